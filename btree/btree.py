@@ -44,12 +44,31 @@ perform_in_batch() method.. Batching opens a single transaction for
 all operations and caches results in memory, thus reducing datastore
 operations, latency and cost.
 """
+import base64
+import collections
+import contextlib
+import hashlib
+import hmac
+import pickle
+import random
+import threading
 from google.appengine.ext import ndb
 import internal
+import keycodec
+from keycodec import Descending
+from replica import TreeReplica
+from storage import MemoryStorage
 
 __author__ = "Tijmen Roberti"
 __license__ = "MIT"
-__all__ = ['BTree', 'MultiBTree', 'MultiBTree2']
+__all__ = ['BTree', 'MultiBTree', 'MultiBTree2', 'Descending',
+           'MemoryStorage', 'TreeReplica', 'BatchError', 'perform_on_trees']
+
+# The maximum number of tree entities in the process-wide tree cache.
+_TREE_CACHE_SIZE = 10000
+# The first byte of cursors that hold a signed pickle instead of a
+# keycodec encoding, which never starts with this byte.
+_SIGNED_CURSOR = "\x00"
 
 
 def batch_operation(func):
@@ -66,37 +85,379 @@ def batch_operation(func):
     return wrapper
 
 
+def _with_expiry(item, size):
+    """
+    Returns the tuple |item| with |size| fields, followed by its
+    optional expiry time, with None as expiry time if the item has
+    none.
+    """
+    item = tuple(item)
+    if len(item) == size:
+        return item + (None,)
+    if len(item) != size + 1:
+        raise ValueError("Invalid item: %s" % (item,))
+    return item
+
+
+class _TreeCache(object):
+    """
+    A process-wide cache of tree entities by key, which holds at most
+    |max_size| trees and evicts the least recently used ones. Tree
+    entities are immutable, so they can be cached indefinitely. Each
+    lookup returns a new instance of the tree, as instances hold the
+    state of their own batches.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        # Maps keys to (model class, property values) tuples.
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Returns a new instance of the tree with the given |key|, or
+        None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+        model_class, values = entry
+        return model_class(key=key, **values)
+
+    def put(self, tree):
+        with self._lock:
+            self._entries.pop(tree.key, None)
+            self._entries[tree.key] = (tree.__class__, tree.to_dict())
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_tree_cache = _TreeCache(_TREE_CACHE_SIZE)
+
+
+class BatchError(Exception):
+    """
+    Raised by perform_on_trees() if a batch failed. The |results| and
+    |errors| attributes are lists with the result and the exception of
+    each batch, in the order of the batches, and None where a batch has
+    no result or did not fail.
+    """
+    def __init__(self, results, errors):
+        failed = len([error for error in errors if error is not None])
+        Exception.__init__(self, "%s of %s batches failed" %
+                           (failed, len(errors)))
+        self.results = results
+        self.errors = errors
+
+
+def perform_on_trees(batches):
+    """
+    Performs a batch of operations on each of several trees, as
+    perform_in_batch() does for a single tree, and returns a list with
+    the result of each batch.
+
+    All batches run one after the other in a single cross-group
+    transaction, so they fail or succeed together. Note that the
+    datastore limits the number of entity groups in a cross-group
+    transaction. If a transaction is already in progress, all batches
+    are part of it.
+
+    Trees are not hashable, so the batches are given as pairs.
+
+    Example:
+
+    perform_on_trees([(daily, lambda: daily.insert(score, None, user)),
+                      (weekly, lambda: weekly.insert(score, None, user))])
+
+    Args:
+      batches: A sequence of (tree, func) pairs, where |func| is a
+        function without arguments as passed to perform_in_batch().
+        Each tree can occur only once.
+
+    Raises:
+      BatchError: If a batch failed. All other batches are then rolled
+        back and have no result.
+      ValueError: If a tree occurs more than once, or if the trees use
+        different storage engines.
+    """
+    batches = list(batches)
+    if len(set(tree.key for tree, _ in batches)) < len(batches):
+        raise ValueError("Each tree can occur only once")
+    storages = set(tree._storage for tree, _ in batches)
+    if len(storages) > 1:
+        raise ValueError("Trees in a single transaction must use the "
+                         "same storage engine")
+    results = [None] * len(batches)
+    errors = [None] * len(batches)
+
+    def txn():
+        errors[:] = [None] * len(batches)
+        for i, (tree, func) in enumerate(batches):
+            try:
+                results[i] = tree.perform_in_batch(func)
+            except Exception as e:
+                errors[i] = e
+                raise
+
+    if batches:
+        try:
+            storages.pop().transaction(txn, xg=True)
+        except Exception:
+            if not any(error is not None for error in errors):
+                raise
+            raise BatchError([None] * len(batches), errors)
+    return results
+
+
+class _ItemIterator(object):
+    """
+    Iterator returned by iter_items(). Yields the items of a key range
+    page by page, each page retrieved in its own batch. The cursor
+    attribute holds the position after the last yielded item.
+    """
+    def __init__(self, tree, start_key, end_key, page_size, cursor):
+        if page_size < 1:
+            raise ValueError("Invalid page size: %s" % (page_size,))
+        self._tree = tree
+        self._start_key = start_key
+        self._end_key = end_key
+        self._page_size = page_size
+        # The (stored key, identifier, rank) of the last yielded item.
+        self._position = None
+        if cursor is not None:
+            self._position = self._decode_cursor(cursor)
+        self._page = []
+        self._start = None
+        self._done = False
+
+    @property
+    def cursor(self):
+        """
+        An opaque string that can be passed to iter_items() to continue
+        after the last yielded item, or None if no item has been
+        yielded yet and no cursor was passed in.
+
+        Raises:
+          ValueError: If the key of the item is not supported by the
+            keycodec module, and the tree has no creation id to sign
+            the cursor with.
+        """
+        if self._position is None:
+            return None
+        key, identifier, rank = self._position
+        position = (self._tree._decode_key(key), identifier, rank)
+        try:
+            data = keycodec.encode(position)
+        except ValueError:
+            data = pickle.dumps(position, 2)
+            data = _SIGNED_CURSOR + self._sign(data) + data
+        return base64.urlsafe_b64encode(data)
+
+    def _sign(self, data):
+        """
+        Returns the HMAC of the byte string |data|, keyed with the
+        creation id of the tree. The creation id is random and never
+        leaves the server, so clients cannot sign cursors themselves.
+        """
+        secret = self._tree.creation_id
+        if secret is None:
+            raise ValueError("Tree %s has no creation id to sign cursors "
+                             "with" % (self._tree.key,))
+        return hmac.new(str(secret), data, hashlib.sha256).digest()
+
+    def _decode_cursor(self, cursor):
+        """
+        Returns the position held by |cursor|. Cursors are decoded with
+        the keycodec module, which only builds plain values, or are
+        only unpickled once their signature is verified, so a cursor
+        from an untrusted source cannot run any code.
+        """
+        try:
+            data = base64.urlsafe_b64decode(str(cursor))
+            if data.startswith(_SIGNED_CURSOR):
+                size = hashlib.sha256().digest_size
+                signature, data = data[1:size + 1], data[size + 1:]
+                if not hmac.compare_digest(signature, self._sign(data)):
+                    raise ValueError()
+                key, identifier, rank = pickle.loads(data)
+            else:
+                key, identifier, rank = keycodec.decode(data)
+            if not ((identifier is None or isinstance(identifier, basestring))
+                    and isinstance(rank, (int, long)) and rank >= 0):
+                raise ValueError()
+            return self._tree._encode_key(key), identifier, rank
+        except Exception:
+            raise ValueError("Invalid cursor: %s" % (cursor,))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            if not self._page and not self._done:
+                self._start, self._page = self._tree.perform_in_batch(
+                    self._fetch_page)
+                self._done = len(self._page) < self._page_size
+            if not self._page:
+                raise StopIteration()
+            item = self._page.pop(0)
+            self._position = (item[0], item[2] if len(item) > 2 else None,
+                              self._start)
+            self._start += 1
+            # Expired items are skipped.
+            item = self._tree._decode_item(item)
+            if item is not None:
+                return item
+
+    def _fetch_page(self):
+        """
+        Returns a (start, items) tuple with the next page of stored
+        items, and the index of the first item.
+        """
+        tree = self._tree
+        if self._position is None:
+            start = 0
+            if self._start_key is not None:
+                start = tree._lower_bound_index(
+                    tree._encode_key(self._start_key))
+        else:
+            start = tree._index_after(*self._position)
+        if self._end_key is None:
+            stop = tree._size()
+        else:
+            stop = tree._lower_bound_index(tree._encode_key(self._end_key))
+        num = min(self._page_size, stop - start)
+        if num <= 0:
+            return start, []
+        return start, tree._get_by_index_range(start_index=start, num=num)
+
+
 class _BTreeBase(internal._BTreeBase):
     """
     Contains all operations that are common to all trees.
     """
     @classmethod
-    def create(cls, key_name, minimum_degree, parent=None):
+    def create(cls, key_name, minimum_degree, parent=None,
+               index_values=True, identifier_order=False, aggregate=None,
+               encode_keys=False, descending=False, capacity=None,
+               keep_lowest=False, ttl=False, versioned=False,
+               inline_threshold=None, root_pointer=False, storage=None):
         """
         Create a new BTree instance with the given |key_name| and
         |minimum_degree|. This will create all initial entities
         and puts them in the Datastore.
 
+        A tree with the same key is replaced. Instances of the old tree
+        that are still cached, also in other processes, notice this
+        in their next batch and reload the options of the new tree.
+
         Args:
           key_name: The name of this BTree entity.
           minimum_degree: The degree of the BTree. This value must be
             at least 2.
+          parent: An optional ndb.Key that is the key of the parent
+            entity for this BTree.
+          index_values: Only used by MultiBTree2. If False, the
+            identifier index only stores the key of each item, not
+            its value. This makes the index entities smaller and they
+            are only rewritten when the key of an identifier changes,
+            but getting an item by identifier requires a lookup in
+            the tree.
+          identifier_order: Only used by MultiBTree2. If True, items
+            with identical keys are ordered by their identifier
+            instead of in insertion order. Finding, removing and
+            replacing items by identifier then takes a single binary
+            search per level, even if many items share the same key.
+          aggregate: If set, the tree maintains the aggregate of the
+            values in each subtree, so aggregate_range() runs in time
+            proportional to the depth of the tree. Either 'sum',
+            'min', 'max', or a picklable (module level) function that
+            combines two values, which must be associative. Values
+            that are None are ignored.
+          encode_keys: If True, keys are stored in an order preserving
+            binary encoding, see the keycodec module. Encoded keys
+            are more compact and faster to compare, but only None,
+            ints, floats, strings, tuples and Descending keys are
+            supported. Keys are decoded again when items are returned,
+            with strings as unicode and integral floats as ints.
+          descending: If True, the items are ordered from the highest
+            to the lowest key, so index 0 holds the highest key. All
+            bounds and key ranges follow the order of the tree, so a
+            key range [lo_key, hi_key) then needs lo_key >= hi_key.
+            Combine with encode_keys to store the keys compactly.
+          capacity: If set, the tree holds at most this many items.
+            Inserting beyond the capacity evicts the items with the
+            lowest keys, including their identifier index entities.
+            If the tree is full, an item that would be evicted
+            directly is rejected without descending the tree.
+          keep_lowest: If True, a capped tree keeps the items with the
+            lowest keys instead, and evicts those with the highest.
+          ttl: If True, items can be inserted with an expiry time. Reads
+            leave out items that have expired, or return None instead
+            of a single expired item, but expired items still count
+            towards indices, sizes and aggregates until they are
+            removed with sweep_expired().
+          versioned: If True, the root holds a generation that changes
+            with every batch that changes the tree, and each node the
+            generation in which it was last written. A TreeReplica of
+            the tree uses these to only fetch the changed nodes. Every
+            batch that changes the tree then also writes the root.
+          inline_threshold: If set, a tree with at most this many items
+            in its root is kept inline: the items are found by
+            identifier from the root, and no identifier index entities
+            are stored. Small MultiBTree2 trees then need a single
+            entity per operation. A tree that grows beyond the
+            threshold gets its index, and drops it again once it
+            shrinks to half the threshold.
+          root_pointer: If True, a small pointer entity holds the id
+            of the root node, instead of the root always being stored
+            under the same key. When the tree grows or shrinks by a
+            level, only the pointer is written, and no node is copied
+            to another key. Each batch then reads the pointer as well.
+          storage: The storage engine for the entities of the tree, see
+            the storage module. By default, the entities are stored
+            in the datastore. Use a MemoryStorage instance to keep the
+            tree in process memory instead.
 
         Raises:
-          ValueError: If minimum_degree has an invalid value.
+          ValueError: If minimum_degree, aggregate, capacity or
+            inline_threshold has an invalid value.
         """
         tree = cls(id=key_name, parent=parent)
-        tree._initialize(minimum_degree)
+        if storage is not None:
+            tree._storage = storage
+        else:
+            # A tree with the same key is replaced.
+            _tree_cache.remove(tree.key)
+        tree._initialize(minimum_degree, index_values=index_values,
+                         identifier_order=identifier_order,
+                         aggregate=aggregate, encode_keys=encode_keys,
+                         descending=descending, capacity=capacity,
+                         keep_lowest=keep_lowest, ttl=ttl,
+                         versioned=versioned,
+                         inline_threshold=inline_threshold,
+                         root_pointer=root_pointer)
         return tree
 
     @classmethod
-    def get_or_create(cls, name, minimum_degree, parent=None):
+    def get_or_create(cls, name, minimum_degree, parent=None, storage=None,
+                      **options):
         """
-        Gets the BTree with the given |name|. If this function is
-        called from a transaction, then the tree is directly retrieved
-        from the Datastore. If not, then first memcache is tried, and
-        then the datastore. This is save, as the BTree model entities
-        are immutable and can be safely memcached.
+        Gets the BTree with the given |name|. Tree entities are
+        immutable, so trees in the datastore are kept in a bounded
+        process-wide cache, which is used both in and outside of
+        transactions. On a cache miss, memcache is tried first outside
+        transactions, and then the datastore.
 
         If the tree does not exist yet, then a new transaction is
         started to create the tree wth the provided |degree|. If a
@@ -113,24 +474,104 @@ class _BTreeBase(internal._BTreeBase):
             guidance on choosing the right degree.
           parent: An optional ndb.Key tbat is the key of the parent
             entity for this BTree.
+          storage: The storage engine that holds the tree, as passed to
+            create(). By default, the datastore. Trees in other storage
+            engines are not cached.
+          options: Additional keyword arguments that are passed to
+            create() if the tree is created. Ignored if the tree
+            already exists.
         """
         key = ndb.Key(cls, name, parent=parent)
+        cached = storage is None
+        if cached:
+            tree = _tree_cache.get(key)
+            if tree is not None:
+                return tree
+            storage = cls._storage
 
         def txn():
-            tree = key.get()
+            tree = storage.get(key)
             if tree is None:
-                tree = cls.create(name, minimum_degree, parent=parent)
+                tree = cls.create(name, minimum_degree, parent=parent,
+                                  storage=storage, **options)
             return tree
 
-        if ndb.in_transaction():
-            tree = txn()
-        else:
-            # Not in a transaction, try memcache, then datastore.
-            tree = key.get()
-            if tree is None:
-                tree = ndb.transaction(txn)
+        # Outside a transaction, the datastore engine tries memcache
+        # first.
+        tree = storage.get(key)
+        if tree is None:
+            tree = storage.transaction(txn)
+            # A tree created in an enclosing transaction is not cached,
+            # as that transaction can still fail.
+            cached = cached and not storage.in_transaction()
+        if cached:
+            _tree_cache.put(tree)
+        tree._storage = storage
         return tree
 
+    @classmethod
+    def drop(cls, name, parent=None, storage=None):
+        """
+        Deletes the tree with the given |name|, and all its entities.
+        The entities are found with keys-only queries, and deleted in
+        chunks that run concurrently, so even large trees are dropped
+        quickly. Does nothing if the tree does not exist.
+
+        Dropping a tree is not atomic, and the tree must not be used
+        while it is dropped. Other processes can keep the tree in
+        their tree cache. Their batches raise a ValueError once the
+        tree is dropped, or use the new tree once it is created again.
+
+        Args:
+          name: The key name of the tree.
+          parent: An optional ndb.Key that is the key of the parent
+            entity of the tree.
+          storage: The storage engine that holds the tree, as passed to
+            create(). By default, the datastore.
+        """
+        key = ndb.Key(cls, name, parent=parent)
+        if storage is not None:
+            cls._drop(key, storage)
+        else:
+            cls._drop(key, cls._storage)
+            _tree_cache.remove(key)
+
+    @classmethod
+    def get_many_trees(cls, names, parent=None):
+        """
+        Returns a list with the tree in the datastore for each of the
+        given |names|, or None for trees that do not exist. The trees
+        are taken from the process-wide tree cache where possible, and
+        the others are fetched together. Unlike get_or_create(), trees
+        are never created.
+
+        Args:
+          names: The key names of the trees.
+          parent: An optional ndb.Key that is the key of the parent
+            entity of all the trees.
+        """
+        keys = [ndb.Key(cls, name, parent=parent) for name in names]
+        trees = [_tree_cache.get(key) for key in keys]
+        missing = [i for i, tree in enumerate(trees) if tree is None]
+        fetched = cls._storage.get_multi([keys[i] for i in missing])
+        for i, tree in zip(missing, fetched):
+            if tree is not None:
+                _tree_cache.put(tree)
+                trees[i] = tree
+        return trees
+
+    def clear(self):
+        """
+        Removes all items from the tree. Instead of deleting the items
+        one by one, all nodes and identifier index entities are found
+        with keys-only queries and deleted in chunks that run
+        concurrently, after which the tree gets an empty root.
+
+        Clearing is not atomic, so the tree must not be changed while
+        it is cleared. Reads see the items until the root is replaced,
+        but identifier lookups can fail before that.
+        """
+        self._clear()
 
     @batch_operation
     def get_by_index(self, index):
@@ -138,7 +579,7 @@ class _BTreeBase(internal._BTreeBase):
         Returns the item at the given index. Raises an IndexError if
         the index is out of bounds.
         """
-        return self._get_by_index(index)
+        return self._decode_item(self._get_by_index(index))
 
 
     @batch_operation
@@ -158,18 +599,45 @@ class _BTreeBase(internal._BTreeBase):
         Raises:
           ValueError: if the key does not exist in the tree.
         """
-        i = self._left_index_of_key(key)
+        i = self._left_index_of_key(self._encode_key(key))
         if i == -1:
             raise ValueError("Key %s not found in the tree." % (key,))
         return i
 
+    @batch_operation
+    def around_index(self, index, before, after):
+        """
+        Returns the items around the given |index|: up to |before|
+        items before it, the item itself and up to |after| items after
+        it. A negative index counts from the end of the tree.
+
+        Returns:
+          An (index, items) tuple, with the non-negative index of the
+          item and the list of items around it.
+
+        Raises:
+          IndexError: If the index is out of bounds.
+          ValueError: If |before| or |after| is negative.
+        """
+        if before < 0 or after < 0:
+            raise ValueError("Invalid window: %s before, %s after" %
+                             (before, after))
+        size = self._size()
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("Index %s out of range" % (index,))
+        path = self._path_to_index(index)
+        return index, self._decode_items(self._get_window(path, before,
+                                                         after))
+
     @batch_operation
     def lower_bound(self, key):
         """
         Returns the index of the first item whose key is not smaller
         than the given |key|.
         """
-        return self._lower_bound_index(key)
+        return self._lower_bound_index(self._encode_key(key))
 
     @batch_operation
     def upper_bound(self, key):
@@ -177,7 +645,203 @@ class _BTreeBase(internal._BTreeBase):
         Returns the index of the first item whose key is strictly
         greater than |key|.
         """
-        return self._upper_bound_index(key)
+        return self._upper_bound_index(self._encode_key(key))
+
+    @batch_operation
+    def count_range(self, lo=None, hi=None, include_lo=True,
+                    include_hi=False):
+        """
+        Returns the number of items with a key between |lo| and |hi|.
+        By default this is the range [lo, hi), and |include_lo| and
+        |include_hi| select whether each end of the range is
+        included. A bound that is None is unbounded.
+
+        Both bounds are found in a single descent that shares the
+        nodes on the common path, and the items in between are
+        counted with the subtree counts.
+        """
+        bounds = []
+        if lo is not None:
+            bounds.append((self._encode_key(lo), not include_lo))
+        if hi is not None:
+            bounds.append((self._encode_key(hi), include_hi))
+        indices = self._bound_indices(bounds)
+        start = indices.pop(0) if lo is not None else 0
+        stop = indices.pop(0) if hi is not None else self._size()
+        return max(0, stop - start)
+
+    @batch_operation
+    def ranks(self, keys):
+        """
+        Returns a list with the rank of each key in |keys|, which is
+        the index of the first item whose key is not smaller than the
+        key, as returned by lower_bound(). All ranks are computed in
+        a single descent of the tree, which is much faster than
+        calling lower_bound() for each key.
+        """
+        return self._bound_indices([(self._encode_key(key), False)
+                                    for key in keys])
+
+    @batch_operation
+    def percentiles(self, keys):
+        """
+        Returns a list with a (rank, percentile) tuple for each key in
+        |keys|. The rank is as returned by ranks(), and the percentile
+        is the fraction of the items in the tree with a smaller key,
+        in the range [0, 1]. The percentile is 0.0 for an empty tree.
+        """
+        size = self._size()
+        return [(rank, float(rank) / size if size else 0.0)
+                for rank in self._bound_indices([(self._encode_key(key), False)
+                                                 for key in keys])]
+
+    @batch_operation
+    def quantile(self, q):
+        """
+        Returns the item at the fractional position |q| in the tree,
+        which must be in the range [0, 1]. For example, 0.5 returns
+        the median item and 1.0 the last item.
+
+        Raises:
+          ValueError: If q is out of range.
+          IndexError: If the tree is empty.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile %s out of range" % (q,))
+        size = self._size()
+        return self._decode_item(self._get_by_index(min(int(q * size),
+                                                        size - 1)))
+
+    @batch_operation
+    def sample(self, k, lo_index=None, hi_index=None):
+        """
+        Returns a list of |k| distinct items, chosen uniformly at
+        random from the items with an index in the range [lo_index,
+        hi_index). By default, the range is the whole tree, and the
+        range is interpreted as a slice. The items are returned in
+        tree order.
+
+        The items are found in a single descent of the tree, so this
+        is much faster than retrieving the whole range.
+
+        Raises:
+          ValueError: If k is larger than the size of the range.
+        """
+        start, stop, _ = slice(lo_index, hi_index).indices(self._size())
+        indices = random.sample(xrange(start, max(start, stop)), k)
+        return self._decode_items(self._get_by_indices(sorted(indices)))
+
+    @batch_operation
+    def sample_by_key(self, k, lo_key, hi_key):
+        """
+        Returns a list of |k| distinct items, chosen uniformly at
+        random from the items with a key in the range [lo_key,
+        hi_key). The items are returned in tree order.
+
+        Raises:
+          ValueError: If k is larger than the number of items in the
+            range.
+        """
+        start, stop = self._bound_indices([(self._encode_key(lo_key), False),
+                                           (self._encode_key(hi_key), False)])
+        return self.sample(k, start, stop)
+
+    @batch_operation
+    def reversed(self, start=None, stop=None):
+        """
+        Returns a list with the items with an index in the range
+        [start, stop) in reverse order, so starting with the item at
+        index stop - 1. By default, the range is the whole tree, and
+        the range is interpreted as a slice. For example, reversed(-10)
+        returns the last 10 items, last item first.
+
+        The items are found in a single walk from right to left, which
+        fetches all needed children of a node together.
+        """
+        start, stop, _ = slice(start, stop).indices(self._size())
+        return self._decode_items(self._get_reversed_range(start, stop))
+
+    def iter_items(self, start_key=None, end_key=None, page_size=100,
+                   cursor=None):
+        """
+        Returns an iterator over the items with a key in the range
+        [start_key, end_key), which are unbounded if None. The items
+        are retrieved lazily in pages of |page_size| items, each in its
+        own short batch, so very large ranges can be read without a
+        long transaction or holding all items in memory. Note that
+        the pages are only consistent with each other if the iteration
+        is done in a single batch.
+
+        The cursor attribute of the iterator is an opaque string which
+        holds the key, identifier and index of the last yielded item.
+        Passing it as |cursor| to a later call continues after that
+        item, even if items were inserted or removed in the meantime.
+        The cursor holds the key encoded with the keycodec module, so
+        byte string keys continue as unicode. Other keys are pickled,
+        and signed with the creation id of the tree, so cursors of a
+        tree that is created again become invalid. Cursors are safe to
+        hand out to clients, as decoding them cannot run any code.
+
+        Example:
+
+        items = tree.iter_items(page_size=500, cursor=saved_cursor)
+        for item in itertools.islice(items, 10000):
+            export(item)
+        saved_cursor = items.cursor
+
+        Raises:
+          ValueError: If the page size or the cursor is invalid.
+        """
+        return _ItemIterator(self, start_key, end_key, page_size, cursor)
+
+    @batch_operation
+    def aggregate_range(self, start=None, stop=None):
+        """
+        Returns the aggregate of the values of the items with an index
+        in the range [start, stop), using the aggregate function the
+        tree was created with. By default, the range is the whole
+        tree, and the range is interpreted as a slice. Returns None if
+        the range is empty.
+
+        Raises:
+          ValueError: If the tree does not maintain aggregates.
+        """
+        if self.aggregate is None:
+            raise ValueError("Tree %s has no aggregate function" %
+                             (self.key,))
+        start, stop, _ = slice(start, stop).indices(self._size())
+        return self._aggregate_index_range(start, stop)
+
+    @batch_operation
+    def aggregate_by_key(self, lo_key, hi_key):
+        """
+        Returns the aggregate of the values of the items with a key
+        in the range [lo_key, hi_key). Returns None if the range is
+        empty.
+
+        Raises:
+          ValueError: If the tree does not maintain aggregates.
+        """
+        start, stop = self._bound_indices([(self._encode_key(lo_key), False),
+                                           (self._encode_key(hi_key), False)])
+        return self.aggregate_range(start, stop)
+
+    @batch_operation
+    def sweep_expired(self, budget=100):
+        """
+        Removes up to |budget| items whose expiry time has passed, and
+        returns the number of removed items. Each node tracks the
+        earliest expiry time in the subtree of each of its links, so
+        subtrees without expired items are skipped. Call repeatedly,
+        for example from a cron job, until it returns less than
+        |budget|.
+
+        Raises:
+          ValueError: If the tree was not created with ttl set.
+        """
+        if not self.ttl:
+            raise ValueError("Tree %s has no expiring items" % (self.key,))
+        return self._sweep_expired(budget)
 
     @batch_operation
     def pop(self, index):
@@ -187,7 +851,7 @@ class _BTreeBase(internal._BTreeBase):
         Raises:
            IndexError: If the index is out of bounds.
         """
-        return self._delete_index(index)
+        return self._decode_item(self._delete_index(index))
 
     @batch_operation
     def tree_size(self):
@@ -198,6 +862,71 @@ class _BTreeBase(internal._BTreeBase):
         """
         return self._size()
 
+    @batch_operation
+    def compact(self, fill_factor=0.9, max_nodes=100, cursor=None):
+        """
+        Re-packs the items of the tree into fewer nodes, each filled
+        to about |fill_factor| of the maximum node size, and deletes
+        the nodes that are freed. Useful after removing many items,
+        which can leave many nodes at their minimum size.
+
+        Nodes are re-packed across the boundaries of their parents,
+        and the tree is lowered when the children of the root fit into
+        a single node. Every node except the root still keeps at least
+        as many children as the minimum degree of the tree, so a tree
+        of a low degree can keep nodes that are filled below
+        |fill_factor|. Another pass can then pack the nodes further.
+
+        Compaction is done in chunks, so a pass over a large tree can
+        be spread over multiple calls (and requests). Each call
+        re-packs the children of about |max_nodes| nodes and returns
+        a cursor, which must be passed to the next call to continue
+        the pass. None is returned when the pass is completed.
+
+        Example:
+
+        cursor = tree.compact()
+        while cursor is not None:
+            cursor = tree.compact(cursor=cursor)
+
+        Raises:
+          ValueError: If fill_factor is not in the range (0, 1].
+        """
+        if not 0 < fill_factor <= 1:
+            raise ValueError("Invalid fill factor: %s" % (fill_factor,))
+        return self._compact(fill_factor, max_nodes, cursor)
+
+
+    @contextlib.contextmanager
+    def node_cache(self):
+        """
+        Returns a context manager in which the root and internal nodes
+        of the tree are kept in memory between batches, for example
+        for the duration of a request. Each batch still reads the
+        root to check the generation of the tree, but the other upper
+        levels are only fetched again if the tree changed. Nested
+        uses share the same cache.
+
+        Example:
+
+        with tree.node_cache():
+            rank = tree.index(key)
+            top = tree[0:10]
+
+        Raises:
+          ValueError: If the tree was not created with versioned set.
+        """
+        if not self.versioned:
+            raise ValueError("Tree %s is not versioned" % (self.key,))
+        if self._node_cache is not None:
+            yield
+            return
+        self._node_cache = {}
+        try:
+            yield
+        finally:
+            self._node_cache = None
+
 
     def perform_in_batch(self, func):
         """
@@ -228,27 +957,32 @@ class _BTreeBase(internal._BTreeBase):
         Returns the item at the given index. If a slice is provided, a
         list containing all items in the range are provided. Note that
         the slice arguments are more limited than those of a general
-        list. Only positive indices and step values are allowed for
-        slices. A negative index is allowed for single items.
+        list. Only steps of 1 and -1 are allowed for slices, the
+        latter returns the items in reverse order, as reversed() does.
 
         Raises a ValueError if the index is out of range, or when
-        negative values are used.
+        an unsupported step is used.
         """
         if isinstance(index, slice):
             start, stop, step = index.indices(self.tree_size())
+            if step == -1:
+                return self._decode_items(
+                    self._get_reversed_range(stop + 1, start + 1))
             if step != 1:
                 # User can implement this themselves, as 'under the
                 # hood' the full range gets retrieved anyway, so there
                 # is no performance benefit.
                 raise ValueError("Stepping in a slice is not supported")
-            return self._get_by_index_range(start_index=start, num=stop - start)
+            return self._decode_items(
+                self._get_by_index_range(start_index=start, num=stop - start))
         else:
-            return self._get_by_index(index)
+            return self._decode_item(self._get_by_index(index))
 
 
     @batch_operation
     def __contains__(self, key):
-        return self._get_by_key(key) is not None
+        return self._decode_item(
+            self._get_by_key(self._encode_key(key))) is not None
 
 
 class BTree(_BTreeBase):
@@ -259,22 +993,30 @@ class BTree(_BTreeBase):
     described above.
     """
     @batch_operation
-    def insert(self, key, value):
+    def insert(self, key, value, expires=None):
         """
         Inserts a new value in the btree for the given key.
-        Any existing value for that key will be overwritten.
+        Any existing value for that key will be overwritten. In trees
+        created with ttl set, |expires| is the optional POSIX time at
+        which the item expires.
+
+        Returns False if the tree is capped and the item is rejected,
+        otherwise True.
         """
-        self._insert(key, value, None, allow_duplicates=False)
+        return self._insert(self._encode_key(key), value, None,
+                            allow_duplicates=False, expires=expires)
 
     @batch_operation
     def update(self, iterable):
         """
         Inserts multiple key, value pairs in the tree. Any iterable
         that yields (key, value) pairs can be used as input for this
-        function.
+        function. The pairs can also be (key, value, expires) tuples.
         """
-        for (key, value) in iterable:
-            self._insert(key, value, None, allow_duplicates=False)
+        for item in iterable:
+            key, value, expires = _with_expiry(item, 2)
+            self._insert(self._encode_key(key), value, None,
+                         allow_duplicates=False, expires=expires)
 
     @batch_operation
     def get(self, key):
@@ -283,14 +1025,14 @@ class BTree(_BTreeBase):
             The value that corresponds to the given key,
             or None if no such value exists.
         """
-        return self._get_by_key(key)
+        return self._decode_item(self._get_by_key(self._encode_key(key)))
 
     @batch_operation
     def remove(self, key):
         """
         Remove the entry with the given |key|.
         """
-        self._delete_key(key)
+        self._delete_key(self._encode_key(key))
 
 
 class MultiBTree(_BTreeBase):
@@ -301,30 +1043,40 @@ class MultiBTree(_BTreeBase):
     If the items need to be uniquely identifable, use MultiBTree2.
     """
     @batch_operation
-    def insert(self, key, value):
+    def insert(self, key, value, expires=None):
         """
         Inserts a new value in the btree with the given key. Multiple
         identical keys are allowed, and are ordered in insertion
-        order.
+        order. In trees created with ttl set, |expires| is the
+        optional POSIX time at which the item expires.
+
+        Returns False if the tree is capped and the item is rejected,
+        otherwise True.
         """
-        self._insert(key, value, None, allow_duplicates=True)
+        return self._insert(self._encode_key(key), value, None,
+                            allow_duplicates=True, expires=expires)
 
     @batch_operation
     def update(self, iterable):
         """
         Inserts multiple key, value pairs in the tree. Any iterable
         that yields (key, value) pairs can be used as input for this
-        function.
+        function. The pairs can also be (key, value, expires) tuples.
         """
-        for (key, value) in iterable:
-            self._insert(key, value, None, allow_duplicates=True)
+        for item in iterable:
+            key, value, expires = _with_expiry(item, 2)
+            self._insert(self._encode_key(key), value, None,
+                         allow_duplicates=True, expires=expires)
 
     @batch_operation
     def count(self, key):
         """
-        Counts the number of occurrences of |key|.
+        Counts the number of occurrences of |key|. Both ends of the
+        range of items with the key are found in a single descent.
         """
-        return (self._right_index_of_key(key) - self._left_index_of_key(key))
+        key = self._encode_key(key)
+        lower, upper = self._bound_indices([(key, False), (key, True)])
+        return upper - lower
 
     @batch_operation
     def get_all(self, key):
@@ -332,7 +1084,7 @@ class MultiBTree(_BTreeBase):
         Returns a list with all (key, value) pairs stored in the tree
         that match the given |key|.
         """
-        return self._get_all_by_key(key)
+        return self._decode_items(self._get_all_by_key(self._encode_key(key)))
 
     @batch_operation
     def index_left(self, key):
@@ -353,7 +1105,7 @@ class MultiBTree(_BTreeBase):
         Raises:
           ValueError: If the key does not exist in the tree.
         """
-        i = self._right_index_of_key(key)
+        i = self._right_index_of_key(self._encode_key(key))
         if i == -1:
             raise ValueError("Key %s not found in the tree." % (key,))
         return i
@@ -363,7 +1115,7 @@ class MultiBTree(_BTreeBase):
         """
         Removes all entries with the given |key|.
         """
-        self._delete_key_all(key)
+        self._delete_key_all(self._encode_key(key))
 
 
 class MultiBTree2(_BTreeBase):
@@ -383,14 +1135,17 @@ class MultiBTree2(_BTreeBase):
     the identifier is already used in the tree.
 
     Obviously, storage costs are also increased, as the identifier is
-    stored with each key, value pair.
+    stored with each key, value pair. Trees created with index_values
+    set to False keep only the keys in the identifier index, which
+    reduces the size of the index and the number of index writes.
     """
     @batch_operation
-    def insert(self, key, value, identifier):
+    def insert(self, key, value, identifier, expires=None):
         """
         Inserts a new value in the btree with the given key and unique
         identifier. Multiple identical keys are allowed, and are
-        ordered in insertion order.
+        ordered in insertion order, or by identifier if the tree was
+        created with identifier_order set.
 
         The parameter |identifier| must be a string that uniquely
         identifies this key/value pair, which can later be used to
@@ -402,9 +1157,16 @@ class MultiBTree2(_BTreeBase):
         into a normal BTree, but with extra overhead caused by the
         identifier querying. In those cases you are better off using a
         BTree.
+
+        In trees created with ttl set, |expires| is the optional POSIX
+        time at which the item expires.
+
+        Returns False if the tree is capped and the item is rejected,
+        otherwise True.
         """
         if identifier is not None:
-            self._insert(key, value, identifier, allow_duplicates=True)
+            return self._insert(self._encode_key(key), value, identifier,
+                                allow_duplicates=True, expires=expires)
         else:
             raise ValueError("Invalid identifier: %s" % (identifier,))
 
@@ -413,23 +1175,92 @@ class MultiBTree2(_BTreeBase):
         """
         Inserts multiple key, value, identifier tuples in the
         tree. Any iterable that yields (key, value, identifier) tuples
-        can be used as input for this function.
+        can be used as input for this function. The tuples can also
+        be (key, value, identifier, expires) tuples.
+
+        The result is the same as inserting the items one by one, but
+        all existing items with the same identifiers are replaced in
+        a single pass before the new items are inserted, which is
+        considerably faster.
+        """
+        items = [(self._encode_key(key), value, id, expires)
+                 for (key, value, id, expires)
+                 in (_with_expiry(item, 3) for item in iterable)]
+        for (key, value, id, expires) in items:
+            if id is None:
+                raise ValueError("Identifiers cannot be None")
+        self._insert_with_identifiers(items)
+
+    @batch_operation
+    def upsert_if(self, identifier, key, value, predicate='max',
+                  expires=None):
+        """
+        Inserts the (key, value) pair with the given |identifier|, but
+        only if there is no item with that identifier yet, or if the
+        new key wins from the key of the existing item. Otherwise the
+        tree is not changed at all.
+
+        The decision only needs the identifier index, so rejected
+        items do not cost any tree reads or writes. In trees created
+        with ttl set, an item that would be rejected is accepted if
+        the existing item has expired, which is checked by reading the
+        node that holds it.
+
+        Args:
+          identifier: The unique string identifier of the item.
+          key: The new key, for example a score.
+          value: The new value.
+          predicate: Either 'max', which accepts a key that is
+            strictly greater than the existing key, 'min', which
+            accepts a key that is strictly smaller, or a function that
+            is called as predicate(new_key, existing_key) and returns
+            True if the new item must replace the existing item.
+          expires: The optional POSIX time at which the new item
+            expires, in trees created with ttl set.
+
+        Returns:
+          True if the item was inserted, False otherwise, also if the
+          item is rejected by a capped tree.
+
+        Raises:
+          ValueError: If the identifier or predicate is invalid.
+        """
+        if identifier is None:
+            raise ValueError("Invalid identifier: %s" % (identifier,))
+        return self._upsert_with_identifiers(
+            [(self._encode_key(key), value, identifier, expires)],
+            predicate)[0]
+
+    @batch_operation
+    def upsert_all_if(self, iterable, predicate='max'):
+        """
+        Performs upsert_if() for all (key, value, identifier) tuples
+        yielded by |iterable|, in order, in a single batch. All
+        identifiers are fetched at once, and the accepted items are
+        inserted as in update(). The tuples can also be (key, value,
+        identifier, expires) tuples.
+
+        Returns:
+          A list of booleans, one for each item, that tells whether
+          the item was inserted.
         """
-        keys, values, identifiers = zip(*iterable)
-        for id in identifiers:
+        items = [(self._encode_key(key), value, id, expires)
+                 for (key, value, id, expires)
+                 in (_with_expiry(item, 3) for item in iterable)]
+        for (key, value, id, expires) in items:
             if id is None:
                 raise ValueError("Identifiers cannot be None")
-        self._populate_identifier_cache(identifiers)
-        import itertools
-        for (key, value, id) in itertools.izip(keys, values, identifiers):
-            self._insert(key, value, id, allow_duplicates=True)
+        return self._upsert_with_identifiers(items, predicate)
 
     @batch_operation
     def count(self, key):
         """
-        Counts the number of occurrences of |key|.
+        Counts the number of occurrences of |key|. Both ends of the
+        range of items with the key are found in a single descent.
         """
-        return (self._right_index_of_key(key) - self._left_index_of_key(key))
+        key = self._encode_key(key)
+        lower, upper = self._bound_indices([(key, False), (key, True)])
+        return upper - lower
 
     @batch_operation
     def get_all(self, key):
@@ -437,7 +1268,7 @@ class MultiBTree2(_BTreeBase):
         Returns a list with all items, each a (key, value, identifier)
         tuple, that match the given key in this tree.
         """
-        return self._get_all_by_key(key)
+        return self._decode_items(self._get_all_by_key(self._encode_key(key)))
 
     @batch_operation
     def get_by_identifier(self, identifier):
@@ -446,7 +1277,46 @@ class MultiBTree2(_BTreeBase):
         the given unique identifier. Returns None is no such item
         exists.
         """
-        return self._get_by_identifier(identifier)
+        return self._decode_item(self._get_by_identifier(identifier))
+
+    @batch_operation
+    def around(self, identifier, before, after):
+        """
+        Returns the rank of the item with the given |identifier|,
+        together with up to |before| items before it, the item itself
+        and up to |after| items after it. The rank and the items are
+        found from a single descent to the item.
+
+        Returns:
+          An (index, items) tuple, or None if no item with the given
+          identifier exists.
+
+        Raises:
+          ValueError: If |before| or |after| is negative.
+        """
+        if before < 0 or after < 0:
+            raise ValueError("Invalid window: %s before, %s after" %
+                             (before, after))
+        indexed = self._indexed_item(identifier)
+        if indexed is None:
+            return None
+        path = self._path_to_item(indexed[0], identifier)
+        return self._index_of_path(path), self._decode_items(
+            self._get_window(path, before, after))
+
+    @batch_operation
+    def index_of_identifier(self, identifier):
+        """
+        Returns the index of the item with the given |identifier|.
+
+        Raises:
+          ValueError: If no item with the identifier exists.
+        """
+        indexed = self._indexed_item(identifier)
+        if indexed is None:
+            raise ValueError("Identifier %s not found in the tree." %
+                             (identifier,))
+        return self._index_for_key_and_identifier(indexed[0], identifier)
 
     @batch_operation
     def index_left(self, key):
@@ -464,7 +1334,7 @@ class MultiBTree2(_BTreeBase):
         Raises:
           ValueError: If the key is not in the tree.
         """
-        i = self._right_index_of_key(key)
+        i = self._right_index_of_key(self._encode_key(key))
         if i == -1:
             raise ValueError("Key %s not found in the tree." % (key,))
         return i
@@ -474,7 +1344,7 @@ class MultiBTree2(_BTreeBase):
         """
         Removes all entries with the given |key|.
         """
-        self._delete_key_all(key)
+        self._delete_key_all(self._encode_key(key))
 
     @batch_operation
     def remove_by_identifier(self, identifier):
@@ -1,15 +1,25 @@
 """
 Tests for the BTrees.
 """
+import base64
+import datetime
 import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
 import unittest
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
 
-from . import BTree, MultiBTree, MultiBTree2
+from . import (BTree, MultiBTree, MultiBTree2, Descending, MemoryStorage,
+               TreeReplica, BatchError, perform_on_trees)
 
+import btree
 import internal
+import keycodec
 
 
 class BTreeTestBase(unittest.TestCase):
@@ -19,6 +29,8 @@ class BTreeTestBase(unittest.TestCase):
         self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0)
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
         self.testbed.init_memcache_stub()
+        # The process-wide tree cache outlives the datastore stub.
+        btree._tree_cache.clear()
         # Silences the logging messages during the tests
         ndb.add_flow_exception(ValueError)
         ndb.add_flow_exception(IndexError)
@@ -37,6 +49,10 @@ def walk_items(tree):
 def walk_keys(tree):
     return [item[0] for item in walk_items(tree)]
 
+def count_nodes(tree):
+    q = internal._BTreeNode.query(ancestor=tree.key)
+    return len(q.fetch(keys_only=True))
+
 
 class BTreeTest(BTreeTestBase):
     def validate_tree(self, tree):
@@ -55,7 +71,7 @@ class BTreeTest(BTreeTestBase):
         """
         items = tree[:]
         for item in items:
-            key = ndb.Key(MultiBTree2, "tree", internal._BTreeIndex, item[2])
+            key = ndb.Key(internal._BTreeIndex, item[2], parent=tree.key)
             index = key.get()
             self.assertIsNotNone(index)
             self.assertEqual(index.tree_key, item[0])
@@ -755,6 +771,18 @@ class BTreeTest(BTreeTestBase):
         tree.perform_in_batch(f)
         self.validate_empty_tree(tree)
 
+    def test_pop_deep_tree(self):
+        """
+        Tests deleting by index in a tree of height three or more,
+        where moving and merging children also moves whole subtrees.
+        """
+        tree = MultiBTree.create("tree", 2)
+        tree.update((x, str(x)) for x in range(100))
+        items = tree[:]
+        for index in [37, 11, 50, 0, 3, 80, 21, 60, 9, 40]:
+            self.assertEqual(items.pop(index), tree.pop(index))
+            self.assertEqual(items, tree[:])
+
     def test_print_tree(self):
         """
         Tests the print tree functions. These are for debugging
@@ -769,6 +797,1298 @@ class BTreeTest(BTreeTestBase):
         tree._print_tree_summary()
 
 
+    def test_compact(self):
+        """
+        Tests compacting a tree after many items are removed, both in
+        a single pass and in small chunks.
+        """
+        for chunk in [1000, 1]:
+            name = "tree-%s" % chunk
+            tree = MultiBTree2.create(name, 3)
+            tree.update((x, str(x), str(x)) for x in range(200))
+            def f():
+                for x in range(200):
+                    if x % 5:
+                        tree.remove_by_identifier(str(x))
+            tree.perform_in_batch(f)
+            items = tree[:]
+            before = count_nodes(tree)
+            cursor = tree.compact(max_nodes=chunk)
+            while cursor is not None:
+                cursor = tree.compact(max_nodes=chunk, cursor=cursor)
+            self.assertLess(count_nodes(tree), before)
+            # The 40 remaining items fill 10 leaves, which requires
+            # moving leaves between their parents.
+            self.assertEqual(13, count_nodes(tree))
+            self.assertEqual(items, tree[:])
+            self.assertEqual(len(items), tree.tree_size())
+            self.validate_indices(tree)
+            # The compacted tree must still support all operations.
+            tree.update((x, str(x), str(x)) for x in range(1, 200, 5))
+            tree.remove_by_identifier("0")
+            self.validate_tree(tree)
+            self.assertEqual(len(items) + 39, tree.tree_size())
+        self.assertRaises(ValueError, tree.compact, 0)
+
+
+    def test_index_without_values(self):
+        """
+        Tests a MultiBTree2 whose identifier index only stores keys.
+        """
+        tree = MultiBTree2.create("tree", 3, index_values=False)
+        self.assertFalse(tree.index_values)
+        tree.update((x, str(x), str(x)) for x in range(50))
+        for x in range(50):
+            self.assertEqual((x, str(x), str(x)),
+                             tree.get_by_identifier(str(x)))
+        for item in tree[:]:
+            key = ndb.Key(internal._BTreeIndex, item[2], parent=tree.key)
+            index = key.get()
+            self.assertEqual(index.tree_key, item[0])
+            self.assertIsNone(index.tree_value)
+        # Replacing only the values, or moving items between nodes,
+        # must not write any index entities.
+        written = []
+        make_index = tree._make_index
+        def spy(*args):
+            written.append(args[0])
+            return make_index(*args)
+        tree._make_index = spy
+        tree.update((x, "new", str(x)) for x in range(50))
+        tree.remove_by_identifier("25")
+        self.assertEqual([], written)
+        self.assertEqual((10, "new", "10"), tree.get_by_identifier("10"))
+        self.assertIsNone(tree.get_by_identifier("25"))
+        tree.insert(100, "moved", "10")
+        self.assertEqual(["10"], written)
+        self.assertEqual((100, "moved", "10"), tree.get_by_identifier("10"))
+        self.validate_tree(tree)
+        # Equal contents of another type are still written.
+        tree.insert(20.0, "new", "20")
+        self.assertEqual(["10", "20"], written)
+        key = ndb.Key(internal._BTreeIndex, "20", parent=tree.key)
+        self.assertIsInstance(key.get().tree_key, float)
+        tree = MultiBTree2.create("values", 3)
+        tree.update((x, 1, str(x)) for x in range(50))
+        tree.update((x, 1.0, str(x)) for x in range(50))
+        key = ndb.Key(internal._BTreeIndex, "30", parent=tree.key)
+        self.assertIsInstance(key.get().tree_value, float)
+
+
+    def test_update_replaces_identifiers(self):
+        """
+        Tests that update() gives the same result as inserting the
+        items one by one, when many identifiers are replaced.
+        """
+        import bisect
+        expected = []
+        def insert(key, value, id):
+            expected[:] = [item for item in expected if item[2] != id]
+            keys = [item[0] for item in expected]
+            expected.insert(bisect.bisect_right(keys, key), (key, value, id))
+
+        tree = MultiBTree2.create("tree", 3)
+        items = [(x % 20, str(x), str(x)) for x in range(100)]
+        for item in items:
+            insert(*item)
+        tree.update(items)
+        self.assertEqual(expected, tree[:])
+        # Items with identical keys, items that move within their
+        # leaf or further, new items and a repeated identifier.
+        items = [(x % 20, "same", str(x)) for x in range(0, 100, 7)]
+        items += [(x % 20 + 0.5, "moved", str(x)) for x in range(1, 100, 9)]
+        items += [(50 + x, "new", "new-%s" % x) for x in range(5)]
+        items += [(-1, "first", "3"), (7.25, "last", "3")]
+        for item in items:
+            insert(*item)
+        # Each replaced item is located once, whether it is moved within
+        # its leaf or deleted.
+        located = []
+        path_to_item = tree._path_to_item
+        def spy(key, id):
+            located.append(id)
+            return path_to_item(key, id)
+        tree._path_to_item = spy
+        tree.update(items)
+        tree._path_to_item = path_to_item
+        replaced = set(item[2] for item in items
+                       if not item[2].startswith("new"))
+        self.assertEqual(sorted(replaced), sorted(located))
+        self.assertEqual(expected, tree[:])
+        self.assertEqual(len(expected), tree.tree_size())
+        self.validate_indices(tree)
+        # The same, for an item that is inserted on its own.
+        del located[:]
+        tree._path_to_item = spy
+        tree.insert(1000, "far", "5")
+        tree._path_to_item = path_to_item
+        insert(1000, "far", "5")
+        self.assertEqual(["5"], located)
+        self.assertEqual(expected, tree[:])
+        self.validate_indices(tree)
+
+
+    def test_upsert_if(self):
+        """
+        Tests the conditional inserts of a MultiBTree2.
+        """
+        tree = MultiBTree2.create("tree", 3)
+        self.assertTrue(tree.upsert_if("a", 10, "v1"))
+        self.assertFalse(tree.upsert_if("a", 5, "v2"))
+        self.assertFalse(tree.upsert_if("a", 10, "v2"))
+        self.assertEqual((10, "v1", "a"), tree.get_by_identifier("a"))
+        self.assertTrue(tree.upsert_if("a", 15, "v3"))
+        self.assertEqual((15, "v3", "a"), tree.get_by_identifier("a"))
+        self.assertTrue(tree.upsert_if("a", 1, "v4", predicate="min"))
+        self.assertTrue(tree.upsert_if("a", 1, "v5",
+                                       predicate=lambda new, old: new == old))
+        self.assertEqual([(1, "v5", "a")], tree[:])
+        self.assertRaises(ValueError, tree.upsert_if, "a", 1, "v", "median")
+        self.assertRaises(ValueError, tree.upsert_if, None, 1, "v")
+        # Bulk submissions, also with repeated identifiers.
+        tree = MultiBTree2.create("tree-bulk", 3)
+        items = [(x % 7, str(x), str(x % 10)) for x in range(100)]
+        results = tree.upsert_all_if(items)
+        best = {}
+        for key, value, id in items:
+            if id not in best or key > best[id][0]:
+                best[id] = (key, value, id)
+        self.assertEqual(sorted(best.values()), sorted(tree[:]))
+        self.assertEqual(len(best), tree.tree_size())
+        self.assertEqual(len(best), sum(1 for x in range(10)
+                                        if results[x]))
+        self.validate_indices(tree)
+        # Expired items that are not swept yet count as absent.
+        tree = MultiBTree2.create("tree-ttl", 3, ttl=True)
+        past = time.time() - 60
+        tree.update((x, str(x), "id%s" % x, past if x % 2 else None)
+                    for x in range(20))
+        self.assertTrue(tree.upsert_if("id1", 0, "new"))
+        self.assertFalse(tree.upsert_if("id2", 0, "new"))
+        self.assertEqual([True, False, True, True], tree.upsert_all_if(
+                [(0, "new", "id3"), (0, "new", "id4"),
+                 (-1, "new", "id5", past), (-2, "new", "id5")]))
+        self.assertEqual((0, "new", "id1"), tree.get_by_identifier("id1"))
+        self.assertEqual((0, "new", "id3"), tree.get_by_identifier("id3"))
+        self.assertEqual((-2, "new", "id5"), tree.get_by_identifier("id5"))
+        self.assertEqual(20, tree.tree_size())
+        self.validate_indices(tree)
+
+
+    def test_around(self):
+        """
+        Tests the neighborhood queries.
+        """
+        tree = MultiBTree2.create("tree", 3)
+        items = [(x // 3, str(x), str(x)) for x in range(60)]
+        tree.update(items)
+        for x in [0, 1, 5, 30, 58, 59]:
+            self.assertEqual((x, items[max(0, x - 10):x + 6]),
+                             tree.around(str(x), 10, 5))
+            self.assertEqual((x, items[max(0, x - 2):x + 3]),
+                             tree.around_index(x, 2, 2))
+        self.assertEqual((59, items[57:]), tree.around_index(-1, 2, 2))
+        self.assertEqual((0, [items[0]]), tree.around_index(0, 0, 0))
+        self.assertIsNone(tree.around("missing", 1, 1))
+        self.assertRaises(IndexError, tree.around_index, 60, 1, 1)
+        self.assertRaises(ValueError, tree.around, "5", -1, 1)
+        self.assertRaises(ValueError, tree.around_index, 5, 1, -1)
+        # The window is collected from the one descent to the item, so
+        # every node is retrieved at most once.
+        for x in range(60):
+            fetched = []
+            get_node = tree._get_node
+            def spy(link):
+                fetched.append(link)
+                return get_node(link)
+            tree._get_node = spy
+            window = tree.around(str(x), 7, 4)
+            tree._get_node = get_node
+            self.assertEqual((x, items[max(0, x - 7):x + 5]), window)
+            self.assertEqual(len(set(fetched)), len(fetched))
+
+
+    def test_ranks_and_percentiles(self):
+        """
+        Tests the batched rank functions.
+        """
+        import bisect
+        tree = MultiBTree.create("tree", 3)
+        self.assertEqual([0, 0], tree.ranks([1, 2]))
+        self.assertEqual([(0, 0.0)], tree.percentiles([1]))
+        self.assertRaises(IndexError, tree.quantile, 0.5)
+        keys = sorted(x % 23 for x in range(100))
+        tree.update((key, str(key)) for key in keys)
+        probes = [50, -1, 3, 3, 22, 10.5, 0, 7]
+        expected = [bisect.bisect_left(keys, key) for key in probes]
+        self.assertEqual(expected, tree.ranks(probes))
+        self.assertEqual([(rank, rank / 100.0) for rank in expected],
+                         tree.percentiles(probes))
+        self.assertEqual(tree[0], tree.quantile(0))
+        self.assertEqual(tree[50], tree.quantile(0.5))
+        self.assertEqual(tree[99], tree.quantile(1))
+        self.assertRaises(ValueError, tree.quantile, 1.5)
+
+
+    def test_identifier_order(self):
+        """
+        Tests a MultiBTree2 that orders identical keys by identifier.
+        """
+        tree = MultiBTree2.create("tree", 3, identifier_order=True)
+        ids = ["%03d" % ((x * 37) % 100) for x in range(100)]
+        items = [(x % 3, "v", id) for x, id in enumerate(ids)]
+        tree.update(items[:50])
+        for item in items[50:]:
+            tree.insert(*item)
+        expected = sorted(items)
+        self.assertEqual(expected, tree[:])
+        for i, item in enumerate(expected):
+            self.assertEqual(i, tree.index_of_identifier(item[2]))
+        self.assertRaises(ValueError, tree.index_of_identifier, "missing")
+        # Replace and remove items.
+        tree.update([(1, "w", "000"), (0, "w", "099"), (2, "w", "050")])
+        tree.remove_by_identifier("001")
+        expected = sorted([item for item in expected
+                           if item[2] not in ("000", "099", "050", "001")] +
+                          [(1, "w", "000"), (0, "w", "099"), (2, "w", "050")],
+                          key=lambda item: (item[0], item[2]))
+        self.assertEqual(expected, tree[:])
+        self.assertEqual(expected.index((0, "w", "099")),
+                         tree.index_of_identifier("099"))
+        self.validate_indices(tree)
+
+
+    def test_sample(self):
+        """
+        Tests random sampling from (parts of) the tree.
+        """
+        tree = MultiBTree.create("tree", 3)
+        items = [(x // 2, str(x)) for x in range(100)]
+        tree.update(items)
+        sample = tree.sample(10)
+        self.assertEqual(10, len(sample))
+        self.assertEqual(sorted(set(sample), key=items.index), sample)
+        self.assertTrue(all(item in items for item in sample))
+        sample = tree.sample(5, 20, 30)
+        self.assertEqual(5, len(set(sample)))
+        self.assertTrue(all(item in items[20:30] for item in sample))
+        self.assertEqual(items[90:], tree.sample(10, -10))
+        self.assertEqual(items, tree.sample(100))
+        sample = tree.sample_by_key(8, 10, 15)
+        self.assertEqual(8, len(set(sample)))
+        self.assertTrue(all(10 <= item[0] < 15 for item in sample))
+        self.assertEqual(items[20:30], tree.sample_by_key(10, 10, 15))
+        self.assertEqual([], tree.sample(0))
+        self.assertRaises(ValueError, tree.sample, 11, 0, 10)
+        self.assertRaises(ValueError, tree.sample_by_key, 3, 5, 6)
+
+
+    def test_aggregates(self):
+        """
+        Tests that the subtree aggregates stay correct through splits,
+        merges, moves between siblings, compaction and replaced items.
+        """
+        def check(tree):
+            values = [item[1] for item in tree[:]]
+            self.assertEqual(sum(values) if values else None,
+                             tree.aggregate_range())
+            for start, stop in [(0, 1), (3, 17), (5, -5), (-20, None),
+                                (10, 10), (40, 20)]:
+                expected = values[start:stop]
+                self.assertEqual(sum(expected) if expected else None,
+                                 tree.aggregate_range(start, stop))
+
+        tree = MultiBTree2.create("tree", 2, aggregate='sum')
+        tree.update((x % 7, x, str(x)) for x in range(100))
+        check(tree)
+        self.assertEqual(sum(x for x in range(100) if 2 <= x % 7 < 4),
+                         tree.aggregate_by_key(2, 4))
+        self.assertIsNone(tree.aggregate_by_key(4, 2))
+        # Replacing values in place, and moving items.
+        tree.update((x % 7, x * 2, str(x)) for x in range(0, 100, 3))
+        tree.update((x % 5, x, str(x)) for x in range(1, 100, 3))
+        check(tree)
+        for x in range(0, 100, 2):
+            tree.remove_by_identifier(str(x))
+            if x % 10 == 0:
+                check(tree)
+        check(tree)
+        cursor = tree.compact()
+        while cursor is not None:
+            cursor = tree.compact(cursor=cursor)
+        check(tree)
+        for x in range(1, 100, 2):
+            tree.pop(0)
+        self.assertIsNone(tree.aggregate_range())
+
+        tree = BTree.create("tree-max", 2, aggregate='max')
+        tree.update((x, (x * 37) % 101) for x in range(100))
+        tree.insert(50, 1000)
+        self.assertEqual(1000, tree.aggregate_range(40, 60))
+        self.assertEqual(max((x * 37) % 101 for x in range(60, 100)),
+                         tree.aggregate_by_key(60, 100))
+        tree.remove(50)
+        self.assertEqual(max((x * 37) % 101 for x in range(40, 60)
+                             if x != 50),
+                         tree.aggregate_range(40, 59))
+        self.assertRaises(ValueError, BTree.create("tree-none", 2)
+                          .aggregate_range)
+        self.assertRaises(ValueError, BTree.create, "tree-bad", 2,
+                          aggregate='avg')
+
+
+    def test_keycodec(self):
+        """
+        Tests that encoded keys decode to the original keys and sort in
+        the same order as the keys.
+        """
+        groups = [
+            [None],
+            [-float("inf"), -1e300, -2 ** 70, -256, -255.5, -255, -1.5, -1,
+             -1e-300, 0, 5e-324, 0.5, 1, 1 + 2 ** -52, 1.5, 9.5, 10, 255,
+             255.5, 256, 2 ** 70, 1e300, float("inf")],
+            ["", u"\x00", "\x00\x00", "\x00\x01", "a", "a\x00", "ab",
+             u"\xe9", u"\u20ac"],
+            [(), (None,), (1,), (1, "a"), (1, "b"), (2,), ("a", -1)],
+            [Descending("b"), Descending("ab"), Descending("a")],
+        ]
+        keys = [key for group in groups for key in group]
+        for key in keys:
+            self.assertEqual(key, keycodec.decode(keycodec.encode(key)))
+        encoded = [keycodec.encode(key) for key in keys]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual(len(set(encoded)), len(encoded))
+        self.assertRaises(ValueError, keycodec.encode, [1, 2])
+        self.assertRaises(ValueError, keycodec.decode, "\x7f")
+        self.assertRaises(ValueError, keycodec.decode,
+                          keycodec.encode("abc")[:-1])
+        self.assertRaises(ValueError, keycodec.decode,
+                          keycodec.encode(1)[:-1] + "\x05")
+
+    def test_keycodec_numbers_and_strings(self):
+        """
+        Tests that ints and floats share one numeric order, and that
+        str and unicode strings are the same keys.
+        """
+        encode = keycodec.encode
+        self.assertEqual([9.5, 10, 10.5],
+                         sorted([10, 10.5, 9.5], key=encode))
+        self.assertEqual([(-1, 2.5), (-0.5, 1), (0, "a")],
+                         sorted([(0, "a"), (-0.5, 1), (-1, 2.5)], key=encode))
+        self.assertEqual(encode(0), encode(-0.0))
+        self.assertEqual(encode(10), encode(10.0))
+        self.assertEqual(10, keycodec.decode(encode(10.0)))
+        self.assertIsInstance(keycodec.decode(encode(2.5)), float)
+        self.assertRaises(ValueError, encode, float("nan"))
+        self.assertEqual(encode("a"), encode(u"a"))
+        self.assertEqual(encode(("\xc3\xa9", 1)), encode((u"\xe9", 1)))
+        self.assertEqual(u"a", keycodec.decode(encode("a")))
+        self.assertRaises(ValueError, encode, "\xff")
+        # The same holds for trees with encoded keys.
+        tree = BTree.create("tree", 2, encode_keys=True)
+        tree.update([(10, "a"), (9.5, "b"), ("x", "c"), (-0.0, "d")])
+        tree.insert(u"x", "e")
+        tree.insert(0, "f")
+        self.assertEqual([(0, "f"), (9.5, "b"), (10, "a"), (u"x", "e")],
+                         tree[:])
+
+    def test_encoded_keys(self):
+        """
+        Tests trees that store their keys in the binary encoding.
+        """
+        tree = MultiBTree2.create("tree", 3, encode_keys=True)
+        items = [((x % 4, Descending(x // 3), str(x)), x, str(x))
+                 for x in range(60)]
+        tree.update(reversed(items))
+        items.sort()
+        self.assertEqual(items, tree[:])
+        self.assertTrue(all(isinstance(key, str)
+                            for key in tree.perform_in_batch(
+                                    lambda: tree._get_root().keys)))
+        key = items[10][0]
+        self.assertEqual(items[10], tree.get_all(key)[0])
+        self.assertEqual(10, tree.index(key))
+        self.assertEqual(15, tree.lower_bound((1,)))
+        self.assertEqual([0, 15, 60], tree.ranks([(0,), (1,), (4,)]))
+        self.assertEqual(items[5], tree.get_by_identifier(items[5][2]))
+        self.assertEqual(items[20], tree.pop(20))
+        self.assertTrue(tree.upsert_if("1", (5, Descending(0), "x"), 0,
+                                       lambda new, old: new[0] > old[0]))
+        self.assertEqual(((5, Descending(0), "x"), 0, "1"), tree[-1])
+        self.assertRaises(ValueError, tree.insert, [1], 0, "y")
+
+        tree = BTree.create("tree-btree", 3, encode_keys=True)
+        tree.update((Descending(x), str(x)) for x in range(20))
+        self.assertEqual((Descending(19), "19"), tree[0])
+        self.assertEqual((Descending(5), "5"), tree.get(Descending(5)))
+        self.assertTrue(Descending(7) in tree)
+        tree.remove(Descending(7))
+        self.assertFalse(Descending(7) in tree)
+
+    def test_descending_pickle(self):
+        """
+        Tests that Descending keys survive pickling, also with falsy
+        keys.
+        """
+        for key in [None, 0, "", (), "a", (1, Descending(None))]:
+            for protocol in range(3):
+                copy = pickle.loads(pickle.dumps(Descending(key), protocol))
+                self.assertEqual(Descending(key), copy)
+        storage = MemoryStorage()
+        tree = BTree.create("tree", 2, storage=storage)
+        tree.update((Descending(x), str(x)) for x in [None, 0, 1])
+        self.assertEqual([(Descending(1), "1"), (Descending(0), "0"),
+                          (Descending(None), "None")], tree[:])
+        self.assertEqual((Descending(0), "0"), tree.get(Descending(0)))
+
+    def test_descending(self):
+        """
+        Tests descending trees and reading items in reverse order.
+        """
+        for encode_keys in [False, True]:
+            name = "tree-%s" % encode_keys
+            tree = MultiBTree2.create(name, 2, descending=True,
+                                      encode_keys=encode_keys)
+            tree.update((x // 2, str(x), str(x)) for x in range(50))
+            items = sorted(tree[:], key=lambda item: -item[0])
+            self.assertEqual(items, tree[:])
+            self.assertEqual((24, "48", "48"), tree[0])
+            self.assertEqual(0, tree.index(24))
+            self.assertEqual(48, tree.lower_bound(0))
+            self.assertEqual(50, tree.upper_bound(0))
+            self.assertEqual(2, tree.count(10))
+            self.assertTrue(tree.upsert_if("0", 100, "top"))
+            self.assertFalse(tree.upsert_if("1", -1, "bottom"))
+            self.assertEqual((100, "top", "0"), tree[0])
+            items = tree[:]
+            self.assertEqual(list(reversed(items)), tree.reversed())
+            self.assertEqual(list(reversed(items))[:5], tree.reversed(-5))
+
+        tree = MultiBTree.create("tree", 2)
+        tree.update((x, str(x)) for x in range(100))
+        items = tree[:]
+        for start, stop in [(0, 100), (10, 37), (None, 5), (-5, None),
+                            (40, 41), (30, 20), (0, 0)]:
+            self.assertEqual(list(reversed(items[start:stop])),
+                             tree.reversed(start, stop))
+        self.assertEqual(items[::-1], tree[::-1])
+        self.assertEqual(items[60:20:-1], tree[60:20:-1])
+        self.assertEqual(items[-3::-1], tree[-3::-1])
+        self.assertRaises(ValueError, tree.__getitem__, slice(None, None, 2))
+
+    def test_iter_items(self):
+        """
+        Tests iterating over key ranges in pages, and continuing an
+        iteration with a cursor after the tree changed.
+        """
+        tree = MultiBTree2.create("tree", 2)
+        tree.update((x // 3, str(x), str(x)) for x in range(90))
+        items = tree[:]
+        self.assertEqual(items, list(tree.iter_items(page_size=7)))
+        self.assertEqual(items[30:60],
+                         list(tree.iter_items(10, 20, page_size=30)))
+        self.assertEqual([], list(tree.iter_items(20, 10)))
+        iterator = tree.iter_items(5, page_size=4)
+        self.assertIsNone(iterator.cursor)
+        self.assertEqual(items[15:25], [next(iterator) for _ in range(10)])
+        cursor = iterator.cursor
+        # Remove the last yielded item and insert items around it.
+        tree.remove_by_identifier("24")
+        tree.insert(8, "new", "new")
+        tree.insert(7, "before", "before")
+        expected = [item for item in tree[:] if item[0] >= 8]
+        self.assertEqual(expected, list(tree.iter_items(5, cursor=cursor)))
+        # Continue after an item that still exists.
+        iterator = tree.iter_items(page_size=1)
+        self.assertEqual(tree[:3], [next(iterator) for _ in range(3)])
+        tree.insert(-1, "first", "first")
+        self.assertEqual(tree[4:], list(tree.iter_items(
+                    page_size=1, cursor=iterator.cursor)))
+        self.assertRaises(ValueError, tree.iter_items, page_size=0)
+        self.assertRaises(ValueError, tree.iter_items, cursor="invalid")
+        # Tampered cursors are rejected without being unpickled.
+        path = os.path.join(tempfile.mkdtemp(), "exploit")
+        class Exploit(object):
+            def __reduce__(self):
+                return (os.mkdir, (path,))
+        tampered = [base64.urlsafe_b64encode(pickle.dumps(Exploit(), 2)),
+                    base64.urlsafe_b64encode(keycodec.encode((1, "a"))),
+                    base64.urlsafe_b64encode(keycodec.encode((1, 2, -1))),
+                    cursor[:-4]]
+        for cursor in tampered:
+            self.assertRaises(ValueError, tree.iter_items, cursor=cursor)
+        self.assertFalse(os.path.exists(path))
+
+        # Keys that keycodec does not support get signed cursors.
+        tree = BTree.create("tree-dates", 2)
+        days = [datetime.date(2020, 1, 1) + datetime.timedelta(x)
+                for x in range(20)]
+        tree.update((day, day.day) for day in days)
+        iterator = tree.iter_items(page_size=3)
+        self.assertEqual(tree[:5], [next(iterator) for _ in range(5)])
+        cursor = iterator.cursor
+        self.assertEqual(tree[5:], list(tree.iter_items(cursor=cursor)))
+        data = base64.urlsafe_b64decode(cursor)
+        tampered = [base64.urlsafe_b64encode(data[:-1] + "x"),
+                    base64.urlsafe_b64encode(data[:1] + "x" + data[2:]),
+                    base64.urlsafe_b64encode(
+                        data[:33] + pickle.dumps(Exploit(), 2))]
+        for cursor in tampered:
+            self.assertRaises(ValueError, tree.iter_items, cursor=cursor)
+        self.assertFalse(os.path.exists(path))
+        tree.creation_id = None
+        self.assertRaises(ValueError, getattr, iterator, "cursor")
+        shutil.rmtree(os.path.dirname(path))
+
+        tree = BTree.create("tree-btree", 3, descending=True)
+        tree.update((x, str(x)) for x in range(30))
+        iterator = tree.iter_items(page_size=4)
+        self.assertEqual((29, "29"), next(iterator))
+        self.assertEqual(tree[1:10], list(tree.iter_items(28, 19,
+                                                          page_size=4)))
+
+    def test_count_range(self):
+        """
+        Tests counting the items in key ranges, with and without
+        inclusive or unbounded ends.
+        """
+        tree = MultiBTree.create("tree", 2)
+        keys = [x // 4 for x in range(100)]
+        tree.update((key, None) for key in keys)
+        def expected(lo, hi, include_lo, include_hi):
+            return len([key for key in keys
+                        if (lo is None or key > lo or
+                            (include_lo and key == lo)) and
+                        (hi is None or key < hi or
+                         (include_hi and key == hi))])
+        for lo, hi in [(None, None), (3, 10), (3, 3), (10, 3), (None, 7),
+                       (20, None), (-5, 2), (24, 30), (30, 40)]:
+            for include_lo in [False, True]:
+                for include_hi in [False, True]:
+                    self.assertEqual(expected(lo, hi, include_lo, include_hi),
+                                     tree.count_range(lo, hi, include_lo,
+                                                      include_hi))
+        self.assertEqual(4, tree.count(24))
+        self.assertEqual(0, tree.count(25))
+
+    def test_capacity(self):
+        """
+        Tests capped trees, which evict items beyond their capacity and
+        reject items that would be evicted directly.
+        """
+        tree = MultiBTree2.create("tree", 2, capacity=10)
+        keys = [(x * 37) % 101 for x in range(60)]
+        tree.update((key, None, str(key)) for key in keys[:30])
+        for key in keys[30:]:
+            tree.insert(key, None, str(key))
+        top = sorted(keys)[-10:]
+        self.assertEqual(top, [item[0] for item in tree[:]])
+        self.validate_indices(tree)
+        self.assertEqual(10, len(internal._BTreeIndex.query(
+                    ancestor=tree.key).fetch(keys_only=True)))
+        # Rejected items do not write anything.
+        put_node = tree._put_node
+        def spy(*args):
+            self.fail("Node written for a rejected item")
+        tree._put_node = spy
+        self.assertFalse(tree.insert(top[0], None, "low"))
+        self.assertFalse(tree.insert(-1, None, "lower"))
+        self.assertEqual([False], tree.upsert_all_if([(0, None, "zero")]))
+        tree._put_node = put_node
+        self.assertIsNone(tree.get_by_identifier("low"))
+        # Moving an existing item below the boundary keeps it.
+        self.assertTrue(tree.insert(-1, None, str(top[-1])))
+        self.assertEqual(-1, tree[0][0])
+        self.assertTrue(tree.insert(1000, None, "high"))
+        self.assertEqual(top[:-1] + [1000], [item[0] for item in tree[:]])
+        self.validate_indices(tree)
+
+        for descending in [False, True]:
+            name = "tree-%s" % descending
+            tree = BTree.create(name, 2, capacity=5, keep_lowest=True,
+                                descending=descending)
+            tree.update((x, str(x)) for x in range(20, 0, -1))
+            self.assertEqual(range(1, 6),
+                             sorted(item[0] for item in tree[:]))
+            self.assertTrue(tree.insert(5, "replaced"))
+            self.assertFalse(tree.insert(6, "6"))
+            self.assertEqual((5, "replaced"), tree.get(5))
+            self.assertTrue(tree.insert(0, "0"))
+            self.assertEqual(range(0, 5),
+                             sorted(item[0] for item in tree[:]))
+        self.assertRaises(ValueError, BTree.create, "tree-bad", 2,
+                          capacity=0)
+
+        # Moving the last item within its leaf changes the boundary.
+        tree = MultiBTree2.create("tree-move", 2, capacity=10,
+                                  keep_lowest=True)
+        tree.update((x, None, "id%s" % x) for x in range(0, 100, 10))
+        self.assertIsNotNone(tree.perform_in_batch(
+                lambda: tree._move_within_leaf(90, 85, None, "id90"))[1])
+        self.assertEqual(85, tree[-1][0])
+        self.assertFalse(tree.insert(87, None, "between"))
+        self.assertIsNone(tree.get_by_identifier("between"))
+        # And so does moving another item past the last one.
+        self.assertIsNotNone(tree.perform_in_batch(
+                lambda: tree._move_within_leaf(80, 95, None, "id80"))[1])
+        self.assertEqual(95, tree[-1][0])
+        self.assertTrue(tree.insert(87, None, "between"))
+        self.assertEqual(87, tree[-1][0])
+        self.validate_indices(tree)
+
+    def test_expiry(self):
+        """
+        Tests trees with expiring items, which are filtered from reads
+        and removed by sweep_expired().
+        """
+        past = time.time() - 60
+        future = time.time() + 3600
+        tree = MultiBTree2.create("tree", 2, ttl=True)
+        tree.update((x, str(x), "id%s" % x, past if x % 7 == 0 else None)
+                    for x in range(100))
+        tree.insert(100, "100", "id100", expires=future)
+        live = [x for x in range(101) if x % 7 != 0]
+        self.assertEqual(live, [item[0] for item in tree[:]])
+        self.assertEqual(live, [item[0] for item in tree.iter_items(
+                    page_size=6)])
+        self.assertEqual(live[::-1], [item[0] for item in tree.reversed()])
+        self.assertIsNone(tree.get_by_identifier("id14"))
+        self.assertEqual((15, "15", "id15"), tree.get_by_identifier("id15"))
+        self.assertEqual([], tree.get_all(14))
+        self.assertFalse(14 in tree)
+        self.assertIsNone(tree[0])
+        # Expired items still count until they are swept.
+        self.assertEqual(101, tree.tree_size())
+        self.assertEqual(14, tree.lower_bound(14))
+
+        def check_link_expires(node):
+            for link, expires in zip(node.links, node.link_expires):
+                child = tree._get_node(link)
+                self.assertEqual(child.tree_expires(), expires)
+                check_link_expires(child)
+        tree.perform_in_batch(lambda: check_link_expires(tree._get_root()))
+
+        self.assertEqual(5, tree.sweep_expired(5))
+        self.assertEqual(96, tree.tree_size())
+        self.assertEqual(10, tree.sweep_expired())
+        self.assertEqual(0, tree.sweep_expired())
+        self.assertEqual(live, [item[0] for item in tree[:]])
+        self.assertIsNone(tree.get_by_identifier("id14"))
+        self.validate_indices(tree)
+        tree.perform_in_batch(lambda: check_link_expires(tree._get_root()))
+
+        # Replacing an item also replaces its expiry time.
+        tree.insert(15, "15", "id15", expires=past)
+        self.assertIsNone(tree.get_by_identifier("id15"))
+        tree.insert(15, "15", "id15")
+        self.assertEqual((15, "15", "id15"), tree.get_by_identifier("id15"))
+        self.assertEqual(0, tree.sweep_expired())
+
+        tree = BTree.create("ttl-map", 2, ttl=True)
+        tree.update([(1, "a"), (2, "b", past), (3, "c", future)])
+        self.assertIsNone(tree.get(2))
+        self.assertEqual((3, "c"), tree.get(3))
+        self.assertEqual(1, tree.sweep_expired())
+        self.assertEqual([(1, "a"), (3, "c")], tree[:])
+        plain = BTree.create("plain", 2)
+        self.assertRaises(ValueError, plain.insert, 1, "a", future)
+        self.assertRaises(ValueError, plain.sweep_expired)
+
+    def test_memory_storage(self):
+        """
+        Tests trees that are stored in process memory instead of the
+        datastore.
+        """
+        storage = MemoryStorage()
+        tree = MultiBTree2.get_or_create("tree", 2, storage=storage)
+        tree.update((x % 17, str(x), "id%s" % x) for x in range(100))
+        tree.remove_by_identifier("id3")
+        self.assertEqual(99, tree.tree_size())
+        self.assertTrue(issorted(walk_keys(tree)))
+        self.assertEqual((4, "4", "id4"), tree.get_by_identifier("id4"))
+        self.assertIsNone(tree.get_by_identifier("id3"))
+        self.assertEqual(0, len(ndb.Query(ancestor=tree.key).fetch()))
+        # The same tree is found again, with its options.
+        same = MultiBTree2.get_or_create("tree", 5, storage=storage)
+        self.assertEqual(2, same.degree)
+        self.assertEqual(walk_items(tree), walk_items(same))
+
+        # A failed batch does not change the stored tree.
+        def fail():
+            tree.insert(1000, "x", "new")
+            raise ValueError()
+        size = len(storage)
+        self.assertRaises(ValueError, tree.perform_in_batch, fail)
+        self.assertEqual(size, len(storage))
+        self.assertIsNone(tree.get_by_identifier("new"))
+
+        other = BTree.create("tree", 3, storage=MemoryStorage())
+        other.update((x, x) for x in range(50))
+        self.assertEqual(range(50), walk_keys(other))
+
+    def test_sqlite_storage(self):
+        """
+        Tests trees that are stored in a SQLite database file.
+        """
+        from sqlite_storage import SqliteStorage
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "trees.db")
+            storage = SqliteStorage(path)
+            tree = MultiBTree2.get_or_create("tree", 2, storage=storage)
+            with storage.bulk_load():
+                tree.update((x % 13, x, "id%s" % x) for x in range(200))
+            tree.remove_by_identifier("id7")
+            items = walk_items(tree)
+            self.assertEqual(199, len(items))
+            self.assertTrue(issorted(walk_keys(tree)))
+            self.assertEqual(0, len(ndb.Query(ancestor=tree.key).fetch()))
+            storage.close()
+
+            # The tree is found again in a new connection.
+            storage = SqliteStorage(path)
+            tree = MultiBTree2.get_or_create("tree", 3, storage=storage)
+            self.assertEqual(2, tree.degree)
+            self.assertEqual(items, walk_items(tree))
+            self.assertEqual((8, 8, "id8"), tree.get_by_identifier("id8"))
+            self.assertIsNone(tree.get_by_identifier("id7"))
+
+            def fail():
+                tree.insert(1000, "x", "new")
+                raise ValueError()
+            self.assertRaises(ValueError, tree.perform_in_batch, fail)
+            self.assertIsNone(tree.get_by_identifier("new"))
+            self.assertEqual(items, walk_items(tree))
+            storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot(self):
+        """
+        Tests writing trees to snapshot files and reading them back.
+        """
+        from snapshot import Snapshot, write_snapshot
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "tree.snapshot")
+            tree = MultiBTree2.create("tree", 2)
+            tree.update((x % 17, {"x": x}, "id%s" % x) for x in range(150))
+            write_snapshot(tree, path, page_size=7)
+            with Snapshot(path) as snapshot:
+                self.assertEqual(150, len(snapshot))
+                self.assertEqual(tree[:], snapshot[:])
+                self.assertEqual(tree[20:40], snapshot.get_range(20, 40))
+                self.assertEqual(tree[-1], snapshot.get_by_index(-1))
+                for key in [-1, 0, 5, 16, 17]:
+                    self.assertEqual(tree.lower_bound(key),
+                                     snapshot.lower_bound(key))
+                    self.assertEqual(tree.upper_bound(key),
+                                     snapshot.upper_bound(key))
+                self.assertEqual(tree.index(9), snapshot.index(9))
+                self.assertRaises(ValueError, snapshot.index, 17)
+                self.assertRaises(IndexError, snapshot.get_by_index, 150)
+                self.assertEqual(tree.get_by_identifier("id42"),
+                                 snapshot.get_by_identifier("id42"))
+                self.assertEqual(tree.index_of_identifier("id99"),
+                                 snapshot.index_of_identifier("id99"))
+                self.assertIsNone(snapshot.get_by_identifier("missing"))
+
+            tree = BTree.create("desc", 3, descending=True, encode_keys=True)
+            tree.update(((x, str(x)), x) for x in range(50))
+            write_snapshot(tree, path)
+            with Snapshot(path) as snapshot:
+                self.assertEqual(tree[:], snapshot[:])
+                self.assertEqual(tree.lower_bound((20, "20")),
+                                 snapshot.lower_bound((20, "20")))
+                self.assertEqual(-1, snapshot.index_of_identifier("x"))
+
+            write_snapshot(BTree.create("empty", 2), path)
+            with Snapshot(path) as snapshot:
+                self.assertEqual([], snapshot[:])
+                self.assertEqual(0, snapshot.lower_bound(1))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_replica(self):
+        """
+        Tests replicas, which serve reads from memory and only fetch
+        the nodes that changed since the last generation check.
+        """
+        tree = MultiBTree2.create("tree", 2, versioned=True)
+        tree.update((x, x, "id%s" % x) for x in range(100))
+        replica = TreeReplica(tree, refresh_ms=60000, max_nodes=1000)
+        self.assertEqual(tree[:], replica[:])
+        self.assertEqual(tree.lower_bound(50), replica.lower_bound(50))
+        self.assertEqual(tree.upper_bound(50), replica.upper_bound(50))
+        self.assertEqual(tree.index(7), replica.index(7))
+        self.assertRaises(ValueError, replica.index, 1000)
+        self.assertEqual(tree[-1], replica.get_by_index(-1))
+        generation = replica.generation
+
+        # Changes are only seen after the refresh interval.
+        tree.insert(1000, "x", "new")
+        tree.remove_by_identifier("id3")
+        self.assertEqual(100, len(replica))
+        fetched = []
+        storage = tree._storage
+        class Spy(object):
+            def get_multi(self, keys):
+                fetched.extend(keys)
+                return storage.get_multi(keys)
+        expected = tree[:]
+        num_nodes = len(internal._BTreeNode.query(ancestor=tree.key).fetch())
+        tree._storage = Spy()
+        replica.refresh()
+        self.assertEqual(generation + 2, replica.generation)
+        self.assertEqual(expected, replica[:])
+        # Only the changed nodes are fetched again.
+        self.assertLess(len(fetched), num_nodes / 2)
+        del fetched[:]
+        self.assertEqual(expected, replica[:])
+        self.assertEqual(0, len(fetched))
+        tree._storage = storage
+
+        # Moving an item within its leaf also reaches the replica.
+        tree.insert(51, "moved", "id50")
+        replica.refresh()
+        self.assertEqual(tree[:], replica[:])
+
+        small = TreeReplica(tree, refresh_ms=0, max_nodes=3)
+        self.assertEqual(tree[:], small[:])
+        self.assertTrue(len(small._leaves) + len(small._internal) <= 3)
+        self.assertRaises(ValueError, TreeReplica,
+                          BTree.create("plain", 2))
+
+    def test_replica_generations(self):
+        """
+        Tests that a replica does not mix an old root with newer nodes
+        that it fetches again after they were evicted.
+        """
+        tree = MultiBTree2.create("tree", 2, versioned=True)
+        tree.update((x, x, "id%s" % x) for x in range(100))
+        replica = TreeReplica(tree, refresh_ms=60000, max_nodes=3)
+        old = tree[:]
+        self.assertEqual(old, replica[:])
+        # The first leaf was evicted by reading the rest of the tree.
+        self.assertEqual(old[:2], replica[:2])
+        self.assertEqual(old[-2:], replica[-2:])
+        tree.remove_by_identifier("id0")
+        tree.insert(0.5, "x", "new")
+        new = tree[:]
+        # The replica reads the new generation rather than the new
+        # first leaf below the old root.
+        self.assertEqual(new[:3], replica[:3])
+        self.assertEqual(new, replica[:])
+        self.assertEqual(TreeReplica(tree).generation, replica.generation)
+
+        # Nodes that were deleted since the root was read.
+        tree.update((x, x, "more%s" % x) for x in range(100, 140))
+        replica.refresh()
+        self.assertEqual(tree[:], replica[:])
+        def remove():
+            for x in range(1, 100):
+                tree.remove_by_identifier("id%s" % x)
+        tree.perform_in_batch(remove)
+        self.assertEqual(tree[:], replica[:])
+
+        # A node that never matches its link only restarts a read a
+        # limited number of times, after which the tree is read.
+        root = tree.perform_in_batch(tree._get_root)
+        leaf = tree.perform_in_batch(lambda: tree._get_node(root.links[0]))
+        leaf.version += 1
+        leaf.put()
+        replica = TreeReplica(tree, refresh_ms=60000, max_nodes=0)
+        fetched = []
+        storage = tree._storage
+        class Spy(object):
+            def get_multi(self, keys):
+                fetched.extend(keys)
+                return storage.get_multi(keys)
+            def __getattr__(self, name):
+                return getattr(storage, name)
+        expected = tree[:]
+        tree._storage = Spy()
+        items = replica[:]
+        tree._storage = storage
+        self.assertEqual(expected, items)
+        # The first read and five restarts fetch the leaf.
+        self.assertEqual(6, fetched.count(leaf.key))
+        self.assertEqual(tree[0], replica[0])
+        self.assertEqual(tree.lower_bound(120), replica.lower_bound(120))
+        self.assertEqual(tree.index(120), replica.index(120))
+
+    def test_replica_root_pointer(self):
+        """
+        Tests that a replica of a tree with a root pointer reads the
+        pointer and the root in a single transaction.
+        """
+        tree = MultiBTree2.create("tree", 2, versioned=True,
+                                  root_pointer=True)
+        tree.update((x, x, "id%s" % x) for x in range(10))
+        storage = tree._storage
+        reads = []
+        class Spy(object):
+            def get(self, key):
+                reads.append((key.kind(), storage.in_transaction()))
+                return storage.get(key)
+            def get_multi(self, keys):
+                reads.extend((key.kind(), storage.in_transaction())
+                             for key in keys)
+                return storage.get_multi(keys)
+            def __getattr__(self, name):
+                return getattr(storage, name)
+        tree._storage = Spy()
+        replica = TreeReplica(tree, refresh_ms=0)
+        self.assertEqual(10, len(replica))
+        tree._storage = storage
+        self.assertEqual([("_BTreeRoot", True), ("_BTreeNode", True)],
+                         reads[:2])
+        tree.update((x, x, "id%s" % x) for x in range(10, 100))
+        self.assertEqual(tree[:], replica[:])
+
+    def test_node_cache(self):
+        """
+        Tests caching the root and internal nodes between batches.
+        """
+        tree = MultiBTree2.create("tree", 2, versioned=True)
+        tree.update((x, x, "id%s" % x) for x in range(200))
+        storage = tree._storage
+        fetched = []
+        class Spy(object):
+            def get(self, key):
+                fetched.append(key)
+                return storage.get(key)
+            def get_multi(self, keys):
+                fetched.extend(keys)
+                return storage.get_multi(keys)
+            def __getattr__(self, name):
+                return getattr(storage, name)
+        tree._storage = Spy()
+        expected = tree[0:10]
+        index = tree.index(150)
+        uncached = len(fetched)
+        del fetched[:]
+        with tree.node_cache():
+            self.assertEqual(index, tree.index(150))
+            self.assertEqual(expected, tree[0:10])
+            first = len(fetched)
+            del fetched[:]
+            self.assertEqual(index, tree.index(150))
+            self.assertEqual(expected, tree[0:10])
+            # Only the root and the leaves are read again.
+            self.assertLessEqual(first, uncached)
+            self.assertLess(len(fetched), first)
+            self.assertEqual(2, fetched.count(tree._make_node_key("root")))
+
+            # Changes within the cache and elsewhere are seen.
+            tree.insert(-1, "x", "new")
+            self.assertEqual((-1, "x", "new"), tree[0])
+            other = MultiBTree2.get_by_id("tree")
+            other.remove_by_identifier("new")
+            other.insert(1000, "y", "last")
+            self.assertEqual(expected, tree[0:10])
+            self.assertEqual((1000, "y", "last"), tree[-1])
+            def fail():
+                tree.remove_all(0)
+                raise ValueError()
+            self.assertRaises(ValueError, tree.perform_in_batch, fail)
+            self.assertEqual(other[:], tree[:])
+        self.assertIsNone(tree._node_cache)
+        tree._storage = storage
+        plain = BTree.create("plain", 2)
+        with self.assertRaises(ValueError):
+            with plain.node_cache():
+                pass
+
+    def test_tree_cache(self):
+        """
+        Tests the process-wide cache of tree entities.
+        """
+        tree = MultiBTree2.get_or_create("tree", 3, aggregate="sum")
+        tree.insert(1, 1, "a")
+        fetched = []
+        original = ndb.get_multi
+        def get_multi(keys, **kwargs):
+            fetched.extend(keys)
+            return original(keys, **kwargs)
+        ndb.get_multi = get_multi
+        try:
+            cached = MultiBTree2.get_or_create("tree", 2)
+            self.assertIsNot(tree, cached)
+            self.assertEqual(tree, cached)
+            self.assertEqual(3, cached.degree)
+            self.assertEqual([(1, 1, "a")], cached[:])
+            self.assertEqual(ndb.transaction(
+                lambda: MultiBTree2.get_or_create("tree", 2)), tree)
+            other = MultiBTree2.create("other", 2)
+            del fetched[:]
+            trees = MultiBTree2.get_many_trees(["tree", "missing", "other"])
+            self.assertEqual([tree, None, other], trees)
+            # Only the trees that are not cached are fetched.
+            self.assertEqual([ndb.Key(MultiBTree2, "missing"), other.key],
+                             [key for key in fetched
+                              if key.kind() == "MultiBTree2"])
+        finally:
+            ndb.get_multi = original
+        # Created trees replace the cached ones.
+        MultiBTree2.create("tree", 4)
+        self.assertEqual(4, MultiBTree2.get_or_create("tree", 2).degree)
+        # A tree created in a failed transaction is not cached.
+        def txn():
+            MultiBTree2.get_or_create("failed", 2)
+            raise ValueError()
+        self.assertRaises(ValueError, ndb.transaction, txn)
+        self.assertEqual([None], MultiBTree2.get_many_trees(["failed"]))
+        # Trees in other storage engines are not cached.
+        storage = MemoryStorage()
+        memory = MultiBTree2.get_or_create("memory", 2, storage=storage)
+        self.assertIs(storage, memory._storage)
+        self.assertEqual([None], MultiBTree2.get_many_trees(["memory"]))
+
+    def test_recreated_tree(self):
+        """
+        Tests that instances of a tree that was dropped and created
+        again, such as those cached by other processes, notice this in
+        their next batch.
+        """
+        for root_pointer in [False, True]:
+            name = "tree-%s" % root_pointer
+            stale = MultiBTree2.create(name, 2, root_pointer=root_pointer)
+            stale.update((x, x, str(x)) for x in range(20))
+            other = stale.key.get()
+            MultiBTree2.drop(name)
+            self.assertRaises(ValueError, stale.tree_size)
+            MultiBTree2.create(name, 3, root_pointer=not root_pointer,
+                               capacity=5)
+            self.assertEqual(0, other.tree_size())
+            self.assertEqual(3, other.degree)
+            other.update((x, x, str(x)) for x in range(10))
+            self.assertEqual(range(5, 10), [item[0] for item in stale[:]])
+            self.assertEqual(5, stale.capacity)
+            self.assertEqual(not root_pointer, stale.root_pointer)
+        # Trees created before creation ids were stored.
+        tree = MultiBTree2.create("old", 2)
+        tree.creation_id = None
+        tree.put()
+        root = tree.perform_in_batch(tree._get_root)
+        root.creation_id = None
+        root.put()
+        tree.update((x, x, str(x)) for x in range(20))
+        self.assertEqual(20, tree.key.get().tree_size())
+
+    def test_perform_on_trees(self):
+        """
+        Tests performing batches on several trees.
+        """
+        trees = [MultiBTree2.create("tree%s" % i, 2) for i in range(5)]
+        def insert(tree, i):
+            def f():
+                tree.insert(i, i, "id%s" % i)
+                return tree.tree_size()
+            return f
+        results = perform_on_trees((tree, insert(tree, i))
+                                   for i, tree in enumerate(trees))
+        self.assertEqual([1] * 5, results)
+        for i, tree in enumerate(trees):
+            self.assertEqual([(i, i, "id%s" % i)], tree[:])
+        def fail():
+            trees[1].insert(10, 10, "new")
+            raise IndexError()
+        # If a batch fails, all batches are rolled back.
+        batches = [(trees[3], insert(trees[3], 10)), (trees[1], fail),
+                   (trees[4], insert(trees[4], 10))]
+        with self.assertRaises(BatchError) as cm:
+            perform_on_trees(batches)
+        self.assertEqual([None] * 3, cm.exception.results)
+        self.assertIsNone(cm.exception.errors[0])
+        self.assertIsInstance(cm.exception.errors[1], IndexError)
+        self.assertEqual([1, 1], [tree.tree_size() for tree in trees[3:]])
+        self.assertEqual([2, 2], perform_on_trees(
+            [(trees[3], insert(trees[3], 10)),
+             (trees[4], insert(trees[4], 10))]))
+        self.assertEqual([], perform_on_trees([]))
+        # Trees in other storage engines.
+        storage = MemoryStorage()
+        memory = MultiBTree2.create("memory", 2, storage=storage)
+        self.assertEqual([1], perform_on_trees([(memory, insert(memory, 1))]))
+        with self.assertRaises(ValueError):
+            perform_on_trees([(memory, memory.tree_size),
+                              (trees[0], trees[0].tree_size)])
+        # Each tree can occur only once, also as another instance.
+        with self.assertRaises(ValueError):
+            perform_on_trees([(trees[0], insert(trees[0], 20)),
+                              (trees[0].key.get(), trees[0].tree_size)])
+        self.assertEqual(1, trees[0].tree_size())
+
+    def test_inline(self):
+        """
+        Tests trees that keep their identifiers inline while small.
+        """
+        def count_indices(tree):
+            q = internal._BTreeIndex.query(ancestor=tree.key)
+            return len(q.fetch(keys_only=True))
+        tree = MultiBTree2.create("tree", 4, inline_threshold=6)
+        plain = MultiBTree2.create("plain", 4)
+        def check(inline):
+            self.assertEqual(plain[:], tree[:])
+            self.assertEqual(0 if inline else tree.tree_size(),
+                             count_indices(tree))
+            for item in plain[:]:
+                self.assertEqual(item, tree.get_by_identifier(item[2]))
+                self.assertEqual(plain.index_of_identifier(item[2]),
+                                 tree.index_of_identifier(item[2]))
+        for t in (tree, plain):
+            t.update((x, x, "id%s" % x) for x in range(5))
+            t.insert(7, "a", "id1")
+            t.upsert_if("id2", 10, "b")
+        check(True)
+        self.assertIsNone(tree.get_by_identifier("missing"))
+        self.assertEqual(1, count_nodes(tree))
+        # Growing beyond the threshold adds the index.
+        for t in (tree, plain):
+            t.insert(20, "c", "id20")
+            t.insert(21, "d", "id21")
+        check(False)
+        for t in (tree, plain):
+            t.update((x, x, "id%s" % x) for x in range(30, 60))
+            t.remove_by_identifier("id33")
+        check(False)
+        # Shrinking to half the threshold drops it again.
+        for t in (tree, plain):
+            t.perform_in_batch(lambda: [t.remove_by_identifier("id%s" % x)
+                                        for x in range(30, 60)])
+            t.remove_by_identifier("id20")
+        check(False)
+        for t in (tree, plain):
+            t.remove_by_identifier("id21")
+            t.remove_by_identifier("id0")
+        check(False)
+        for t in (tree, plain):
+            t.remove_by_identifier("id1")
+        check(True)
+        # Changes that grow and shrink the tree in a single batch.
+        for t in (tree, plain):
+            def f():
+                t.update((x, x, "id%s" % x) for x in range(100, 140))
+                t.insert(0, "e", "id4")
+                for x in range(100, 140):
+                    t.remove_by_identifier("id%s" % x)
+            t.perform_in_batch(f)
+        check(True)
+        with self.assertRaises(ValueError):
+            MultiBTree2.create("invalid", 2, inline_threshold=0)
+
+    def test_clear_and_drop(self):
+        """
+        Tests clearing and dropping whole trees.
+        """
+        def count_entities(tree):
+            return count_nodes(tree) + len(internal._BTreeIndex.query(
+                ancestor=tree.key).fetch(keys_only=True))
+        tree = MultiBTree2.get_or_create("tree", 2, versioned=True)
+        tree.update((x, x, "id%s" % x) for x in range(100))
+        other = MultiBTree2.create("other", 2)
+        other.insert(1, 1, "id1")
+        generation = tree.perform_in_batch(tree._get_root).version
+        tree.clear()
+        self.assertEqual([], tree[:])
+        self.assertEqual(1, count_entities(tree))
+        self.assertIsNone(tree.get_by_identifier("id5"))
+        self.assertGreater(tree.perform_in_batch(tree._get_root).version,
+                           generation)
+        tree.update((x, x, "id%s" % x) for x in range(10))
+        self.assertEqual(10, tree.tree_size())
+        self.assertEqual((5, 5, "id5"), tree.get_by_identifier("id5"))
+        # Dropping removes all entities, also from the tree cache.
+        MultiBTree2.drop("tree")
+        self.assertEqual(0, count_entities(tree))
+        self.assertIsNone(MultiBTree2.get_by_id("tree"))
+        self.assertEqual([None], MultiBTree2.get_many_trees(["tree"]))
+        self.assertEqual(0, MultiBTree2.get_or_create("tree", 2).tree_size())
+        MultiBTree2.drop("missing")
+        self.assertEqual([(1, 1, "id1")], other[:])
+        # Trees whose parent is another tree are not affected.
+        outer = MultiBTree2.create("outer", 2)
+        inner = MultiBTree2.create("inner", 2, parent=outer.key)
+        for t in (outer, inner):
+            t.update((x, x, "id%s" % x) for x in range(20))
+        outer.clear()
+        self.assertEqual(20, inner.tree_size())
+        MultiBTree2.drop("outer")
+        self.assertEqual(range(20), [item[0] for item in inner[:]])
+        self.assertEqual((5, 5, "id5"), inner.get_by_identifier("id5"))
+        # Trees in other storage engines.
+        storage = MemoryStorage()
+        memory = MultiBTree2.create("tree", 2, storage=storage,
+                                    inline_threshold=4)
+        memory.update((x, x, "id%s" % x) for x in range(20))
+        memory.clear()
+        self.assertEqual(2, len(storage))
+        self.assertEqual([], memory[:])
+        memory.insert(1, 1, "id1")
+        self.assertEqual(2, len(storage))
+        MultiBTree2.drop("tree", storage=storage)
+        self.assertEqual(0, len(storage))
+
+    def test_root_pointer(self):
+        """
+        Tests trees whose root is found through a root pointer.
+        """
+        def root_id(tree):
+            return internal._BTreeRoot.get_by_id(
+                "root", parent=tree.key).node_id
+        def node_ids(tree):
+            return set(key.id() for key in internal._BTreeNode.query(
+                ancestor=tree.key).fetch(keys_only=True))
+        tree = MultiBTree2.create("tree", 2, root_pointer=True)
+        plain = MultiBTree2.create("plain", 2)
+        first = root_id(tree)
+        self.assertEqual(set([first]), node_ids(tree))
+        for t in (tree, plain):
+            t.update((x, x, "id%s" % x) for x in range(3))
+        self.assertEqual(first, root_id(tree))
+        # Growing the tree only adds nodes.
+        for t in (tree, plain):
+            t.insert(3, 3, "id3")
+        self.assertEqual(plain[:], tree[:])
+        self.assertEqual(3, len(node_ids(tree)))
+        self.assertIn(first, node_ids(tree))
+        self.assertNotEqual(first, root_id(tree))
+        for t in (tree, plain):
+            t.update((x, x, "id%s" % x) for x in range(4, 50))
+        self.assertEqual(plain[:], tree[:])
+        self.assertEqual(len(node_ids(plain)), len(node_ids(tree)))
+        self.assertNotIn("root", node_ids(tree))
+        # Shrinking the tree only removes nodes.
+        for x in range(48):
+            before = node_ids(tree)
+            for t in (tree, plain):
+                t.remove_by_identifier("id%s" % x)
+            self.assertLessEqual(node_ids(tree), before)
+            self.assertIn(root_id(tree), node_ids(tree))
+        self.assertEqual(plain[:], tree[:])
+        self.assertEqual(1, len(node_ids(tree)))
+        self.assertEqual((49, 49, "id49"), tree.get_by_identifier("id49"))
+        # A replica and the node cache follow the pointer.
+        tree = MultiBTree2.create("versioned", 2, root_pointer=True,
+                                  versioned=True)
+        replica = TreeReplica(tree, refresh_ms=0)
+        with tree.node_cache():
+            for x in range(30):
+                tree.insert(x, x, "id%s" % x)
+                self.assertEqual(tree[:], replica[:])
+            tree.perform_in_batch(lambda: [tree.remove_by_identifier(
+                "id%s" % x) for x in range(25)])
+            self.assertEqual(tree[:], replica[:])
+            self.assertEqual(5, tree.tree_size())
+        tree.clear()
+        self.assertEqual([], replica[:])
+        MultiBTree2.drop("versioned")
+        self.assertEqual(set(), node_ids(tree))
+        self.assertIsNone(internal._BTreeRoot.get_by_id("root",
+                                                        parent=tree.key))
+
+
 
 def main():
     fast = unittest.TestSuite()
@@ -5,8 +5,37 @@ __author__ = "Tijmen Roberti"
 __license__ = "MIT"
 
 import bisect
+import operator
+import time
+import uuid
 from itertools import izip, izip_longest, chain
 from google.appengine.ext import ndb
+import keycodec
+from storage import NdbStorage
+
+
+# The named predicates that can be used for conditional inserts. Each
+# predicate is called with the new key and the existing key.
+_UPSERT_PREDICATES = {
+    'max': lambda new_key, old_key: new_key > old_key,
+    'min': lambda new_key, old_key: new_key < old_key,
+}
+
+# The named functions that can be used to aggregate the values of a
+# tree. Each function combines two aggregated values into one.
+_AGGREGATE_FUNCTIONS = {
+    'sum': operator.add,
+    'min': min,
+    'max': max,
+}
+
+
+class _ExpiredItem(tuple):
+    """
+    An item of a tree with expiring items, whose expiry time has
+    passed but which is not yet removed from the tree. Reads filter
+    these items out.
+    """
 
 
 class _BTreeNode(ndb.Model):
@@ -38,12 +67,42 @@ class _BTreeNode(ndb.Model):
     links = ndb.PickleProperty('l', indexed=False)
     # The sizes of the subtree for each corresponding link.
     counts = ndb.PickleProperty('c', indexed=False)
+    # The aggregated values of the subtree for each corresponding
+    # link. Only used if the tree has an aggregate function, otherwise
+    # this array is empty.
+    aggregates = ndb.PickleProperty('a', indexed=False)
     # The original identifier of this node when it was created. When a
     # node becomes a root node, it takes as id "root" instead of its
     # assigned id. If another node becomes the root node, it reverts
     # back to its original assigned id, that is stored in this
     # property.
     assigned_id = ndb.IntegerProperty('aid', indexed=False)
+    # Only used by the root node of a capped tree. The stored key of
+    # the item that is evicted next, so items that would be evicted
+    # directly can be rejected without descending the tree.
+    boundary = ndb.PickleProperty('b', indexed=False)
+    # The expiry time of each item, or None if the item does not
+    # expire. Only used if the tree has expiring items, otherwise
+    # this array is empty.
+    expires = ndb.PickleProperty('e', indexed=False)
+    # The earliest expiry time of the items in the subtree of each
+    # link, or None if none of them expires. Only used if the tree
+    # has expiring items, otherwise this array is empty.
+    link_expires = ndb.PickleProperty('le', indexed=False)
+    # Only used in versioned trees. The generation of the root in
+    # which this node was last written. The version of the root is
+    # the generation of the tree.
+    version = ndb.IntegerProperty('ver', indexed=False)
+    # Only used in versioned trees, otherwise this array is empty. The
+    # version of the node of each link.
+    link_versions = ndb.PickleProperty('lv', indexed=False)
+    # Only used by the root of a tree with an inline threshold. Whether
+    # the tree is inline: all its items are in the root, and their
+    # identifiers are not in the identifier index.
+    inline = ndb.BooleanProperty('in', indexed=False)
+    # Only used by the root of a tree without a root pointer. The
+    # creation id of the tree, see _BTreeBase.
+    creation_id = ndb.StringProperty('cid', indexed=False)
 
 
     def is_leaf(self):
@@ -55,10 +114,13 @@ class _BTreeNode(ndb.Model):
     def insert(self, index, item):
         """
         Inserts the (key, value, id) item at the given index in this
-        node.
+        node. In trees with expiring items, the item is a (key, value,
+        id, expires) tuple.
         """
         self.keys.insert(index, item[0])
         self.values.insert(index, item[1])
+        if self._parent_tree.ttl:
+            self.expires.insert(index, item[3])
         if item[2] is not None:
             self.ids.insert(index, item[2])
             self._parent_tree._identifier_added(item[2], item[0], item[1])
@@ -70,6 +132,8 @@ class _BTreeNode(ndb.Model):
         """
         self.keys.append(item[0])
         self.values.append(item[1])
+        if self._parent_tree.ttl:
+            self.expires.append(item[3])
         if item[2] is not None:
             self.ids.append(item[2])
             self._parent_tree._identifier_added(item[2], item[0], item[1])
@@ -79,30 +143,41 @@ class _BTreeNode(ndb.Model):
         Replaces the existing values at the given |index| with the
         values of the new (key, value, id) item.
         """
+        old_item = self.item(index)
         self.keys[index] = item[0]
         self.values[index] = item[1]
+        if self._parent_tree.ttl:
+            self.expires[index] = item[3]
         if item[2] is not None:
-            old_id = self.ids[index]
             self.ids[index] = item[2]
-            self._parent_tree._identifier_removed(old_id)
+            self._parent_tree._identifier_removed(old_item[2], old_item[0],
+                                                 old_item[1])
             self._parent_tree._identifier_added(item[2], item[0], item[1])
 
     def item(self, index):
         """
-        Returns the (key, value, id) tuple at the given |index|.
+        Returns the (key, value, id) tuple at the given |index|, or a
+        (key, value, id, expires) tuple in trees with expiring items.
         """
-        return (self.keys[index], self.values[index],
+        item = (self.keys[index], self.values[index],
                 self.ids[index] if self.ids else None)
+        if self._parent_tree.ttl:
+            item += (self.expires[index],)
+        return item
 
     def pop_item(self, index=-1):
         """
         Pops the (key, value, id) tuple at the given |index|, or the last
-        item if no index is provided.
+        item if no index is provided. In trees with expiring items, the
+        expiry time is popped as fourth element.
         """
         popped = (self.keys.pop(index), self.values.pop(index),
                   self.ids.pop(index) if self.ids else None)
+        if self._parent_tree.ttl:
+            popped += (self.expires.pop(index),)
         if popped[2] is not None:
-            self._parent_tree._identifier_removed(popped[2])
+            self._parent_tree._identifier_removed(popped[2], popped[0],
+                                                 popped[1])
         return popped
 
     def tree_size(self):
@@ -111,6 +186,81 @@ class _BTreeNode(ndb.Model):
         """
         return sum(self.counts) + len(self.keys)
 
+    def tree_aggregate(self):
+        """
+        Returns the aggregate of all values in the tree formed by this
+        node, combined in tree order.
+        """
+        combine = self._parent_tree._combine
+        result = None
+        for i, value in enumerate(self.values):
+            if self.aggregates:
+                result = combine(result, self.aggregates[i])
+            result = combine(result, value)
+        if self.aggregates:
+            result = combine(result, self.aggregates[-1])
+        return result
+
+    def tree_expires(self):
+        """
+        Returns the earliest expiry time of the items in the tree
+        formed by this node, or None if none of them expires.
+        """
+        times = [t for t in chain(self.expires, self.link_expires)
+                 if t is not None]
+        return min(times) if times else None
+
+    def as_link(self):
+        """
+        Returns a (link, count, aggregate, expires, version) tuple that
+        refers to this node, which can be inserted in a parent node
+        with insert_link().
+        """
+        tree = self._parent_tree
+        return (self.key.id(), self.tree_size(),
+                self.tree_aggregate() if tree.aggregate is not None else None,
+                self.tree_expires() if tree.ttl else None,
+                self.version)
+
+    def insert_link(self, index, link):
+        """
+        Inserts the (link, count, aggregate, expires, version) tuple at
+        the given |index| in this node.
+        """
+        self.links.insert(index, link[0])
+        self.counts.insert(index, link[1])
+        if self._parent_tree.aggregate is not None:
+            self.aggregates.insert(index, link[2])
+        if self._parent_tree.ttl:
+            self.link_expires.insert(index, link[3])
+        if self._parent_tree.versioned:
+            self.link_versions.insert(index, link[4])
+
+    def pop_link(self, index=-1):
+        """
+        Pops the (link, count, aggregate, expires, version) tuple at the
+        given |index|, or the last link if no index is provided.
+        """
+        def pop(values):
+            return values.pop(index) if values else None
+        return (self.links.pop(index), self.counts.pop(index),
+                pop(self.aggregates), pop(self.link_expires),
+                pop(self.link_versions))
+
+    def update_link(self, index, child):
+        """
+        Updates the count, aggregate and earliest expiry time of the
+        link at |index| after the |child| node it refers to has
+        changed.
+        """
+        self.counts[index] = child.tree_size()
+        if self._parent_tree.aggregate is not None:
+            self.aggregates[index] = child.tree_aggregate()
+        if self._parent_tree.ttl:
+            self.link_expires[index] = child.tree_expires()
+        if self._parent_tree.versioned:
+            self.link_versions[index] = child.version
+
     def extend_with_contents_of_node(self, node):
         """
         Extend this node's key, values and ids with the contents of
@@ -124,6 +274,10 @@ class _BTreeNode(ndb.Model):
             # only.
         self.links.extend(node.links)
         self.counts.extend(node.counts)
+        self.aggregates.extend(node.aggregates)
+        self.expires.extend(node.expires)
+        self.link_expires.extend(node.link_expires)
+        self.link_versions.extend(node.link_versions)
 
     def iteritems(self, start=None, end=None):
         """
@@ -132,6 +286,8 @@ class _BTreeNode(ndb.Model):
         id) pairs. |start| and |end| can be used to specify a slice as
         normal.
         """
+        if self.expires:
+            return iter(self.items(start, end))
         if self.ids:
             return izip_longest(self.keys[start:end],
                                 self.values[start:end],
@@ -144,14 +300,20 @@ class _BTreeNode(ndb.Model):
         Returns a list of items from this node in the range
         [start:end).  The list contains (key, value) pairs if no ids
         are present, otherwise it contains (key, value, identifier
-        pairs).
+        pairs). Items that have expired are returned as _ExpiredItem.
         """
         if self.ids:
-            return zip(self.keys[start:end],
-                       self.values[start:end],
-                       self.ids[start:end])
+            items = zip(self.keys[start:end],
+                        self.values[start:end],
+                        self.ids[start:end])
         else:
-            return zip(self.keys[start:end], self.values[start:end])
+            items = zip(self.keys[start:end], self.values[start:end])
+        if self.expires:
+            is_expired = self._parent_tree._is_expired
+            items = [_ExpiredItem(item) if is_expired(expires) else item
+                     for item, expires in izip(items,
+                                               self.expires[start:end])]
+        return items
 
 
     def __str__(self):
@@ -168,11 +330,25 @@ class _BTreeIndex(ndb.Model):
     """
     _use_memcache = False
     # The key, value pair associated with this identifier that is
-    # Stored in the tree.
+    # Stored in the tree. The value is not stored if the tree is
+    # created with index_values set to False.
     tree_key = ndb.PickleProperty('k', indexed=False)
     tree_value = ndb.PickleProperty('v', indexed=False)
 
 
+class _BTreeRoot(ndb.Model):
+    """
+    The root pointer of a tree with the root pointer layout. It holds
+    the id of the current root node, so the root can change without
+    moving a node to another key.
+    """
+    _use_memcache = False
+    # The id of the root node.
+    node_id = ndb.IntegerProperty('n', indexed=False)
+    # The creation id of the tree, see _BTreeBase.
+    creation_id = ndb.StringProperty('c', indexed=False)
+
+
 class _BTreeBase(ndb.Model):
     """
     The tree base class. The tree only contains a single member variable,
@@ -184,25 +360,127 @@ class _BTreeBase(ndb.Model):
     tree's key. This prevents potential transaction issues where a
     tree is retrieved outside a transaction and also prevents any
     caching issues.
+
+    Trees created with a root pointer use another layout, in which
+    the root keeps its assigned id, and a small _BTreeRoot entity
+    holds the id of the root. When the tree grows or shrinks, only
+    the pointer changes, instead of a whole node being copied to or
+    from the "root" key. Each batch then reads the pointer first.
+
+    All entities are read and written through the storage engine in
+    the _storage attribute, which stores them in the datastore unless
+    another engine is set when the tree is created or retrieved.
     """
+    # The storage engine of the tree entities. Not a property, so it
+    # is set again each time the tree is retrieved.
+    _storage = NdbStorage()
+    # The root and internal nodes that are kept between batches, by
+    # key, or None if nodes are not cached. See _batch_operations().
+    _node_cache = None
     # Minimum degree of the tree, set once during creation. Never
     # changes.
     degree = ndb.IntegerProperty(indexed=False, required=True)
-
-
-    def _initialize(self, minimum_degree):
+    # Whether the identifier index also stores the value of each
+    # item. If not, the index entities are smaller and only need to
+    # be written when the key of an identifier changes, but the value
+    # must be looked up in the tree. Set once during creation.
+    index_values = ndb.BooleanProperty(indexed=False, default=True)
+    # Whether items with identical keys are ordered by their
+    # identifier instead of by insertion order. This allows finding
+    # an item by key and identifier with a binary search, instead of
+    # scanning all items with the same key. Set once during creation.
+    identifier_order = ndb.BooleanProperty(indexed=False, default=False)
+    # The function used to aggregate the values in each subtree, or
+    # None if no aggregates are maintained. Either the name of one of
+    # the functions in _AGGREGATE_FUNCTIONS, or a picklable function
+    # that combines two values. Set once during creation.
+    aggregate = ndb.PickleProperty(indexed=False)
+    # Whether keys are stored in the order preserving binary encoding
+    # of the keycodec module, instead of as python objects. Set once
+    # during creation.
+    encode_keys = ndb.BooleanProperty(indexed=False, default=False)
+    # Whether the items are ordered from the highest to the lowest
+    # key. Keys are then stored wrapped in keycodec.Descending. Set
+    # once during creation.
+    descending = ndb.BooleanProperty(indexed=False, default=False)
+    # The maximum number of items in the tree, or None if the tree is
+    # not capped. Set once during creation.
+    capacity = ndb.IntegerProperty(indexed=False)
+    # Whether a capped tree keeps the items with the lowest keys
+    # instead of those with the highest keys. Set once during
+    # creation.
+    keep_lowest = ndb.BooleanProperty(indexed=False, default=False)
+    # Whether items can have an expiry time, after which reads filter
+    # them out until they are removed by sweep_expired(). Set once
+    # during creation.
+    ttl = ndb.BooleanProperty(indexed=False, default=False)
+    # Whether nodes carry versions, so a TreeReplica can find the
+    # changed nodes from the root down. Set once during creation.
+    versioned = ndb.BooleanProperty(indexed=False, default=False)
+    # The maximum size of an inline tree, whose identifiers are found
+    # in the root instead of in the identifier index, or None if the
+    # tree always uses the index. Set once during creation.
+    inline_threshold = ndb.IntegerProperty(indexed=False)
+    # Whether the id of the root is stored in a _BTreeRoot entity,
+    # instead of the root always having the id "root". Set once
+    # during creation.
+    root_pointer = ndb.BooleanProperty(indexed=False, default=False)
+    # A random id that is set during creation, and that is also stored
+    # in the root pointer, or else in the root. A tree entity that was
+    # cached before its tree was dropped and created again has another
+    # id than the root, which each batch checks. None for trees that
+    # were created without a creation id.
+    creation_id = ndb.StringProperty(indexed=False)
+
+
+    def _initialize(self, minimum_degree, index_values=True,
+                    identifier_order=False, aggregate=None,
+                    encode_keys=False, descending=False, capacity=None,
+                    keep_lowest=False, ttl=False, versioned=False,
+                    inline_threshold=None, root_pointer=False):
         """
         Initializes this instance. Creates a root node and sets
-        the degree of the tree.
+        the degree and other options of the tree.
         """
         if minimum_degree < 2:
             raise ValueError("Minimum degree of tree must be 2 or greater")
         if not self.key:
             raise ValueError("Cannot initialize a tree without a key")
+        if not (aggregate is None or aggregate in _AGGREGATE_FUNCTIONS
+                or callable(aggregate)):
+            raise ValueError("Unknown aggregate function %r" % (aggregate,))
+        if capacity is not None and capacity < 1:
+            raise ValueError("Capacity must be 1 or greater")
+        if inline_threshold is not None and inline_threshold < 1:
+            raise ValueError("Inline threshold must be 1 or greater")
         root = self._make_node()
-        root.key = self._make_node_key("root")
+        if not root_pointer:
+            root.key = self._make_node_key("root")
         self.degree = minimum_degree
-        ndb.put_multi([root, self])
+        self.index_values = index_values
+        self.identifier_order = identifier_order
+        self.aggregate = aggregate
+        self.encode_keys = encode_keys
+        self.descending = descending
+        self.capacity = capacity
+        self.keep_lowest = keep_lowest
+        self.ttl = ttl
+        self.versioned = versioned
+        self.inline_threshold = inline_threshold
+        self.root_pointer = root_pointer
+        if versioned:
+            root.version = 1
+        if inline_threshold is not None:
+            root.inline = True
+        self.creation_id = uuid.uuid4().hex
+        entities = [root, self]
+        if root_pointer:
+            entities.append(_BTreeRoot(key=self._make_pointer_key(),
+                                       node_id=root.key.id(),
+                                       creation_id=self.creation_id))
+        else:
+            root.creation_id = self.creation_id
+        self._storage.put_multi(entities)
         return self
 
 
@@ -219,38 +497,249 @@ class _BTreeBase(ndb.Model):
 
         All operations must be part of a call to _batch_operations, as
         it sets up caches that are used in most calls.
+
+        If the _node_cache attribute is a dict, the root and internal
+        nodes are also kept in it after the batch. Each following
+        batch still reads the root, which keeps the transaction safe,
+        but it only uses the cached nodes if the generation of the
+        root did not change. Nodes written by a batch are added to the
+        cache after its transaction has completed.
         """
+        # The nodes written and deleted by the batch, and the key of
+        # the root after the batch, for the node cache.
+        written = {}
+        deleted = set()
+        root_key = []
+        nested = self._storage.in_transaction()
+
         def txn():
             first_batch_call = not all([hasattr(self, "_nodes_to_put"),
                                         hasattr(self, "_indices_to_put"),
                                         hasattr(self, "_identifier_cache"),
-                                        hasattr(self, "_keys_to_delete")])
+                                        hasattr(self, "_stored_indices"),
+                                        hasattr(self, "_keys_to_delete"),
+                                        hasattr(self, "_inline_index"),
+                                        hasattr(self, "_root_pointer")])
             if first_batch_call:
                 self._nodes_to_put = dict()
                 self._indices_to_put = dict()
                 self._identifier_cache = dict()
+                self._stored_indices = dict()
                 self._keys_to_delete = set()
+                written.clear()
+                deleted.clear()
+                holder = self._check_creation()
+                self._root_pointer = holder if self.root_pointer else None
+                root_id = self._root_id()
+                if self._node_cache is not None:
+                    self._validate_node_cache(
+                        None if self.root_pointer else holder)
+                self._inline_index = self._read_inline_index()
             try:
                 results = func()
                 if first_batch_call and any([self._nodes_to_put,
                                              self._indices_to_put,
                                              self._keys_to_delete]):
-                    futures = ndb.delete_multi_async(self._keys_to_delete)
-                    ndb.put_multi(chain(self._nodes_to_put.itervalues(),
-                                        self._indices_to_put.itervalues()))
-                    [future.get_result() for future in futures]
+                    self._prepare_flush()
+                    entities = list(chain(self._nodes_to_put.itervalues(),
+                                          self._indices_to_put.itervalues()))
+                    if self._root_id() != root_id:
+                        entities.append(self._root_pointer)
+                    self._storage.write_multi(entities,
+                                              list(self._keys_to_delete))
+                    written.update(self._nodes_to_put)
+                    deleted.update(self._keys_to_delete)
+                    root_key[:] = [self._make_node_key(self._root_id())]
             finally:
                 if first_batch_call:
                     del self._nodes_to_put
                     del self._indices_to_put
                     del self._identifier_cache
+                    del self._stored_indices
                     del self._keys_to_delete
+                    del self._inline_index
+                    del self._root_pointer
             return results
 
-        if ndb.in_transaction():
-            return txn()
-        else:
-            return ndb.transaction(txn)
+        try:
+            results = self._storage.transaction(txn)
+        except:
+            # Cached nodes might have been changed by the failed batch.
+            if self._node_cache is not None:
+                self._node_cache.clear()
+            raise
+        if self._node_cache is not None and (written or deleted):
+            if nested:
+                # The changes are only committed with the enclosing
+                # transaction, which can still fail.
+                self._node_cache.clear()
+            else:
+                self._update_node_cache(written, deleted, root_key[0])
+        return results
+
+
+    def _check_creation(self):
+        """
+        Reloads the options of this tree from its tree entity, if the
+        creation id stored with the root differs from the one of this
+        instance. The tree was then dropped and created again since
+        this instance was read, for example by another process that
+        cached the old tree entity.
+
+        Returns the entity that holds the creation id: the root
+        pointer, or the root if the tree has no root pointer.
+
+        Raises:
+          ValueError: If the tree no longer exists.
+        """
+        def read():
+            if self.root_pointer:
+                return self._storage.get(self._make_pointer_key())
+            return self._storage.get(self._make_node_key("root"))
+
+        holder = read()
+        if holder is not None and holder.creation_id == self.creation_id:
+            return holder
+        tree = self._storage.get(self.key)
+        if tree is None:
+            raise ValueError("Tree %s no longer exists" % (self.key,))
+        # Cached instances are updated in place, so they are all valid
+        # again.
+        self.populate(**tree.to_dict())
+        if self._node_cache is not None:
+            self._node_cache.clear()
+        holder = read()
+        assert holder, "No root found for tree %s" % (self.key,)
+        return holder
+
+
+    def _validate_node_cache(self, root=None):
+        """
+        Reads the root, unless it is given as |root|, and clears the
+        node cache if the generation of the tree changed since the
+        cached nodes were read.
+        """
+        key = self._make_node_key(self._root_id())
+        if root is None:
+            root = self._storage.get(key)
+        assert root, "No node found with key %s" % (key,)
+        cached = self._node_cache.get(key)
+        if cached is None or cached.version != root.version:
+            self._node_cache.clear()
+        self._attach_node(root)
+        self._node_cache[key] = root
+
+
+    def _cache_node(self, node, root_key=None):
+        """
+        Adds |node| to the node cache, if nodes are cached and it is
+        the root or an internal node. |root_key| is the key of the
+        root, by default the key of the root in the current batch.
+        """
+        if self._node_cache is None:
+            return
+        if root_key is None:
+            root_key = self._make_node_key(self._root_id())
+        if node.links or node.key == root_key:
+            self._node_cache[node.key] = node
+
+
+    def _update_node_cache(self, written, deleted, root_key):
+        """
+        Updates the node cache with the nodes in the dict |written|
+        and the keys in the set |deleted| of a completed batch, after
+        which the root has the key |root_key|.
+        """
+        for key in deleted:
+            self._node_cache.pop(key, None)
+        for key, node in written.iteritems():
+            self._node_cache.pop(key, None)
+            self._cache_node(node, root_key)
+
+
+    def _prepare_flush(self):
+        """
+        Updates the state that is derived from the whole tree, such as
+        the boundary of a capped tree. Called once at the end of the
+        outermost batch, just before all changes are written.
+        """
+        if self.inline_threshold is not None:
+            self._flush_inline_index()
+        root_key = self._make_node_key(self._root_id())
+        if self.capacity is not None and root_key in self._nodes_to_put:
+            root = self._nodes_to_put[root_key]
+            root.boundary = self._capacity_boundary(root)
+        if self.versioned:
+            # All written nodes get the next generation as version.
+            # The parent of a written node is always written too, so
+            # the new versions reach the root through the links.
+            root = self._get_root()
+            self._put_node(root)
+            generation = root.version + 1
+            for node in self._nodes_to_put.itervalues():
+                node.version = generation
+            for node in self._nodes_to_put.itervalues():
+                for i, link in enumerate(node.links):
+                    if self._make_node_key(link) in self._nodes_to_put:
+                        node.link_versions[i] = generation
+
+
+    def _read_inline_index(self):
+        """
+        Returns a dict that maps the identifiers of an inline tree to
+        the (key, value) pairs of their items, as read from the root,
+        or None if the tree is not inline.
+        """
+        if self.inline_threshold is None:
+            return None
+        root = self._get_root()
+        if not root.inline:
+            return None
+        return dict((id, (key, value)) for key, value, id
+                    in izip(root.keys, root.values, root.ids))
+
+
+    def _flush_inline_index(self):
+        """
+        Drops the identifier index changes of an inline tree that is
+        still small enough after the batch. A tree that grew beyond its
+        root or the inline threshold is promoted, and gets an index
+        entity for each identifier. A tree with an index is demoted
+        once it shrinks to a single node of at most half the threshold,
+        so a tree around the threshold does not switch every batch.
+        """
+        root = self._get_root()
+        small = root.is_leaf() and root.size() <= self.inline_threshold
+        if self._inline_index is not None:
+            # An inline tree has no index entities to delete.
+            self._keys_to_delete.difference_update(
+                [key for key in self._keys_to_delete
+                 if key.kind() == _BTreeIndex._get_kind()])
+            if small:
+                self._indices_to_put.clear()
+                if not root.inline:
+                    # The root was replaced during the batch.
+                    root.inline = True
+                    self._put_node(root)
+                return
+            root.inline = False
+            self._put_node(root)
+            # The identifier cache holds all identifiers changed in
+            # this batch, and the inline index all others.
+            for identifier in set(self._inline_index).union(
+                    self._identifier_cache):
+                contents = self._identifier_cache.get(
+                    identifier, self._inline_index.get(identifier))
+                if contents is not None:
+                    index = self._make_index(identifier, *contents)
+                    self._indices_to_put[index.key] = index
+        elif small and root.size() <= self.inline_threshold // 2:
+            root.inline = True
+            self._put_node(root)
+            for identifier in root.ids:
+                index_key = self._make_index_key(identifier)
+                self._indices_to_put.pop(index_key, None)
+                self._keys_to_delete.add(index_key)
 
 
     def _put_node(self, *args):
@@ -333,9 +822,16 @@ class _BTreeBase(ndb.Model):
         """
         assert isinstance(identifier, basestring), "Identifiers must be strings"
         key_and_value = self._key_and_value_for_identifier(identifier)
-        if key_and_value is not None:
-            return key_and_value + (identifier,)
-        return None
+        if key_and_value is None:
+            return None
+        item = key_and_value + (identifier,)
+        if self.ttl:
+            # The index does not store the expiry time, so it is read
+            # from the node that holds the item.
+            node, x = self._path_to_item(key_and_value[0], identifier)[-1]
+            if self._is_expired(node.expires[x]):
+                return _ExpiredItem(item)
+        return item
 
 
     def _get_by_index(self, index):
@@ -384,30 +880,377 @@ class _BTreeBase(ndb.Model):
         return in_order(self._get_root(), start_index, num)
 
 
-    def _insert(self, key, value, identifier, allow_duplicates=False):
+    def _get_reversed_range(self, start, stop):
+        """
+        Returns a list of the items in the range [start, stop), in
+        reverse order. The nodes are walked from right to left, and
+        all children of a node that hold items in the range are
+        fetched together.
+        """
+        def reverse_order(node, start, stop, results):
+            # |start| and |stop| are relative to the tree of |node|.
+            if node.is_leaf():
+                results.extend(reversed(node.items(start, stop)))
+                return
+            # Collect the children and items in the range from left to
+            # right, as (i, start, stop) tuples for the children, and
+            # (i, None, None) tuples for the items.
+            entries = []
+            offset = 0
+            for i, count in enumerate(node.counts):
+                end = offset + count
+                if start < end and offset < stop:
+                    entries.append((i, max(start, offset) - offset,
+                                    min(stop, end) - offset))
+                if i < node.size() and start <= end < stop:
+                    entries.append((i, None, None))
+                offset = end + 1
+            children = self._get_nodes([node.links[i] for i, lo, _
+                                        in entries if lo is not None])
+            for i, lo, hi in reversed(entries):
+                if lo is None:
+                    results.append(node.items(i, i + 1)[0])
+                else:
+                    reverse_order(children.pop(), lo, hi, results)
+
+        results = []
+        if start < stop:
+            reverse_order(self._get_root(), start, stop, results)
+        return results
+
+
+    def _get_by_indices(self, indices):
+        """
+        Returns a list with the item at each of the given |indices|,
+        which must all be in the range [0, size). All items are found
+        in a single descent, in which all nodes needed at the next
+        level are fetched together.
+        """
+        results = [None] * len(indices)
+        # Each entry is a (node, offset, positions) tuple, with the
+        # offset the index of the first item in the subtree of node,
+        # and positions the indices of the requested items in it.
+        level = [(self._get_root(), 0, range(len(indices)))]
+        while level:
+            links = []
+            for node, offset, positions in level:
+                if node.is_leaf():
+                    for p in positions:
+                        i = indices[p] - offset
+                        results[p] = node.items(i, i + 1)[0]
+                    continue
+                children = {}
+                for p in positions:
+                    start = offset
+                    for i, count in enumerate(node.counts):
+                        if indices[p] < start + count:
+                            children.setdefault(i, (start, []))[1].append(p)
+                            break
+                        if indices[p] == start + count:
+                            results[p] = node.items(i, i + 1)[0]
+                            break
+                        start += count + 1
+                for i, (start, group) in sorted(children.iteritems()):
+                    links.append((node.links[i], start, group))
+            nodes = self._get_nodes([link for link, _, _ in links])
+            level = [(node, start, group) for node, (_, start, group)
+                     in izip(nodes, links)]
+        return results
+
+
+    def _insert(self, key, value, identifier, allow_duplicates=False,
+                expires=None):
+        """
+        Inserts the item in the tree, which expires at the POSIX time
+        |expires| if it is not None. Returns False if the tree is
+        capped and the item is rejected, otherwise True.
+        """
+        self._check_expires(expires)
         if identifier is not None:
             if  not isinstance(identifier, basestring):
                 raise ValueError("Identifiers must be strings")
-            self._delete_identifier(identifier)
+            indexed = self._indexed_item(identifier)
+            if indexed is not None:
+                index, moved_to = self._move_within_leaf(
+                    indexed[0], key, value, identifier, expires)
+                if moved_to is not None:
+                    return True
+                self._delete_index(index)
+
+        # The replaced item is already deleted, so a capped tree is
+        # never full when an existing identifier is inserted again.
+        if (self.capacity is not None
+            and not self._admits(key, allow_duplicates)):
+            return False
 
         root = self._get_root()
         if self._is_full(root):
             # Grow the tree by one, creating a new root.
             new_root = self._make_node()
-            new_root.key = self._make_node_key("root")
-            # Revert the old root's key back to its original id. This
-            # requires careful swapping, and the nodes are also
-            # immediately put, to update the in memory cache for the
-            # new keys.
-            root.key = self._make_node_key(root.assigned_id)
-            new_root.links.insert(0, root.key.id())
-            new_root.counts.insert(0, root.tree_size())
+            if self.root_pointer:
+                self._set_root(new_root)
+            else:
+                new_root.key = self._make_node_key("root")
+                # Revert the old root's key back to its original id.
+                # This requires careful swapping, and the nodes are
+                # also immediately put, to update the in memory cache
+                # for the new keys.
+                root.key = self._make_node_key(root.assigned_id)
+            # The generation of the tree, the inline flag and the
+            # creation id move to the new root.
+            new_root.version = root.version
+            new_root.inline, root.inline = root.inline, None
+            new_root.creation_id, root.creation_id = root.creation_id, None
+            new_root.insert_link(0, root.as_link())
             self._put_node(root, new_root)
             root = new_root
             self._split_child_node(new_root, 0)
 
         self._do_insert(root, key, value, identifier,
-                        duplicate_keys=allow_duplicates)
+                        duplicate_keys=allow_duplicates, expires=expires)
+        if self.capacity is not None:
+            self._evict_over_capacity()
+        return True
+
+
+    def _admits(self, key, allow_duplicates):
+        """
+        Returns whether a new item with the given |key| is kept in this
+        capped tree. If the tree is full, an item that would be
+        evicted directly is rejected. This is decided with the
+        boundary stored in the root, so the tree is not descended.
+        """
+        root = self._get_root()
+        if root.tree_size() < self.capacity:
+            return True
+        boundary = self._capacity_boundary(root)
+        if key == boundary:
+            # Without duplicates, the existing item is replaced.
+            # Otherwise, the existing items with the same key are
+            # kept instead of the new item.
+            return not allow_duplicates
+        if self._evicts_first():
+            return key > boundary
+        return key < boundary
+
+
+    def _evicts_first(self):
+        """
+        Returns whether a capped tree evicts its first items, instead
+        of its last ones.
+        """
+        # The highest keys are last, unless the tree is descending.
+        return self.keep_lowest == self.descending
+
+
+    def _capacity_boundary(self, root):
+        """
+        Returns the stored key of the item that a capped tree evicts
+        next, or None if the tree is empty. The boundary stored in
+        the |root| is only used if the root did not change during
+        this batch.
+        """
+        if root.key not in self._nodes_to_put:
+            return root.boundary
+        size = root.tree_size()
+        if size == 0:
+            return None
+        return self._get_by_index(0 if self._evicts_first() else size - 1)[0]
+
+
+    def _evict_over_capacity(self):
+        """
+        Removes the first or last items of a capped tree, until the
+        tree holds no more items than its capacity.
+        """
+        size = self._size()
+        while size > self.capacity:
+            self._delete_index(0 if self._evicts_first() else size - 1)
+            size -= 1
+
+
+    def _insert_with_identifiers(self, items):
+        """
+        Inserts all (key, value, identifier, expires) tuples in the list
+        |items|, replacing the existing items with the same
+        identifiers. The result is identical to inserting the items
+        one by one, but all replaced items are first moved within
+        their leaf or deleted in a single pass, and the remaining
+        items are then inserted in sorted order.
+
+        Returns the set of identifiers whose items are rejected by a
+        capped tree.
+        """
+        for (key, value, identifier, expires) in items:
+            if not isinstance(identifier, basestring):
+                raise ValueError("Identifiers must be strings")
+            self._check_expires(expires)
+        # Only the last item for each identifier ends up in the tree.
+        last = dict((item[2], i) for i, item in enumerate(items))
+        items = [item for i, item in enumerate(items) if last[item[2]] == i]
+        self._populate_identifier_cache(last.iterkeys())
+        # Unless identical keys are ordered by identifier, an item can
+        # only be moved within its leaf if no other item in |items|
+        # has the same key, as it would otherwise be positioned before
+        # items that are inserted later.
+        sorted_keys = sorted(item[0] for item in items)
+        to_insert = []
+        # The indices of the replaced items that are deleted.
+        to_delete = []
+        for (key, value, identifier, expires) in items:
+            indexed = self._indexed_item(identifier)
+            if indexed is not None:
+                unique = self.identifier_order or (
+                    bisect.bisect_right(sorted_keys, key) -
+                    bisect.bisect_left(sorted_keys, key)) == 1
+                if not unique:
+                    index = self._index_for_key_and_identifier(indexed[0],
+                                                               identifier)
+                    assert index != -1, (
+                        "Item '%s' missing! Key:'%s'. Tree:%s" %
+                        (identifier, indexed[0], self.key))
+                    to_delete.append(index)
+                else:
+                    index, moved_to = self._move_within_leaf(
+                        indexed[0], key, value, identifier, expires)
+                    if moved_to is None:
+                        to_delete.append(index)
+                    else:
+                        # The items between the old and the new position
+                        # of the moved item shift by one.
+                        for i, other in enumerate(to_delete):
+                            other -= other > index
+                            to_delete[i] = other + (other >= moved_to)
+                        continue
+            to_insert.append((key, value, identifier, expires))
+        self._delete_indices(to_delete)
+        # Sorting is stable, so identical keys stay in insertion order.
+        to_insert.sort(key=lambda item: item[0])
+        rejected = set()
+        for (key, value, identifier, expires) in to_insert:
+            if not self._insert(key, value, identifier, allow_duplicates=True,
+                                expires=expires):
+                rejected.add(identifier)
+        return rejected
+
+
+    def _upsert_with_identifiers(self, items, predicate):
+        """
+        Inserts each (key, value, identifier, expires) tuple in the list
+        |items| for which no item with the same identifier exists, or
+        for which predicate(key, existing_key) returns True. The
+        existing keys are taken from the identifier index, so nothing
+        is written for items that are rejected. An existing item that
+        has expired counts as absent, even if it is not swept yet.
+        |predicate| can also be the name of one of the
+        _UPSERT_PREDICATES.
+
+        Returns a list of booleans that tells for each item whether it
+        was inserted. Items that are rejected by a capped tree are not
+        inserted either.
+        """
+        if not callable(predicate):
+            try:
+                predicate = _UPSERT_PREDICATES[predicate]
+            except KeyError:
+                raise ValueError("Unknown predicate: %s" % (predicate,))
+        if self.encode_keys or self.descending:
+            # Predicates compare the original keys, not the stored
+            # ones.
+            compare = predicate
+            predicate = lambda new_key, old_key: compare(
+                self._decode_key(new_key), self._decode_key(old_key))
+        for item in items:
+            if not isinstance(item[2], basestring):
+                raise ValueError("Identifiers must be strings")
+        self._populate_identifier_cache(set(item[2] for item in items))
+        # The keys and expiry times of identifiers accepted earlier in
+        # |items|.
+        accepted_keys = {}
+        accepted = []
+        results = []
+        for item in items:
+            identifier = item[2]
+            if identifier in accepted_keys:
+                existing, expires = accepted_keys[identifier]
+            else:
+                existing, expires = self._indexed_item(identifier), None
+            inserted = existing is None or bool(predicate(item[0],
+                                                          existing[0]))
+            if not inserted and self.ttl:
+                if identifier not in accepted_keys:
+                    # The index does not store the expiry time, so it
+                    # is read from the node that holds the item.
+                    node, x = self._path_to_item(existing[0],
+                                                 identifier)[-1]
+                    expires = node.expires[x]
+                inserted = self._is_expired(expires)
+            if inserted:
+                accepted_keys[identifier] = ((item[0],), item[3])
+                accepted.append(item)
+            results.append(inserted)
+        if accepted:
+            rejected = self._insert_with_identifiers(accepted)
+            if rejected:
+                results = [result and item[2] not in rejected
+                           for result, item in izip(results, items)]
+        return results
+
+
+    def _move_within_leaf(self, old_key, key, value, identifier,
+                          expires=None):
+        """
+        Replaces the item with the given |old_key| and |identifier| by
+        the new |key|, |value| and expiry time, if the new item belongs
+        in the same leaf. No counts change in that case, so only the
+        leaf is written, unless the tree maintains aggregates or
+        expiry times, or the item is at the boundary of a capped tree.
+
+        Returns an (index, moved_to) pair, with the index of the item
+        before the move, and its index after the move, or None as
+        moved_to if it must be replaced by a delete and an insert. The
+        item is then still at |index|, so it is not located again.
+        """
+        path = self._path_to_item(old_key, identifier)
+        assert path is not None, ("Item '%s' missing! Key:'%s'. Tree:%s" %
+                                  (identifier, old_key, self.key))
+        index = self._index_of_path(path)
+        leaf, x = path[-1]
+        if not leaf.is_leaf():
+            return index, None
+        # An insert of the item follows the same links if it is not
+        # ordered before the separator on the left, but it is ordered
+        # before the separator on the right.
+        for node, i in path[:-1]:
+            if i > 0 and self._precedes(key, identifier, node, i - 1):
+                return index, None
+            if i < node.size() and not self._precedes(key, identifier,
+                                                      node, i):
+                return index, None
+        if self.capacity is not None:
+            root = self._get_root()
+            boundary = root.boundary
+            if (old_key == boundary
+                or (key <= boundary if self._evicts_first()
+                    else key >= boundary)):
+                # The item is or becomes the one that is evicted next,
+                # so the boundary is computed again when the root is
+                # written.
+                self._put_node(root)
+        leaf.pop_item(x)
+        y = self._insertion_index(leaf, key, identifier)
+        leaf.insert(y, (key, value, identifier, expires))
+        self._put_node(leaf)
+        if self.aggregate is not None or self.ttl or self.versioned:
+            # The value or expiry time might have changed, or the new
+            # version must reach the root, so update all links on the
+            # path to the leaf.
+            child = leaf
+            for node, i in reversed(path[:-1]):
+                node.update_link(i, child)
+                self._put_node(node)
+                child = node
+        return index, index - x + y
 
 
     def _delete_key(self, key):
@@ -420,7 +1263,7 @@ class _BTreeBase(ndb.Model):
         item = self._do_delete(root, key)
         self._replace_root_if_required(root)
         if item is not None:
-            return item if item[2] is not None else item[:2]
+            return item[:3] if item[2] is not None else item[:2]
         else:
             return None
 
@@ -444,7 +1287,7 @@ class _BTreeBase(ndb.Model):
         root = self._get_root()
         item = self._do_delete_by_index(root, index)
         self._replace_root_if_required(root)
-        return item if item[2] is not None else item[:2]
+        return item[:3] if item[2] is not None else item[:2]
 
     def _delete_range(self, a, b):
         """
@@ -458,7 +1301,7 @@ class _BTreeBase(ndb.Model):
         for x in xrange(a, b):
             item = self._do_delete_by_index(root, a)
             root = self._replace_root_if_required(root)
-            deleted.append(item if item[2] is not None else item[:2])
+            deleted.append(item[:3] if item[2] is not None else item[:2])
         return deleted
 
 
@@ -468,15 +1311,216 @@ class _BTreeBase(ndb.Model):
         that identifier exist, then this function does not perform any
         operations.
         """
-        key_and_value = self._key_and_value_for_identifier(identifier)
-        if key_and_value is not None:
-            item_index = self._index_for_key_and_identifier(key_and_value[0],
+        indexed = self._indexed_item(identifier)
+        if indexed is not None:
+            item_index = self._index_for_key_and_identifier(indexed[0],
                                                             identifier)
             assert item_index != -1, ("Item '%s' missing! Key:'%s'. Tree:%s" %
-                                      (identifier, key_and_value[0], self.key))
+                                      (identifier, indexed[0], self.key))
             self._delete_index(item_index)
 
 
+    def _compact(self, fill_factor, max_nodes, cursor=None):
+        """
+        Performs a part of a compaction pass over the tree. The
+        internal nodes are visited from the root down, and the
+        children of each visited node are re-packed such that they are
+        filled to about |fill_factor| of their maximum size, both
+        before and after the subtrees of the children are visited.
+        Nodes that are no longer needed are deleted.
+
+        Re-packing the children of a node first moves the links of
+        its grandchildren between the children, so the grandchildren
+        are then re-packed in groups that span several former parents.
+        Re-packing them again afterwards merges the children whose
+        subtrees shrank. Each level thus ends up filled to about
+        |fill_factor|, apart from at most one node per group.
+
+        The pass stops after the children of about |max_nodes| nodes
+        have been re-packed. |cursor| must be None to start a new
+        pass, or the value returned by the previous call to continue
+        a pass.
+
+        Returns a cursor to continue the pass with, or None if the
+        pass is completed.
+        """
+        target = int(fill_factor * (2 * self.degree - 1))
+        target = min(2 * self.degree - 1, max(self.degree - 1, target))
+        # Shared between the recursive calls.
+        state = {'budget': max_nodes, 'started': False}
+
+        def compact_children(node, height):
+            # Returns False if the budget is used up.
+            if state['started'] and len(node.links) > state['budget']:
+                return False
+            state['started'] = True
+            state['budget'] -= len(node.links)
+            self._compact_children(node, target, height == root_height)
+            return True
+
+        def visit(node, height, path):
+            # Returns None if the subtree formed by |node| is fully
+            # compacted, otherwise the path of child indices at which
+            # the pass must continue. An empty path continues with the
+            # node itself, and any other path after the children of
+            # the node were re-packed the first time.
+            if not path:
+                if not compact_children(node, height):
+                    return ()
+            start = min(path[0], len(node.links)) if path else 0
+            if height > 1:
+                for i in xrange(start, len(node.links)):
+                    child = self._get_node(node.links[i])
+                    stopped = visit(child, height - 1,
+                                    path[1:] if path and i == start else ())
+                    if self.versioned and child.key in self._nodes_to_put:
+                        # The new version of the child must reach the
+                        # root.
+                        node.update_link(i, child)
+                        self._put_node(node)
+                    if stopped is not None:
+                        return (i,) + stopped
+            if not compact_children(node, height):
+                # Continue with this node, but skip its children.
+                return (len(node.links),)
+            return None
+
+        root = self._get_root()
+        root_height = 0
+        node = root
+        while not node.is_leaf():
+            node = self._get_node(node.links[0])
+            root_height += 1
+        if root_height == 0:
+            return None
+        if not cursor:
+            # Lower the tree for as long as the children of the root
+            # fit into a single node.
+            while root_height > 0:
+                if not compact_children(root, root_height):
+                    return ()
+                new_root = self._replace_root_if_required(root)
+                if new_root is root:
+                    break
+                root, root_height = new_root, root_height - 1
+            if root_height == 0:
+                return None
+            # The children of the root were re-packed above.
+            cursor = (0,)
+        cursor = visit(root, root_height, cursor)
+        if self._replace_root_if_required(root) is not root and cursor:
+            # The only child of the root became the root.
+            cursor = cursor[1:]
+        return cursor
+
+
+    def _delete_indices(self, indices):
+        """
+        Deletes the items at all |indices|, from the highest to the
+        lowest index, so the indices of the remaining items stay
+        valid.
+        """
+        root = self._get_root()
+        for index in sorted(indices, reverse=True):
+            self._do_delete_by_index(root, index)
+            root = self._replace_root_if_required(root)
+
+
+    def _sweep_expired(self, budget):
+        """
+        Removes up to |budget| items that have expired. Returns the
+        number of removed items.
+
+        Only the subtrees whose earliest expiry time has passed are
+        visited, and all such children of a node are fetched together.
+        The expired items are then deleted from the highest to the
+        lowest index, so the indices of the remaining items stay
+        valid.
+        """
+        indices = []
+
+        def visit(node, offset):
+            # |offset| is the index of the first item in the tree of
+            # |node|.
+            if node.is_leaf():
+                indices.extend(offset + i for i, expires
+                               in enumerate(node.expires)
+                               if self._is_expired(expires))
+                return
+            expired = [i for i, expires in enumerate(node.link_expires)
+                       if self._is_expired(expires)]
+            children = dict(izip(expired, self._get_nodes(
+                        [node.links[i] for i in expired])))
+            for i, count in enumerate(node.counts):
+                if len(indices) >= budget:
+                    return
+                if i in children:
+                    visit(children[i], offset)
+                offset += count
+                if i < node.size() and self._is_expired(node.expires[i]):
+                    indices.append(offset)
+                offset += 1
+
+        root = self._get_root()
+        if budget > 0:
+            visit(root, 0)
+        indices = indices[:budget]
+        for index in reversed(indices):
+            self._do_delete_by_index(root, index)
+            root = self._replace_root_if_required(root)
+        return len(indices)
+
+
+    def _clear(self):
+        """
+        Deletes all identifier index entities and nodes of the tree,
+        and gives it a new empty root. The index entities are deleted
+        first and the old nodes last, so the tree stays readable while
+        it is cleared.
+        """
+        index_keys = self._storage.query_keys(_BTreeIndex, self.key)
+        node_keys = [key for key
+                     in self._storage.query_keys(_BTreeNode, self.key)
+                     if key.id() != "root"]
+        self._storage.delete_multi(index_keys)
+        self._batch_operations(self._reset_root)
+        if self._node_cache is not None:
+            self._node_cache.clear()
+        self._storage.delete_multi(node_keys)
+
+
+    @classmethod
+    def _drop(cls, key, storage):
+        """
+        Deletes the tree with the given |key| from |storage|, together
+        with all its nodes and identifier index entities. The tree
+        entity is deleted last, so the tree cannot be created again
+        while its entities are deleted.
+        """
+        storage.delete_multi(storage.query_keys(_BTreeIndex, key) +
+                             storage.query_keys(_BTreeNode, key))
+        storage.delete_multi([ndb.Key(_BTreeRoot, "root", parent=key), key])
+
+
+    def _reset_root(self):
+        """
+        Replaces the root by an empty root, without deleting any other
+        nodes. The generation of a versioned tree continues in the new
+        root.
+        """
+        old_root = self._get_root()
+        root = self._make_node()
+        if self.root_pointer:
+            self._set_root(root)
+        else:
+            root.key = old_root.key
+        root.version = old_root.version
+        root.creation_id = old_root.creation_id
+        if self.inline_threshold is not None:
+            root.inline = True
+        self._put_node(root)
+
+
     def _replace_root_if_required(self, root):
         """
         Sets a new root of this tree, if the given |root| is empty and
@@ -486,11 +1530,22 @@ class _BTreeBase(ndb.Model):
         if root.size() == 0 and len(root.links) > 0:
             assert len(root.links) == 1, "Cannot have more than one child"
             new_root = self._get_node(root.links[0])
-            # Delete the entity with the old numeric key, and save the
-            # entity again, but this time using the root key.
-            self._delete_node(new_root)
-            new_root.key = root.key
-            self._put_node(new_root) # overwrites old root
+            new_root.version = root.version
+            new_root.inline = root.inline
+            new_root.creation_id = root.creation_id
+            if self.root_pointer:
+                # Only the pointer changes, unless the new root must
+                # store the state of the root.
+                self._delete_node(root)
+                self._set_root(new_root)
+                if self.capacity is not None or self.versioned:
+                    self._put_node(new_root)
+            else:
+                # Delete the entity with the old numeric key, and save
+                # the entity again, but this time using the root key.
+                self._delete_node(new_root)
+                new_root.key = root.key
+                self._put_node(new_root) # overwrites old root
             root = new_root
         return root
 
@@ -509,42 +1564,51 @@ class _BTreeBase(ndb.Model):
         # the new nodes. The separator and associated values will go
         # in the parent node.
         n = self.degree - 1               # separator index
-        node.insert(i, split.item(n))
+        # The separator is popped and inserted, so the identifier
+        # index sees that it only moved.
+        node.insert(i, split.pop_item(n))
         # Split the existing values, the values beyond the separator
         # go into the new node, while the lower values stay in the split
         # node.
-        split.keys, new.keys = split.keys[:n], split.keys[n+1:]
-        split.values, new.values = split.values[:n], split.values[n+1:]
-        split.ids, new.ids = split.ids[:n], split.ids[n+1:]
+        split.keys, new.keys = split.keys[:n], split.keys[n:]
+        split.values, new.values = split.values[:n], split.values[n:]
+        split.ids, new.ids = split.ids[:n], split.ids[n:]
         split.links, new.links = split.links[:n+1], split.links[n+1:]
         split.counts, new.counts = split.counts[:n+1], split.counts[n+1:]
+        split.aggregates, new.aggregates = (split.aggregates[:n+1],
+                                            split.aggregates[n+1:])
+        split.expires, new.expires = split.expires[:n], split.expires[n:]
+        split.link_expires, new.link_expires = (split.link_expires[:n+1],
+                                                split.link_expires[n+1:])
+        split.link_versions, new.link_versions = (split.link_versions[:n+1],
+                                                  split.link_versions[n+1:])
         # Update parent links. The original link to the split node is
         # already in the correct position.
-        node.links.insert(i + 1, new.key.id())
-        node.counts[i] = split.tree_size()
-        node.counts.insert(i + 1, new.tree_size())
+        node.update_link(i, split)
+        node.insert_link(i + 1, new.as_link())
         self._put_node(node, new, split)
 
 
-    def _do_insert(self, node, key, value, identifier, duplicate_keys=True):
+    def _do_insert(self, node, key, value, identifier, duplicate_keys=True,
+                   expires=None):
         """
-        Recursively insert the key, value and id in the non-full
-        |node|. This procedure will split nodes along the way if
+        Recursively insert the key, value, id and expiry time in the
+        non-full |node|. This procedure will split nodes along the way if
         required. Duplicate keys are allowed.
 
         Returns the size of the tree.
         """
-        i = bisect.bisect(node.keys, key)
+        i = self._insertion_index(node, key, identifier)
 
         if (not duplicate_keys
             and 0 <= (i - 1) < node.size()
             and node.keys[i - 1] == key):
-            node.replace(i - 1, (key, value, identifier))
+            node.replace(i - 1, (key, value, identifier, expires))
             self._put_node(node)
             return node.tree_size()
 
         if node.is_leaf():
-            node.insert(i, (key, value, identifier))
+            node.insert(i, (key, value, identifier, expires))
         else:
             child = self._get_node(node.links[i])
             if self._is_full(child):
@@ -559,10 +1623,10 @@ class _BTreeBase(ndb.Model):
                 # splitting. This is not very elegant, but it saves
                 # duplicating logic.
                 return self._do_insert(node, key, value, identifier,
-                                       duplicate_keys)
-            child_size = self._do_insert(child, key, value, identifier,
-                                         duplicate_keys)
-            node.counts[i] = child_size
+                                       duplicate_keys, expires)
+            self._do_insert(child, key, value, identifier, duplicate_keys,
+                            expires)
+            node.update_link(i, child)
         # Must always save as the tree size will have changed or
         # an item is inserted.
         self._put_node(node)
@@ -595,7 +1659,7 @@ class _BTreeBase(ndb.Model):
         if index_in_subtree:
             child, child_i, offset = self._child_with_minimum_degree(node, i)
             deleted_item = self._do_delete_by_index(child, index + offset)
-            node.counts[child_i] = child.tree_size()
+            node.update_link(child_i, child)
             self._put_node(node)
             return deleted_item
 
@@ -610,7 +1674,7 @@ class _BTreeBase(ndb.Model):
             deleted_item = self._do_delete_by_index(left, index - 1)
             item = node.item(i)
             node.replace(i, deleted_item)
-            node.counts[i] = left.tree_size()
+            node.update_link(i, left)
             self._put_node(node)
             return item
 
@@ -619,7 +1683,7 @@ class _BTreeBase(ndb.Model):
             deleted_item = self._do_delete_by_index(right, 0)
             item = node.item(i)
             node.replace(i, deleted_item)
-            node.counts[i + 1] = right.tree_size()
+            node.update_link(i + 1, right)
             self._put_node(node)
             return item
 
@@ -630,7 +1694,7 @@ class _BTreeBase(ndb.Model):
         median = child.size() / 2
         new_index = median + sum(child.counts[:median + 1])
         deleted_item = self._do_delete_by_index(child, new_index)
-        node.counts[i] -= 1
+        node.update_link(i, child)
         self._put_node(node)
         return deleted_item
 
@@ -664,7 +1728,7 @@ class _BTreeBase(ndb.Model):
         if not contains_key:
             child, index, _ = self._child_with_minimum_degree(node, i)
             deleted_item = self._do_delete(child, key)
-            node.counts[index] = child.tree_size()
+            node.update_link(index, child)
             self._put_node(node)
             return deleted_item
 
@@ -680,7 +1744,7 @@ class _BTreeBase(ndb.Model):
             assert deleted_item and p_key == deleted_item[0]
             item = node.item(i)
             node.replace(i, deleted_item)
-            node.counts[i] = left.tree_size()
+            node.update_link(i, left)
             self._put_node(node)
             return item
 
@@ -691,7 +1755,7 @@ class _BTreeBase(ndb.Model):
             assert deleted_item and s_key == deleted_item[0]
             item = node.item(i)
             node.replace(i, deleted_item)
-            node.counts[i + 1] = right.tree_size()
+            node.update_link(i + 1, right)
             self._put_node(node)
             return item
 
@@ -699,7 +1763,7 @@ class _BTreeBase(ndb.Model):
         # children. This will put the |key| in the child node.
         child = self._merge_with_right_sibling(node, i)
         deleted_item = self._do_delete(child, key)
-        node.counts[i] -= 1
+        node.update_link(i, child)
         self._put_node(node)
         return deleted_item
 
@@ -732,13 +1796,15 @@ class _BTreeBase(ndb.Model):
                 item = node.item(index - 1)
                 node.replace(index - 1, left.pop_item())
                 child.insert(0, item)
+                offset = 1
                 if not left.is_leaf():
-                    child.links.insert(0, left.links.pop())
-                    child.counts.insert(0, left.counts.pop())
-                node.counts[index - 1] = left.tree_size()
-                node.counts[index] = child.tree_size()
+                    child.insert_link(0, left.pop_link())
+                    # The moved subtree also precedes the items.
+                    offset += child.counts[0]
+                node.update_link(index - 1, left)
+                node.update_link(index, child)
                 self._put_node(node, child, left)
-                return child, index, 1
+                return child, index, offset
         else:
             left = None
 
@@ -753,10 +1819,9 @@ class _BTreeBase(ndb.Model):
                 node.replace(index, right.pop_item(0))
                 child.append(item)
                 if not right.is_leaf():
-                    child.links.append(right.links.pop(0))
-                    child.counts.append(right.counts.pop(0))
-                node.counts[index] = child.tree_size()
-                node.counts[index + 1] = right.tree_size()
+                    child.insert_link(len(child.links), right.pop_link(0))
+                node.update_link(index, child)
+                node.update_link(index + 1, right)
                 self._put_node(node, child, right)
                 return child, index, 0
         else:
@@ -768,7 +1833,7 @@ class _BTreeBase(ndb.Model):
             # Take the offset before the merge operation, as that
             # increases the size. Also, add one for the key from
             # |node| that moved downwards to the child.
-            offset = left.size() # take offset before merge operation
+            offset = left.tree_size() # take offset before merge operation
             return (self._merge_with_right_sibling(node, index - 1),
                     index - 1,
                     offset + 1)
@@ -795,14 +1860,95 @@ class _BTreeBase(ndb.Model):
 
         left.append(node.pop_item(index))
         left.extend_with_contents_of_node(right)
-        node.links.pop(index + 1) # remove link and free right node
-        node.counts.pop(index + 1)
-        node.counts[index] = left.tree_size()
+        node.pop_link(index + 1) # remove link and free right node
+        node.update_link(index, left)
         self._put_node(node, left)
         self._delete_node(right)
         return left
 
 
+    def _compact_children(self, node, target, is_root):
+        """
+        Re-packs all items of the children of |node|, and the
+        separating items in |node| itself, into as few children as
+        possible, each holding about |target| items. Children that
+        are no longer needed are deleted. A non-root |node| always
+        keeps at least degree children, so it remains a valid node.
+        If the items fit into a single child of the root, they are
+        packed into one full child instead, so the tree can be lowered.
+
+        Returns the number of deleted children.
+        """
+        children = [self._get_node(link) for link in node.links]
+        # Flatten the children and separators as if they were a
+        # single large node. All children are at the same level, so
+        # either all or none of them have links.
+        keys, values, ids, links, counts = [], [], [], [], []
+        aggregates, expires, link_expires, link_versions = [], [], [], []
+        for i, child in enumerate(children):
+            keys.extend(child.keys)
+            values.extend(child.values)
+            ids.extend(child.ids)
+            links.extend(child.links)
+            counts.extend(child.counts)
+            aggregates.extend(child.aggregates)
+            expires.extend(child.expires)
+            link_expires.extend(child.link_expires)
+            link_versions.extend(child.link_versions)
+            if i < node.size():
+                keys.append(node.keys[i])
+                values.append(node.values[i])
+                if node.ids:
+                    ids.append(node.ids[i])
+                if node.expires:
+                    expires.append(node.expires[i])
+
+        minimum = 1 if is_root else self.degree
+        num = min(len(children),
+                  max(minimum, -(-(len(keys) + 1) // (target + 1))))
+        if is_root and len(keys) <= 2 * self.degree - 1:
+            # A single full child lowers the tree by one level.
+            num = 1
+        if num == len(children):
+            return 0
+
+        # Distribute the items evenly, so every child has between
+        # degree - 1 and 2 * degree - 1 items. The moved items keep
+        # their identifiers, so the identifier index stays valid.
+        size, remainder = divmod(len(keys) - (num - 1), num)
+        node.keys, node.values, node.ids, node.expires = [], [], [], []
+        node.links, node.counts, node.aggregates = [], [], []
+        node.link_expires, node.link_versions = [], []
+        pos = 0
+        for i, child in enumerate(children[:num]):
+            n = size + 1 if i < remainder else size
+            child.keys = keys[pos:pos + n]
+            child.values = values[pos:pos + n]
+            child.ids = ids[pos:pos + n]
+            child.expires = expires[pos:pos + n]
+            # Each previous child used one link more than its number
+            # of items, which matches the separators consumed in
+            # between, so its links also start at |pos|.
+            child.links = links[pos:pos + n + 1]
+            child.counts = counts[pos:pos + n + 1]
+            child.aggregates = aggregates[pos:pos + n + 1]
+            child.link_expires = link_expires[pos:pos + n + 1]
+            child.link_versions = link_versions[pos:pos + n + 1]
+            pos += n
+            node.insert_link(len(node.links), child.as_link())
+            if i < num - 1:
+                node.keys.append(keys[pos])
+                node.values.append(values[pos])
+                if ids:
+                    node.ids.append(ids[pos])
+                if expires:
+                    node.expires.append(expires[pos])
+                pos += 1
+        self._put_node(node, *children[:num])
+        self._delete_node(*children[num:])
+        return len(children) - num
+
+
     def _lower_bound_index(self, key):
         """
         Returns the index to the first element whose key is not less than
@@ -833,6 +1979,48 @@ class _BTreeBase(ndb.Model):
         return find_key(self._get_root())
 
 
+    def _bound_indices(self, bounds):
+        """
+        Returns the index of a bound for each (key, right) tuple in the
+        list |bounds|. If right is False, the bound is the index of
+        the first item whose key is not less than key, as returned by
+        _lower_bound_index(). Otherwise, it is the index of the first
+        item whose key is strictly greater than key, as returned by
+        _upper_bound_index().
+
+        All bounds are found in a single descent, in which the nodes
+        on the shared paths are visited once, and all nodes needed at
+        the next level are fetched together.
+        """
+        results = [0] * len(bounds)
+        # Each entry is a (node, offset, positions) tuple, with the
+        # offset the index of the first item in the subtree of node,
+        # and positions the indices of the bounds that lie in it.
+        level = [(self._get_root(), 0, range(len(bounds)))]
+        while level:
+            links = []
+            for node, offset, positions in level:
+                children = {}
+                for p in positions:
+                    key, right = bounds[p]
+                    if right:
+                        i = bisect.bisect_right(node.keys, key)
+                    else:
+                        i = bisect.bisect_left(node.keys, key)
+                    if node.is_leaf():
+                        results[p] = offset + i
+                    else:
+                        children.setdefault(i, []).append(p)
+                for i, group in sorted(children.iteritems()):
+                    links.append((node.links[i],
+                                  offset + sum(node.counts[:i]) + i,
+                                  group))
+            nodes = self._get_nodes([link for link, _, _ in links])
+            level = [(node, offset, group) for node, (_, offset, group)
+                     in izip(nodes, links)]
+        return results
+
+
     def _left_index_of_key(self, key):
         """
         Returns the leftmost index of the item with |key|. Returns
@@ -882,22 +2070,246 @@ class _BTreeBase(ndb.Model):
         Returns the index of the entry which matches the given key and
         id. If no item could be found, returns - 1.
         """
+        path = self._path_to_item(key, id)
+        return self._index_of_path(path) if path is not None else -1
+
+
+    def _index_of_path(self, path):
+        """
+        Returns the index of the item at the end of the |path|, as
+        returned by _path_to_item().
+        """
+        index = 0
+        for node, i in path[:-1]:
+            index += sum(node.counts[:i]) + i
+        node, x = path[-1]
+        return index + (sum(node.counts[:x + 1]) if node.counts else 0) + x
+
+
+    def _index_after(self, key, identifier, index):
+        """
+        Returns the index of the item that follows the item with the
+        given stored |key| and |identifier|, which had the given
+        |index| when it was last seen. If the item still exists at the
+        same key, the index directly after it is returned. Otherwise,
+        |index| is clamped to the range of items with the same key,
+        as items might have been inserted or removed in the meantime.
+        """
+        if identifier is not None:
+            indexed = self._indexed_item(identifier)
+            if indexed is not None and indexed[0] == key:
+                return self._index_for_key_and_identifier(key, identifier) + 1
+        lower, upper = self._bound_indices([(key, False), (key, True)])
+        return min(max(index + 1, lower), upper)
+
+
+    def _get_window(self, path, before, after):
+        """
+        Returns the list of items from |before| items before the item
+        at the end of the |path| up to |after| items after it, clipped
+        to the bounds of the tree. The items are collected outwards
+        from the nodes on the |path|, so only the subtrees next to it
+        that hold items of the window are retrieved.
+        """
+        def first(node, n):
+            # Returns the first |n| items of the tree of |node|.
+            if node.is_leaf():
+                return node.items(0, n)
+            results = []
+            for i, link in enumerate(node.links):
+                if len(results) < n:
+                    results.extend(first(self._get_node(link),
+                                         n - len(results)))
+                if len(results) < n and i < node.size():
+                    results.extend(node.items(i, i + 1))
+            return results
+
+        def last(node, n):
+            # Returns the last |n| items of the tree of |node|, in
+            # reverse order.
+            if node.is_leaf():
+                return node.items(max(0, node.size() - n), None)[::-1]
+            results = []
+            for i in reversed(xrange(len(node.links))):
+                if len(results) < n:
+                    results.extend(last(self._get_node(node.links[i]),
+                                        n - len(results)))
+                if len(results) < n and i > 0:
+                    results.extend(node.items(i - 1, i))
+            return results
+
+        preceding, following = [], []
+        # Walk up from the item, collecting the items on either side of
+        # the followed link in each node, nearest first. In the node of
+        # the item itself, the links next to the item come first.
+        for depth, (node, i) in reversed(list(enumerate(path))):
+            own = depth == len(path) - 1
+            if own and node.links and before > 0:
+                preceding.extend(last(self._get_node(node.links[i]),
+                                      before))
+            for k in reversed(xrange(i)):
+                if len(preceding) >= before:
+                    break
+                preceding.extend(node.items(k, k + 1))
+                if node.links and len(preceding) < before:
+                    preceding.extend(last(self._get_node(node.links[k]),
+                                          before - len(preceding)))
+            start = i + 1 if own else i
+            if own and node.links and after > 0:
+                following.extend(first(self._get_node(node.links[start]),
+                                       after))
+            for k in xrange(start, node.size()):
+                if len(following) >= after:
+                    break
+                following.extend(node.items(k, k + 1))
+                if node.links and len(following) < after:
+                    following.extend(first(self._get_node(node.links[k + 1]),
+                                           after - len(following)))
+        node, x = path[-1]
+        return preceding[::-1] + node.items(x, x + 1) + following
+
+
+    def _path_to_index(self, index):
+        """
+        Returns the path from the root to the item with the given
+        |index|, which must be within the bounds of the tree, in the
+        format of _path_to_item().
+        """
+        path = []
+        node = self._get_root()
+        while not node.is_leaf():
+            for i, count in enumerate(node.counts):
+                if index <= count:
+                    break
+                index -= count + 1
+            path.append((node, i))
+            if index == count:
+                return path
+            node = self._get_node(node.links[i])
+        path.append((node, index))
+        return path
+
+
+    def _aggregate_index_range(self, start, stop):
+        """
+        Returns the aggregate of the values of the items with an index
+        in the range [start, stop), which must be within the bounds of
+        the tree. Returns None if the range is empty.
+
+        Subtrees that lie completely inside the range contribute the
+        aggregate stored in their link, so only the nodes on the paths
+        to both ends of the range are retrieved.
+        """
+        combine = self._combine
+
+        def aggregate(node, start, stop):
+            # |start| and |stop| are relative to the tree of |node|.
+            if node.is_leaf():
+                return reduce(combine, node.values[start:stop], None)
+            result = None
+            offset = 0
+            for i, count in enumerate(node.counts):
+                # The i'th child holds the indices [offset, end), and
+                # the i'th item in this node has the index |end|.
+                end = offset + count
+                if start < end and offset < stop:
+                    if start <= offset and end <= stop:
+                        result = combine(result, node.aggregates[i])
+                    else:
+                        child = self._get_node(node.links[i])
+                        result = combine(result, aggregate(
+                                child, max(start, offset) - offset,
+                                min(stop, end) - offset))
+                if end >= stop:
+                    break
+                if start <= end:
+                    result = combine(result, node.values[i])
+                offset = end + 1
+            return result
+
+        if start >= stop:
+            return None
+        return aggregate(self._get_root(), start, stop)
+
+
+    def _combine(self, a, b):
+        """
+        Combines the aggregated values |a| and |b| with the aggregate
+        function of this tree. None is the identity, so it can be used
+        for empty subtrees and for values that should be ignored.
+        """
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return _AGGREGATE_FUNCTIONS.get(self.aggregate, self.aggregate)(a, b)
+
+
+    def _path_to_item(self, key, id):
+        """
+        Returns the path from the root to the item which matches the
+        given key and id, as a list of (node, index) tuples. For all
+        but the last node, index is the index of the followed link,
+        and for the last node it is the index of the item itself.
+        Returns None if no item could be found.
+
+        If identical keys are ordered by identifier, this is a single
+        binary search per level. Otherwise, all items with the same
+        key might need to be scanned.
+        """
+        if self.identifier_order:
+            path = []
+            node = self._get_root()
+            while True:
+                x = self._insertion_index(node, key, id)
+                if x > 0 and node.keys[x - 1] == key and node.ids[x - 1] == id:
+                    path.append((node, x - 1))
+                    return path
+                if node.is_leaf():
+                    return None
+                path.append((node, x))
+                node = self._get_node(node.links[x])
+
         def find_key_and_id(node):
             i = bisect.bisect_left(node.keys, key)
             j = bisect.bisect_right(node.keys, key)
             for x in xrange(i, j):
                 if node.ids[x] == id:
-                    return (sum(node.counts[:x + 1]) if node.counts else 0) + x
+                    return [(node, x)]
             if node.links:
                 for x in range(i, j + 1):
-                    index = find_key_and_id(self._get_node(node.links[x]))
-                    if index != -1:
-                        return sum(node.counts[:x]) + index + x
-            return -1
+                    path = find_key_and_id(self._get_node(node.links[x]))
+                    if path is not None:
+                        return [(node, x)] + path
+            return None
 
         return find_key_and_id(self._get_root())
 
 
+    def _insertion_index(self, node, key, identifier):
+        """
+        Returns the index in |node| at which an item with the given
+        |key| and |identifier| is inserted. Items with identical keys
+        are inserted after the existing ones, unless the tree orders
+        them by identifier.
+        """
+        i = bisect.bisect_right(node.keys, key)
+        if self.identifier_order and identifier is not None:
+            lo = bisect.bisect_left(node.keys, key, 0, i)
+            i = bisect.bisect_right(node.ids, identifier, lo, i)
+        return i
+
+
+    def _precedes(self, key, identifier, node, i):
+        """
+        Returns True if an item with the given |key| and |identifier|
+        is ordered before the i'th item of |node|.
+        """
+        if self.identifier_order and identifier is not None:
+            return (key, identifier) < (node.keys[i], node.ids[i])
+        return key < node.keys[i]
+
+
     def _find_predecessor(self, node, key):
         """
         Returns the key that is the predecessor of |key| in the subtree
@@ -930,7 +2342,46 @@ class _BTreeBase(ndb.Model):
         """
         Retrieves the node instance that is the root node of this tree.
         """
-        return self._get_node("root")
+        return self._get_node(self._root_id())
+
+
+    def _root_id(self):
+        """
+        Returns the id of the root node in the current batch.
+        """
+        if self._root_pointer is None:
+            return "root"
+        return self._root_pointer.node_id
+
+
+    def _set_root(self, node):
+        """
+        Makes |node| the root of a tree with a root pointer. The
+        pointer is written at the end of the batch.
+        """
+        self._root_pointer.node_id = node.key.id()
+
+
+    def _read_root_pointer(self):
+        """
+        Reads the root pointer of the tree, or returns None if the
+        tree has no root pointer.
+        """
+        if not self.root_pointer:
+            return None
+        key = self._make_pointer_key()
+        pointer = self._storage.get(key)
+        assert pointer, "No root pointer found with key %s" % (key,)
+        return pointer
+
+
+    def _read_root_key(self):
+        """
+        Reads the key of the current root node outside of a batch.
+        """
+        if not self.root_pointer:
+            return self._make_node_key("root")
+        return self._make_node_key(self._read_root_pointer().node_id)
 
 
     def _get_node(self, node_id):
@@ -940,6 +2391,32 @@ class _BTreeBase(ndb.Model):
         return self._get_node_from_key(self._make_node_key(node_id))
 
 
+    def _get_nodes(self, node_ids):
+        """
+        Retrieves the nodes with the given |node_ids| with a single
+        datastore call. Returns a list of nodes, in the same order as
+        |node_ids|.
+        """
+        keys = [self._make_node_key(node_id) for node_id in node_ids]
+        cache = self._node_cache or {}
+        missing = [key for key in keys
+                   if key not in self._nodes_to_put and key not in cache]
+        fetched = dict(izip(missing, self._storage.get_multi(missing)))
+        nodes = []
+        for key in keys:
+            if key in self._nodes_to_put:
+                node = self._nodes_to_put[key]
+            elif key in cache:
+                node = cache[key]
+            else:
+                node = fetched[key]
+                assert node, "No node found with key %s" % (key,)
+                self._attach_node(node)
+                self._cache_node(node)
+            nodes.append(node)
+        return nodes
+
+
     def _get_node_from_key(self, node_key):
         """
         Gets the node from the given full datastore |node_key|. As an
@@ -950,14 +2427,36 @@ class _BTreeBase(ndb.Model):
         # yet, so it is not yet in the ndb transaction cache.
         if node_key in self._nodes_to_put:
             return self._nodes_to_put[node_key]
+        if self._node_cache is not None and node_key in self._node_cache:
+            return self._node_cache[node_key]
         # Get the node from ndb transaction cache, or from the datastore
         # if it hasn't been seen yet.
-        node = node_key.get()
+        node = self._storage.get(node_key)
         assert node, "No node found with key %s" % (node_key,)
-        node._parent_tree = self # used for callbacks
+        self._attach_node(node)
+        self._cache_node(node)
         return node
 
 
+    def _attach_node(self, node):
+        """
+        Prepares a |node| retrieved from the datastore for use with
+        this tree. Sets the _parent_tree attribute that is used for
+        callbacks in the node.
+        """
+        node._parent_tree = self # used for callbacks
+        # Nodes stored before aggregates were introduced lack the
+        # property altogether.
+        if node.aggregates is None:
+            node.aggregates = []
+        if node.expires is None:
+            node.expires = []
+        if node.link_expires is None:
+            node.link_expires = []
+        if node.link_versions is None:
+            node.link_versions = []
+
+
     def _make_node(self):
         """
         Makes a new node with an auto assigned id. The node must be
@@ -966,27 +2465,28 @@ class _BTreeBase(ndb.Model):
         node_id = self._get_assigned_id()
         node = _BTreeNode(id=node_id, parent=self.key)
         node.populate(keys=[], values=[], ids=[], links=[], counts=[],
-                      assigned_id=node_id)
+                      aggregates=[], expires=[], link_expires=[],
+                      link_versions=[], assigned_id=node_id)
         node.assigned_id = node.key.integer_id()
         node._parent_tree = self
         return node
 
 
-    @ndb.non_transactional
     def _get_assigned_id(self):
         """
         Generate a unique integer identifier for a node.
         """
-        # Allocate ids is not possible within a transaction for some
-        # reason, so the non_transactional decorator is used to step
-        # outside the current transaction.
-        return _BTreeNode.allocate_ids(1, parent=self.key)[0]
+        return self._storage.allocate_id(_BTreeNode, self.key)
 
 
     def _make_node_key(self, node_id):
          return ndb.Key(_BTreeNode, node_id, parent=self.key)
 
 
+    def _make_pointer_key(self):
+        return ndb.Key(_BTreeRoot, "root", parent=self.key)
+
+
     def _print_tree(self):
         """
         Returns a string representation of the tree. Each node on a
@@ -1032,27 +2532,29 @@ class _BTreeBase(ndb.Model):
 
         |identifiers| must be an iterable that yields identifiers.
         """
-        identifiers = list(identifiers)
-        keys = (ndb.Key(_BTreeIndex, id, parent=self.key) for id
-                in identifiers)
-        indices = ndb.get_multi(keys)
-        key_values = []
-        for index in indices:
-            if index is not None:
-                key_values.append((index.tree_key, index.tree_value))
-            else:
-                key_values.append(None)
-        self._identifier_cache.update(izip(identifiers, key_values))
+        # Cached identifiers are always more recent than the index.
+        identifiers = [id for id in identifiers
+                       if id not in self._identifier_cache]
+        if self._inline_index is not None:
+            self._identifier_cache.update(
+                (id, self._inline_index.get(id)) for id in identifiers)
+            return
+        keys = [ndb.Key(_BTreeIndex, id, parent=self.key) for id
+                in identifiers]
+        indices = self._storage.get_multi(keys)
+        self._identifier_cache.update(
+            izip(identifiers, (self._index_contents_of(index)
+                               for index in indices)))
 
 
-    def _key_and_value_for_identifier(self, identifier):
+    def _indexed_item(self, identifier):
         """
-        Returns the (key, value) pair associated with the given
-        identifier. If the identifier is not used, None will be
-        returned.
+        Returns the indexed contents of the given identifier: a (key,
+        value) pair, or a (key,) tuple if the index does not store
+        values and the value is not known yet. If the identifier is
+        not used, None will be returned.
 
-        This operation will perform one datastore get to retrieve the
-        (key, value) pair.
+        This operation will perform at most one datastore get.
         """
         # An in-memory identifier cache is used to track the mutations
         # of identifiers during replace or delete operations. If an
@@ -1060,27 +2562,50 @@ class _BTreeBase(ndb.Model):
         # the value in the datastore. None can also be returned as
         # value from the cache, which means that an identifier was
         # deleted. If a identifier is not in the cache, the value is
-        # retrieved from the datastore.
+        # retrieved from the datastore, or from the root of an inline
+        # tree.
         try:
             return self._identifier_cache[identifier]
         except KeyError:
-            index = _BTreeIndex.get_by_id(identifier, parent=self.key)
-            key_value = None
-            if index:
-                key_value = (index.tree_key, index.tree_value)
+            if self._inline_index is not None:
+                contents = self._inline_index.get(identifier)
+            else:
+                index = self._storage.get(self._make_index_key(identifier))
+                contents = self._index_contents_of(index)
+            self._identifier_cache[identifier] = contents
+            return contents
+
+
+    def _key_and_value_for_identifier(self, identifier):
+        """
+        Returns the (key, value) pair associated with the given
+        identifier. If the identifier is not used, None will be
+        returned.
+
+        This operation will perform one datastore get to retrieve the
+        (key, value) pair, and if the index does not store values,
+        a lookup in the tree to find the value.
+        """
+        key_value = self._indexed_item(identifier)
+        if key_value is not None and len(key_value) == 1:
+            i = self._index_for_key_and_identifier(key_value[0], identifier)
+            key_value = self._get_by_index(i)[:2]
             self._identifier_cache[identifier] = key_value
-            return key_value
+        return key_value
 
 
-    def _identifier_removed(self, identifier):
+    def _identifier_removed(self, identifier, key, value):
         """
-        Callback used to notify that an item with the given |identifier|
-        was deleted from a node.
+        Callback used to notify that the item with the given
+        |identifier|, |key| and |value| was deleted from a node.
         """
-        index = self._make_index(identifier)
-        self._keys_to_delete.add(index.key)
-        if index.key in self._indices_to_put:
-            del self._indices_to_put[index.key]
+        index_key = self._make_index_key(identifier)
+        # If the identifier is not yet changed during this batch, its
+        # index in the datastore still matches the removed item.
+        self._stored_indices.setdefault(identifier,
+                                        self._index_contents(key, value))
+        self._indices_to_put.pop(index_key, None)
+        self._keys_to_delete.add(index_key)
         # Setting None implies that the identifier is deleted.
         self._identifier_cache[identifier] = None
 
@@ -1090,18 +2615,118 @@ class _BTreeBase(ndb.Model):
         Callback to notify that an item with the given |identifier| and
         |key_and_value| pair was added to a node
         """
-        index = self._make_index(identifier, key, value)
-        self._indices_to_put[index.key] = index
-        self._keys_to_delete.discard(index.key)
+        index_key = self._make_index_key(identifier)
+        self._keys_to_delete.discard(index_key)
         self._identifier_cache[identifier] = (key, value)
+        # An identifier that is added before it is removed during this
+        # batch is new, so it has no stored index yet.
+        stored = self._stored_indices.setdefault(identifier, None)
+        contents = self._index_contents(key, value)
+        # The types are compared too, as contents that are equal but
+        # different, such as 1 and 1.0, must still be written.
+        if (stored is not None and [(type(x), x) for x in stored] ==
+            [(type(x), x) for x in contents]):
+            # The item only moved within the tree, or its index does
+            # not change, so the stored index is still valid.
+            self._indices_to_put.pop(index_key, None)
+        else:
+            index = self._make_index(identifier, key, value)
+            self._indices_to_put[index_key] = index
+
+
+    def _index_contents(self, key, value):
+        """
+        Returns the contents that are stored in the index for an item
+        with the given |key| and |value|, as a tuple.
+        """
+        return (key, value) if self.index_values else (key,)
+
+
+    def _index_contents_of(self, index):
+        """
+        Returns the contents of the _BTreeIndex instance |index| as a
+        tuple, or None if |index| is None.
+        """
+        if index is None:
+            return None
+        return self._index_contents(index.tree_key, index.tree_value)
 
 
     def _make_index(self, identifier, key=None, value=None):
         """
         Creates a _BTreeIndex instance.
         """
-        return _BTreeIndex(id=str(identifier), parent=self.key,
-                           tree_key=key, tree_value=value)
+        index = _BTreeIndex(id=str(identifier), parent=self.key, tree_key=key)
+        if self.index_values:
+            index.tree_value = value
+        return index
+
+
+    def _encode_key(self, key):
+        """
+        Returns |key| in the form in which it is stored in the tree.
+        """
+        if self.descending:
+            key = keycodec.Descending(key)
+        if self.encode_keys:
+            key = keycodec.encode(key)
+        return key
+
+
+    def _decode_key(self, key):
+        """
+        Returns the original key of the stored |key|.
+        """
+        if self.encode_keys:
+            key = keycodec.decode(key)
+        if self.descending:
+            key = key.key
+        return key
+
+
+    def _decode_item(self, item):
+        """
+        Returns the tree |item| with its original key, if keys are
+        stored in another form. |item| can also be None. Returns None
+        if the item has expired.
+        """
+        if isinstance(item, _ExpiredItem):
+            return None
+        if item is None or not (self.encode_keys or self.descending):
+            return item
+        return (self._decode_key(item[0]),) + tuple(item[1:])
+
+
+    def _decode_items(self, items):
+        """
+        Returns the list of tree |items| with their original keys, if
+        keys are stored in another form. Expired items are left out.
+        """
+        if not (self.encode_keys or self.descending or self.ttl):
+            return items
+        return [self._decode_item(item) for item in items
+                if not isinstance(item, _ExpiredItem)]
+
+
+    def _check_expires(self, expires):
+        """
+        Raises a ValueError if an item with the expiry time |expires|
+        cannot be stored in this tree.
+        """
+        if expires is not None and not self.ttl:
+            raise ValueError("Tree %s has no expiring items" % (self.key,))
+
+
+    def _is_expired(self, expires):
+        """
+        Returns whether an item with the expiry time |expires| has
+        expired.
+        """
+        return expires is not None and expires <= time.time()
+
+
+    def _make_index_key(self, identifier):
+        return ndb.Key(_BTreeIndex, str(identifier), parent=self.key)
 
     def _size(self):
         """Returns the size of the BTree."""
@@ -0,0 +1,297 @@
+"""
+Order preserving binary encoding of keys.
+
+Keys are encoded into byte strings that sort in the same order as the
+keys themselves, so nodes can store compact strings and compare them
+with plain string comparisons, instead of comparing arbitrary python
+objects. Trees created with encode_keys set use this encoding.
+
+Supported key types are None, ints (and longs), floats, str, unicode,
+tuples of supported types and Descending wrappers of supported types,
+which reverse the order of the wrapped key. For example, the key
+
+  (score, Descending(timestamp), name)
+
+orders by ascending score, then by descending timestamp and finally
+by name.
+
+Keys of different types are ordered by type first: None, numbers,
+strings, tuples and finally Descending keys. Ints and floats share a
+single exact numeric scale, so 9.5 sorts before 10, and numbers that
+are equal have the same encoding: 10.0 and -0.0 decode as the ints 10
+and 0. Booleans are encoded as ints, and decode as such. NaN is not
+supported.
+
+A str is encoded as the unicode string it holds in UTF-8, so "a" and
+u"a" are the same key, and all strings decode as unicode. Byte
+strings that are not valid UTF-8 are not supported.
+"""
+__author__ = "Tijmen Roberti"
+__license__ = "MIT"
+
+import functools
+import math
+
+# The type tags that prefix each encoded value. The order of the tags
+# determines the order of values of different types.
+_END = 0x01                     # end of a tuple
+_NONE = 0x02
+_NEGATIVE_INFINITY = 0x0f
+_NEGATIVE = 0x10
+_POSITIVE = 0x11
+_POSITIVE_INFINITY = 0x12
+_UNICODE = 0x31
+_TUPLE = 0x40
+_DESCENDING = 0x50
+
+# Follows the integer part of a number without or with a fraction.
+_INTEGRAL = "\x00"
+_FRACTION = "\x01"
+
+# Strings are terminated by _STRING_END. Zero bytes in strings are
+# escaped as _ESCAPED_ZERO, which sorts after the terminator.
+_STRING_END = "\x00\x01"
+_ESCAPED_ZERO = "\x00\xff"
+
+
+@functools.total_ordering
+class Descending(object):
+    """
+    Wraps a key to reverse its order. Can be used as part of a tuple
+    key to sort some of its fields in descending order. Descending
+    keys also compare in reverse order when keys are not encoded.
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return isinstance(other, Descending) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if not isinstance(other, Descending):
+            return NotImplemented
+        return other.key < self.key
+
+    def __hash__(self):
+        return hash(self.key) ^ 0x5bd1e995
+
+    def __reduce__(self):
+        # The key is passed to the constructor, as a falsy state would
+        # not be restored.
+        return (Descending, (self.key,))
+
+    def __repr__(self):
+        return "Descending(%r)" % (self.key,)
+
+
+def encode(key):
+    """
+    Encodes |key| into a byte string. The byte strings of two keys
+    compare in the same way as the keys themselves.
+
+    Raises:
+      ValueError: If the key, or a part of it, has an unsupported type.
+    """
+    parts = []
+    _encode(key, parts)
+    return "".join(parts)
+
+
+def decode(data):
+    """
+    Decodes the byte string |data|, as returned by encode(), back to
+    the original key. Strings that are encoded as unicode are decoded
+    as unicode.
+
+    Raises:
+      ValueError: If the data is not a valid encoded key.
+    """
+    key, pos = _decode(data, 0, False)
+    if pos != len(data):
+        raise ValueError("Trailing data in encoded key %r" % (data,))
+    return key
+
+
+def _invert(data):
+    return "".join(chr(ord(c) ^ 0xff) for c in data)
+
+
+def _encode_string(data, parts):
+    parts.append(data.replace("\x00", _ESCAPED_ZERO))
+    parts.append(_STRING_END)
+
+
+def _to_bytes(value, length):
+    """
+    Returns the non-negative integer |value| as a big endian byte
+    string of |length| bytes.
+    """
+    data = []
+    for _ in xrange(length):
+        data.append(chr(value & 0xff))
+        value >>= 8
+    return "".join(reversed(data))
+
+
+def _from_bytes(data):
+    value = 0
+    for c in data:
+        value = (value << 8) | ord(c)
+    return value
+
+
+def _encode_number(key, parts):
+    """
+    Appends the encoding of the int or float |key| to |parts|. The
+    magnitude is encoded as the length and the bytes of its integer
+    part, followed by the bytes of its binary fraction, if any. The
+    fraction has no trailing zero bytes, so longer fractions are
+    larger, and is escaped like a string.
+    """
+    if isinstance(key, float):
+        if math.isnan(key):
+            raise ValueError("NaN keys are not supported")
+        if math.isinf(key):
+            parts.append(chr(_POSITIVE_INFINITY if key > 0
+                             else _NEGATIVE_INFINITY))
+            return
+        numerator, denominator = abs(key).as_integer_ratio()
+        integer, remainder = divmod(numerator, denominator)
+        negative = key < 0
+    else:
+        integer, remainder = abs(key), 0
+        negative = key < 0
+    length = (integer.bit_length() + 7) // 8
+    if length > 0xff:
+        raise ValueError("Integer key %s is too large" % (key,))
+    data = [chr(length), _to_bytes(integer, length)]
+    if remainder:
+        # The denominator is a power of two, so the fraction has a
+        # finite number of bits, which is padded to whole bytes.
+        bits = denominator.bit_length() - 1
+        size = (bits + 7) // 8
+        data.append(_FRACTION)
+        _encode_string(_to_bytes(remainder << (8 * size - bits), size), data)
+    else:
+        data.append(_INTEGRAL)
+    data = "".join(data)
+    # The encoding of the magnitude is prefix free, so inverting it
+    # reverses the order for negative numbers.
+    if negative and (integer or remainder):
+        parts.append(chr(_NEGATIVE) + _invert(data))
+    else:
+        parts.append(chr(_POSITIVE) + data)
+
+
+def _encode(key, parts):
+    """
+    Appends the encoding of |key| to the list |parts|.
+    """
+    if key is None:
+        parts.append(chr(_NONE))
+    elif isinstance(key, (int, long, float)):
+        _encode_number(key, parts)
+    elif isinstance(key, (str, unicode)):
+        if isinstance(key, str):
+            try:
+                key.decode("utf-8")
+            except UnicodeDecodeError:
+                raise ValueError("Byte string key %r is not UTF-8" % (key,))
+        else:
+            key = key.encode("utf-8")
+        # UTF-8 preserves the order of the code points.
+        parts.append(chr(_UNICODE))
+        _encode_string(key, parts)
+    elif isinstance(key, tuple):
+        parts.append(chr(_TUPLE))
+        for part in key:
+            _encode(part, parts)
+        parts.append(chr(_END))
+    elif isinstance(key, Descending):
+        # All encodings are prefix free, so inverting all bytes
+        # reverses the order.
+        inner = []
+        _encode(key.key, inner)
+        parts.append(chr(_DESCENDING) + _invert("".join(inner)))
+    else:
+        raise ValueError("Unsupported key type: %s" % (type(key),))
+
+
+def _decode(data, pos, inverted):
+    """
+    Decodes the value starting at |pos| in |data|. If |inverted| is
+    True, all bytes of the value are inverted. Returns a (key, pos)
+    tuple, with pos the position after the decoded value.
+    """
+    def read(n):
+        if pos + n > len(data):
+            raise ValueError("Truncated encoded key %r" % (data,))
+        chunk = data[pos:pos + n]
+        return _invert(chunk) if inverted else chunk
+
+    def read_string():
+        end = _invert(_STRING_END) if inverted else _STRING_END
+        escaped = _invert(_ESCAPED_ZERO) if inverted else _ESCAPED_ZERO
+        chunks = []
+        start = pos
+        while True:
+            i = data.find(end[0], start)
+            if i == -1 or i + 1 >= len(data):
+                raise ValueError("Unterminated string in key %r" % (data,))
+            if data[i:i + 2] == end:
+                chunks.append(data[start:i])
+                break
+            if data[i:i + 2] != escaped:
+                raise ValueError("Invalid escape in key %r" % (data,))
+            chunks.append(data[start:i + 1])
+            start = i + 2
+        chunk = "".join(chunks)
+        return (_invert(chunk) if inverted else chunk), i + 2
+
+    tag = ord(read(1))
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    elif tag == _POSITIVE_INFINITY:
+        return float("inf"), pos
+    elif tag == _NEGATIVE_INFINITY:
+        return -float("inf"), pos
+    elif tag in (_POSITIVE, _NEGATIVE):
+        if tag == _NEGATIVE:
+            inverted = not inverted
+        length = ord(read(1))
+        pos += 1
+        value = _from_bytes(read(length))
+        pos += length
+        marker = read(1)
+        pos += 1
+        if marker == _FRACTION:
+            fraction, pos = read_string()
+            try:
+                if not fraction or fraction[-1] == "\x00":
+                    raise OverflowError()
+                value = math.ldexp((value << (8 * len(fraction))) +
+                                   _from_bytes(fraction), -8 * len(fraction))
+            except OverflowError:
+                raise ValueError("Invalid fraction in key %r" % (data,))
+        elif marker != _INTEGRAL:
+            raise ValueError("Invalid number in key %r" % (data,))
+        return (-value if tag == _NEGATIVE else value), pos
+    elif tag == _UNICODE:
+        value, pos = read_string()
+        return value.decode("utf-8"), pos
+    elif tag == _TUPLE:
+        values = []
+        while ord(read(1)) != _END:
+            value, pos = _decode(data, pos, inverted)
+            values.append(value)
+        return tuple(values), pos + 1
+    elif tag == _DESCENDING:
+        value, pos = _decode(data, pos, not inverted)
+        return Descending(value), pos
+    raise ValueError("Invalid tag %s in encoded key %r" % (tag, data))
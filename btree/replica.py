@@ -0,0 +1,326 @@
+"""
+An in-process read replica of a tree.
+
+A TreeReplica keeps the nodes of a versioned tree in process memory
+and answers reads from there. The root of a versioned tree holds the
+generation of the tree, which increases with every batch that changes
+the tree, and each link holds the version of the node it refers to.
+The replica checks the root at most once per refresh interval, and
+after a change only fetches the nodes whose version differs from the
+one in its parent, as they are needed.
+
+Reads on a replica can thus be up to the refresh interval behind the
+tree, and they are not transactional. Use the tree itself for reads
+that must be current. Each read does see a single generation: if a
+node that is fetched during a read is newer than the link to it in
+its cached parent, the root is refreshed and the read starts over.
+A read that keeps finding newer nodes, for example while the tree is
+changed all the time, is done by the tree instead.
+"""
+__author__ = "Tijmen Roberti"
+__license__ = "MIT"
+
+import bisect
+import collections
+import threading
+import time
+
+# The number of times a read is started over after it found a node of
+# another generation than the cached root, after which it is done by
+# the tree itself.
+_MAX_RESTARTS = 5
+
+
+class _StaleRoot(Exception):
+    """
+    Raised during a read if a fetched node does not belong to the
+    generation of the cached root.
+    """
+
+
+class TreeReplica(object):
+    """
+    Serves reads of the versioned |tree| from process memory. The
+    generation of the tree is checked at most once every |refresh_ms|
+    milliseconds. At most |max_nodes| nodes are kept in memory, apart
+    from the root. When the replica is full, the least recently used
+    leaves are evicted first, and internal nodes only if no leaves are
+    left, as the upper levels are needed by every read.
+
+    A replica can be shared by the threads of a process.
+
+    Raises:
+      ValueError: If the tree is not versioned.
+    """
+    def __init__(self, tree, refresh_ms=1000, max_nodes=10000):
+        if not tree.versioned:
+            raise ValueError("Tree %s is not versioned" % (tree.key,))
+        self._tree = tree
+        self._refresh_ms = refresh_ms
+        self._max_nodes = max_nodes
+        self._lock = threading.RLock()
+        self._root = None
+        self._checked = None
+        # The cached leaves and internal nodes by id, in least
+        # recently used order.
+        self._leaves = collections.OrderedDict()
+        self._internal = collections.OrderedDict()
+
+    @property
+    def generation(self):
+        """
+        The generation of the tree that the replica currently serves.
+        """
+        with self._lock:
+            return self._get_root().version
+
+    def refresh(self):
+        """
+        Checks the generation of the tree now, instead of waiting for
+        the refresh interval to pass.
+        """
+        with self._lock:
+            self._checked = None
+            self._get_root()
+
+    def tree_size(self):
+        """
+        Returns the size of the tree.
+        """
+        with self._lock:
+            return self._read(lambda: self._get_root().tree_size(),
+                              self._tree.tree_size)
+
+    def __len__(self):
+        return self.tree_size()
+
+    def get_by_index(self, index):
+        """
+        Returns the item at the given |index|. A negative index counts
+        from the end.
+
+        Raises:
+          IndexError: If the index is out of bounds.
+        """
+        def read():
+            size = self._get_root().tree_size()
+            i = index + size if index < 0 else index
+            if not 0 <= i < size:
+                raise IndexError("Index %s out of range" % (index,))
+            return self._tree._decode_item(self._get_range(i, i + 1)[0])
+
+        with self._lock:
+            return self._read(read, lambda: self._tree.get_by_index(index))
+
+    def get_range(self, a, b):
+        """
+        Returns a list of the items with an index in the range [a, b),
+        interpreted as a slice.
+        """
+        return self[a:b]
+
+    def __getitem__(self, index):
+        """
+        Returns the item at the given index, or a list of items if a
+        slice with a step of 1 is provided.
+        """
+        if not isinstance(index, slice):
+            return self.get_by_index(index)
+        def read():
+            start, stop, step = index.indices(self._get_root().tree_size())
+            if step != 1:
+                raise ValueError("Stepping in a slice is not supported")
+            return self._tree._decode_items(self._get_range(start, stop))
+
+        with self._lock:
+            return self._read(read, lambda: self._tree[index])
+
+    def lower_bound(self, key):
+        """
+        Returns the index of the first item whose key is not smaller
+        than the given |key|.
+        """
+        stored = self._tree._encode_key(key)
+        with self._lock:
+            return self._read(
+                lambda: self._bound(stored, bisect.bisect_left),
+                lambda: self._tree.lower_bound(key))
+
+    def upper_bound(self, key):
+        """
+        Returns the index of the first item whose key is strictly
+        greater than |key|.
+        """
+        stored = self._tree._encode_key(key)
+        with self._lock:
+            return self._read(
+                lambda: self._bound(stored, bisect.bisect_right),
+                lambda: self._tree.upper_bound(key))
+
+    def index(self, key):
+        """
+        Returns the index of the first item with the given |key|.
+
+        Raises:
+          ValueError: If the key does not exist in the tree.
+        """
+        stored = self._tree._encode_key(key)
+
+        def read():
+            i = self._bound(stored, bisect.bisect_left)
+            if (i == self._get_root().tree_size()
+                or self._get_range(i, i + 1)[0][0] != stored):
+                raise ValueError("Key %s not found in the tree." % (key,))
+            return i
+
+        with self._lock:
+            return self._read(read, lambda: self._tree.index(key))
+
+    def _read(self, func, fallback):
+        """
+        Returns the result of |func|, which reads from the cached
+        nodes. If |func| finds a node of another generation than the
+        cached root, the root is refreshed and |func| is called again,
+        up to _MAX_RESTARTS times. After that, the result of
+        |fallback| is returned, which reads through the tree.
+        """
+        for _ in xrange(_MAX_RESTARTS + 1):
+            try:
+                return func()
+            except _StaleRoot:
+                self._checked = None
+        return fallback()
+
+    def _get_root(self):
+        """
+        Returns the cached root, after fetching it again if the
+        refresh interval has passed and the generation has changed.
+        """
+        now = time.time()
+        if (self._checked is None
+            or (now - self._checked) * 1000 >= self._refresh_ms):
+            read = lambda: self._fetch([self._tree._read_root_key()])[0]
+            if self._tree.root_pointer:
+                # A pointer that is read before the tree grows names
+                # the old root, which is then a child of the new root,
+                # so the pointer and the root are read together.
+                root = self._tree._storage.transaction(read)
+            else:
+                root = read()
+            assert root, "No root found for tree %s" % (self._tree.key,)
+            if self._root is None or root.version != self._root.version:
+                self._root = root
+            self._checked = now
+        return self._root
+
+    def _get_children(self, node, indices):
+        """
+        Returns the children at the given link |indices| of |node|.
+        Children that are not cached, or whose cached version differs
+        from the version in the link, are fetched together.
+
+        Raises:
+          _StaleRoot: If a fetched child no longer exists or has
+            changed since the cached root was read.
+        """
+        children = {}
+        missing = []
+        for i in indices:
+            link = node.links[i]
+            cache = self._leaves if link in self._leaves else self._internal
+            child = cache.get(link)
+            if child is not None and child.version == node.link_versions[i]:
+                # Mark as most recently used.
+                del cache[link]
+                cache[link] = child
+                children[i] = child
+            else:
+                missing.append(i)
+        fetched = self._fetch([self._tree._make_node_key(node.links[i])
+                               for i in missing])
+        stale = False
+        for i, child in zip(missing, fetched):
+            link = node.links[i]
+            self._leaves.pop(link, None)
+            self._internal.pop(link, None)
+            if child is None:
+                stale = True
+                continue
+            # Newer children are still cached, as they are checked
+            # against their link again when they are used.
+            (self._leaves if child.is_leaf() else self._internal)[link] = child
+            children[i] = child
+            stale = stale or child.version != node.link_versions[i]
+        self._evict()
+        if stale:
+            raise _StaleRoot()
+        return [children[i] for i in indices]
+
+    def _fetch(self, keys):
+        """
+        Returns the nodes with the given |keys|, or None for nodes
+        that do not exist.
+        """
+        nodes = self._tree._storage.get_multi(keys)
+        for node in nodes:
+            if node is not None:
+                self._tree._attach_node(node)
+        return nodes
+
+    def _evict(self):
+        """
+        Evicts the least recently used leaves, and then internal nodes,
+        until at most max_nodes nodes are cached.
+        """
+        while len(self._leaves) + len(self._internal) > self._max_nodes:
+            cache = self._leaves if self._leaves else self._internal
+            cache.popitem(last=False)
+
+    def _get_range(self, start, stop):
+        """
+        Returns the stored items with an index in the range [start,
+        stop). All children of a node that hold items in the range are
+        fetched together.
+        """
+        def in_order(node, start, stop, results):
+            # |start| and |stop| are relative to the tree of |node|.
+            if node.is_leaf():
+                results.extend(node.items(start, stop))
+                return
+            entries = []
+            offset = 0
+            for i, count in enumerate(node.counts):
+                end = offset + count
+                if start < end and offset < stop:
+                    entries.append((i, max(start, offset) - offset,
+                                    min(stop, end) - offset))
+                if i < node.size() and start <= end < stop:
+                    entries.append((i, None, None))
+                offset = end + 1
+            children = self._get_children(
+                node, [i for i, lo, _ in entries if lo is not None])
+            children.reverse()
+            for i, lo, hi in entries:
+                if lo is None:
+                    results.append(node.items(i, i + 1)[0])
+                else:
+                    in_order(children.pop(), lo, hi, results)
+
+        results = []
+        if start < stop:
+            in_order(self._get_root(), start, stop, results)
+        return results
+
+    def _bound(self, key, search):
+        """
+        Returns the index of the bound of |key| found with the bisect
+        function |search|, which is bisect_left or bisect_right.
+        """
+        index = 0
+        node = self._get_root()
+        while True:
+            i = search(node.keys, key)
+            if node.is_leaf():
+                return index + i
+            index += sum(node.counts[:i]) + i
+            node = self._get_children(node, [i])[0]
@@ -0,0 +1,283 @@
+"""
+Read-only snapshots of trees in a single memory-mapped file.
+
+A snapshot freezes the items of a tree into an immutable file, which
+readers map into memory with mmap. Items are looked up by index, key
+or identifier without any datastore traffic, and only the keys,
+values and identifiers that are actually read are deserialized. This
+suits trees that change rarely but are read very often, such as daily
+leaderboards.
+
+The file holds the items in tree order, in three columns: keys,
+values and identifiers. Each column is a table of offsets followed by
+the serialized entries, so the i'th entry is found directly. A fourth
+table holds the item indices sorted by identifier, for identifier
+lookups with a binary search.
+
+Example:
+
+write_snapshot(tree, "/tmp/scores.snapshot")
+with Snapshot("/tmp/scores.snapshot") as snapshot:
+    rank = snapshot.lower_bound(score)
+    top = snapshot[0:10]
+
+This module is not imported by the btree package, as App Engine does
+not support mmap.
+"""
+__author__ = "Tijmen Roberti"
+__license__ = "MIT"
+
+import bisect
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import keycodec
+
+_MAGIC = "BTSNAP1\x00"
+# The magic, the number of items, the flags and the offsets of the
+# seven sections.
+_HEADER = struct.Struct("<8sQQ7Q")
+_OFFSET = struct.Struct("<Q")
+
+# Flags
+_DESCENDING = 1
+_ENCODE_KEYS = 2
+_IDENTIFIERS = 4
+
+
+def write_snapshot(tree, path, page_size=1000):
+    """
+    Writes a snapshot of all items in |tree| to the file at |path|,
+    replacing it atomically if it already exists. The items are
+    streamed from the tree with iter_items() in pages of |page_size|
+    items, so the tree does not need to fit in memory, apart from its
+    identifiers, which are sorted in memory.
+
+    Each page is read in its own batch, so the snapshot is only
+    consistent if the tree does not change while it is written.
+    """
+    flags = ((_DESCENDING if tree.descending else 0) |
+             (_ENCODE_KEYS if tree.encode_keys else 0))
+    directory = os.path.dirname(os.path.abspath(path))
+    # The offset tables and the data of the three columns.
+    columns = [(tempfile.TemporaryFile(dir=directory),
+                tempfile.TemporaryFile(dir=directory)) for _ in range(3)]
+    sizes = [0, 0, 0]
+    identifiers = []
+    count = 0
+    for item in tree.iter_items(page_size=page_size):
+        if len(item) > 2:
+            flags |= _IDENTIFIERS
+            identifiers.append((str(item[2]), count))
+        key = tree._encode_key(item[0])
+        entries = [key if tree.encode_keys else pickle.dumps(key, 2),
+                   pickle.dumps(item[1], 2),
+                   str(item[2]) if len(item) > 2 else ""]
+        for i, entry in enumerate(entries):
+            offsets, data = columns[i]
+            offsets.write(_OFFSET.pack(sizes[i]))
+            data.write(entry)
+            sizes[i] += len(entry)
+        count += 1
+    identifiers.sort()
+
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as out:
+            out.write("\x00" * _HEADER.size)
+            sections = []
+            for i, (offsets, data) in enumerate(columns):
+                offsets.write(_OFFSET.pack(sizes[i]))
+                for section in (offsets, data):
+                    sections.append(out.tell())
+                    section.seek(0)
+                    shutil.copyfileobj(section, out)
+                    section.close()
+            sections.append(out.tell())
+            out.write("".join(_OFFSET.pack(index)
+                              for _, index in identifiers))
+            out.seek(0)
+            out.write(_HEADER.pack(_MAGIC, count, flags, *sections))
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+class Snapshot(object):
+    """
+    A read-only view of the snapshot file at |path|, as written by
+    write_snapshot(). Items are returned as by the tree the snapshot
+    was made of: (key, value) pairs, or (key, value, identifier)
+    tuples for MultiBTree2 trees. Keys and bounds follow the order of
+    the tree, also for descending trees.
+
+    Raises:
+      ValueError: If the file is not a snapshot.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._map, 0)
+        if header[0] != _MAGIC:
+            self._map.close()
+            raise ValueError("Not a snapshot: %s" % (path,))
+        self._size, self._flags = header[1:3]
+        self._sections = header[3:]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    def get_by_index(self, index):
+        """
+        Returns the item at the given |index|. A negative index counts
+        from the end.
+
+        Raises:
+          IndexError: If the index is out of bounds.
+        """
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("Index %s out of range" % (index,))
+        key = self._decode_key(self._stored_key(index))
+        value = pickle.loads(self._entry(1, index))
+        if self._flags & _IDENTIFIERS:
+            return (key, value, self._entry(2, index))
+        return (key, value)
+
+    def get_range(self, a, b):
+        """
+        Returns a list of the items with an index in the range [a, b),
+        interpreted as a slice.
+        """
+        return self[a:b]
+
+    def __getitem__(self, index):
+        """
+        Returns the item at the given index, or a list of items if a
+        slice with a step of 1 is provided.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._size)
+            if step != 1:
+                raise ValueError("Stepping in a slice is not supported")
+            return [self.get_by_index(i) for i in xrange(start, stop)]
+        return self.get_by_index(index)
+
+    def lower_bound(self, key):
+        """
+        Returns the index of the first item whose key is not smaller
+        than the given |key|.
+        """
+        return bisect.bisect_left(_KeyColumn(self), self._encode_key(key))
+
+    def upper_bound(self, key):
+        """
+        Returns the index of the first item whose key is strictly
+        greater than |key|.
+        """
+        return bisect.bisect_right(_KeyColumn(self), self._encode_key(key))
+
+    def index(self, key):
+        """
+        Returns the index of the first item with the given |key|.
+
+        Raises:
+          ValueError: If the key is not in the snapshot.
+        """
+        i = self.lower_bound(key)
+        if i == self._size or self._stored_key(i) != self._encode_key(key):
+            raise ValueError("Key %s not found in the snapshot." % (key,))
+        return i
+
+    def index_of_identifier(self, identifier):
+        """
+        Returns the index of the item with the given |identifier|, or
+        -1 if no such item exists.
+        """
+        if not self._flags & _IDENTIFIERS:
+            return -1
+        identifier = str(identifier)
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(2, self._identifier_rank(mid)) < identifier:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._size:
+            return -1
+        index = self._identifier_rank(lo)
+        return index if self._entry(2, index) == identifier else -1
+
+    def get_by_identifier(self, identifier):
+        """
+        Returns the item with the given |identifier|, or None if no
+        such item exists.
+        """
+        index = self.index_of_identifier(identifier)
+        return self.get_by_index(index) if index != -1 else None
+
+    def _entry(self, column, index):
+        """
+        Returns the serialized entry at |index| in the given |column|:
+        0 for keys, 1 for values and 2 for identifiers.
+        """
+        offsets = self._sections[2 * column]
+        data = self._sections[2 * column + 1]
+        start, = _OFFSET.unpack_from(self._map, offsets + 8 * index)
+        stop, = _OFFSET.unpack_from(self._map, offsets + 8 * index + 8)
+        return self._map[data + start:data + stop]
+
+    def _identifier_rank(self, i):
+        """
+        Returns the index of the item with the i'th smallest
+        identifier.
+        """
+        return _OFFSET.unpack_from(self._map, self._sections[6] + 8 * i)[0]
+
+    def _stored_key(self, index):
+        data = self._entry(0, index)
+        return data if self._flags & _ENCODE_KEYS else pickle.loads(data)
+
+    def _encode_key(self, key):
+        if self._flags & _DESCENDING:
+            key = keycodec.Descending(key)
+        if self._flags & _ENCODE_KEYS:
+            key = keycodec.encode(key)
+        return key
+
+    def _decode_key(self, key):
+        if self._flags & _ENCODE_KEYS:
+            key = keycodec.decode(key)
+        if self._flags & _DESCENDING:
+            key = key.key
+        return key
+
+
+class _KeyColumn(object):
+    """
+    A sequence view of the stored keys of a snapshot, for bisect.
+    Only the keys that are compared are deserialized.
+    """
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __getitem__(self, index):
+        return self._snapshot._stored_key(index)
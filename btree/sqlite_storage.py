@@ -0,0 +1,237 @@
+"""
+A storage engine that keeps trees in a local SQLite database file.
+
+Useful for offline work with the same trees as in the datastore, such
+as analytics or replaying historic leaderboards on a single machine.
+The tables hold one row per tree, one row per node and one row per
+identifier of the identifier index. Each batch of tree operations
+runs in a single SQLite transaction.
+
+Example:
+
+storage = SqliteStorage("/tmp/leaderboards.db")
+tree = MultiBTree2.get_or_create("scores", 64, storage=storage)
+with storage.bulk_load():
+    for chunk in chunks:
+        tree.update(chunk)
+
+This module is not imported by the btree package, as SQLite is not
+available on App Engine.
+"""
+__author__ = "Tijmen Roberti"
+__license__ = "MIT"
+
+import contextlib
+import json
+import sqlite3
+import threading
+from google.appengine.ext import ndb
+from storage import Storage
+
+# The maximum number of ids in a single SELECT or DELETE statement.
+_MAX_STATEMENT_IDS = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trees (
+    path TEXT PRIMARY KEY,
+    data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS nodes (
+    tree TEXT NOT NULL,
+    id NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (tree, id));
+CREATE TABLE IF NOT EXISTS indices (
+    tree TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (tree, id));
+CREATE TABLE IF NOT EXISTS sequences (
+    tree TEXT PRIMARY KEY,
+    value INTEGER NOT NULL);
+"""
+
+# The table for each entity kind. All other kinds are trees.
+_TABLES = {
+    '_BTreeNode': 'nodes',
+    '_BTreeIndex': 'indices',
+}
+
+
+def _path(pairs):
+    """
+    Returns the (kind, id) |pairs| of a key as a string, in which
+    str and unicode ids, and int and long ids, are identical.
+    """
+    return json.dumps([[kind, id] for kind, id in pairs])
+
+
+class SqliteStorage(Storage):
+    """
+    Stores the entities of trees in the SQLite database at |path|,
+    which is created if it does not exist. The database uses a write
+    ahead log, so readers in other processes are not blocked by a
+    writer.
+
+    A single connection is shared by all threads, and transactions are
+    serialized with a lock.
+    """
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.text_factory = str
+        self._lock = threading.RLock()
+        self._in_transaction = False
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._connection.close()
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """
+        Returns a context manager in which the database is not synced
+        to disk. This makes large loads considerably faster, but the
+        database can be corrupted if the machine crashes during the
+        load.
+        """
+        with self._lock:
+            self._connection.execute("PRAGMA synchronous=OFF")
+            try:
+                yield self
+            finally:
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+
+    def get_multi(self, keys):
+        with self._lock:
+            found = {}
+            for (table, tree), group in self._group(keys).iteritems():
+                for i in xrange(0, len(group), _MAX_STATEMENT_IDS):
+                    ids = [self._row(key)[2]
+                           for key in group[i:i + _MAX_STATEMENT_IDS]]
+                    if table == 'trees':
+                        rows = self._connection.execute(
+                            "SELECT path, data FROM trees WHERE path IN (%s)"
+                            % ",".join("?" * len(ids)), ids)
+                    else:
+                        rows = self._connection.execute(
+                            "SELECT id, data FROM %s WHERE tree = ? AND id IN "
+                            "(%s)" % (table, ",".join("?" * len(ids))),
+                            [tree] + ids)
+                    found.update(((table, tree, id), str(data))
+                                 for id, data in rows)
+            return [self._load(key, found.get(self._row(key)))
+                    for key in keys]
+
+    def put_multi(self, entities):
+        with self._lock:
+            rows = {}
+            for entity in entities:
+                table, tree, id = self._row(entity.key)
+                rows.setdefault(table, []).append(
+                    (tree, id, sqlite3.Binary(self._dump(entity))))
+            self._transact(self._put_rows, rows)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            self._transact(self._delete_keys, keys)
+
+    def query_keys(self, model_class, parent):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM %s WHERE tree = ?"
+                % _TABLES[model_class._get_kind()], (_path(parent.pairs()),))
+            return [ndb.Key(model_class, id, parent=parent) for id, in rows]
+
+    def allocate_id(self, model_class, parent):
+        with self._lock:
+            return self._transact(self._next_id, _path(parent.pairs()))
+
+    def transaction(self, func, xg=False):
+        with self._lock:
+            if self._in_transaction:
+                return func()
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                result = func()
+                self._connection.execute("COMMIT")
+                return result
+            except:
+                self._connection.execute("ROLLBACK")
+                raise
+            finally:
+                self._in_transaction = False
+
+    def in_transaction(self):
+        with self._lock:
+            return self._in_transaction
+
+    def _transact(self, func, *args):
+        """
+        Calls func(*args) in the current transaction, or otherwise in
+        a transaction of its own.
+        """
+        return self.transaction(lambda: func(*args))
+
+    def _row(self, key):
+        """
+        Returns the (table, tree, id) tuple that identifies the row of
+        the entity with the given |key|. For trees, the tree is None
+        and the id is the path of the key.
+        """
+        table = _TABLES.get(key.kind(), 'trees')
+        if table == 'trees':
+            return table, None, _path(key.pairs())
+        return table, _path(key.parent().pairs()), key.id()
+
+    def _group(self, keys):
+        """
+        Returns a dict that maps each (table, tree) tuple to the list
+        of |keys| with a row in that table and tree.
+        """
+        groups = {}
+        for key in keys:
+            table, tree, _ = self._row(key)
+            groups.setdefault((table, tree), []).append(key)
+        return groups
+
+    def _put_rows(self, rows):
+        for table, values in rows.iteritems():
+            if table == 'trees':
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO trees (path, data) VALUES (?, ?)",
+                    [(id, data) for _, id, data in values])
+            else:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO %s (tree, id, data) "
+                    "VALUES (?, ?, ?)" % table, values)
+
+    def _delete_keys(self, keys):
+        rows = {}
+        for key in keys:
+            table, tree, id = self._row(key)
+            rows.setdefault(table, []).append((tree, id))
+        for table, values in rows.iteritems():
+            if table == 'trees':
+                self._connection.executemany(
+                    "DELETE FROM trees WHERE path = ?",
+                    [(path,) for _, path in values])
+            else:
+                self._connection.executemany(
+                    "DELETE FROM %s WHERE tree = ? AND id = ?" % table,
+                    values)
+
+    def _next_id(self, tree):
+        row = self._connection.execute(
+            "SELECT value FROM sequences WHERE tree = ?", (tree,)).fetchone()
+        value = row[0] + 1 if row else 1
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sequences (tree, value) VALUES (?, ?)",
+            (tree, value))
+        return value
@@ -0,0 +1,255 @@
+"""
+Storage engines for the entities of a tree.
+
+A tree reads and writes its entities (the tree itself, its nodes and
+its identifier index) only through a storage engine, so the same
+counted tree algorithms can run against different stores. All
+entities are ndb models with ndb keys, but only NdbStorage sends them
+to the datastore.
+
+NdbStorage is the default engine and stores the entities in the App
+Engine datastore. MemoryStorage keeps the entities in process memory,
+which is useful for caches, batch jobs and benchmarks that should run
+without the datastore or its stubs. The sqlite_storage module has an
+engine that stores the entities in a local SQLite database file.
+"""
+__author__ = "Tijmen Roberti"
+__license__ = "MIT"
+
+import itertools
+import pickle
+import threading
+from google.appengine.ext import ndb
+
+# The maximum number of keys in a single datastore delete call.
+_MAX_DELETE_KEYS = 500
+
+
+class Storage(object):
+    """
+    The interface of a storage engine. Entities are identified by
+    their ndb.Key. Reads return None for entities that do not exist.
+    """
+    def get(self, key):
+        """
+        Returns the entity with the given |key|, or None.
+        """
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        """
+        Returns a list with the entity for each key in |keys|, or None
+        for the keys of entities that do not exist.
+        """
+        raise NotImplementedError()
+
+    def put_multi(self, entities):
+        """
+        Stores all |entities|, replacing existing entities with the
+        same keys.
+        """
+        raise NotImplementedError()
+
+    def write_multi(self, entities, keys_to_delete):
+        """
+        Stores all |entities| and deletes the entities with the keys in
+        |keys_to_delete|. No key can be in both.
+        """
+        self.put_multi(entities)
+        self.delete_multi(keys_to_delete)
+
+    def delete_multi(self, keys):
+        """
+        Deletes the entities with the given |keys|, if they exist.
+        """
+        raise NotImplementedError()
+
+    def query_keys(self, model_class, parent):
+        """
+        Returns a list with the keys of all entities of |model_class|
+        with the key |parent| as parent.
+        """
+        raise NotImplementedError()
+
+    def allocate_id(self, model_class, parent):
+        """
+        Returns a new unique integer id for an entity of |model_class|
+        with the given |parent| key.
+        """
+        raise NotImplementedError()
+
+    def transaction(self, func, xg=False):
+        """
+        Calls |func| in a transaction and returns its result. If a
+        transaction is already in progress, |func| is called as part
+        of that transaction. If |xg| is True, the transaction can span
+        the entities of several trees, for engines that otherwise
+        limit a transaction to a single tree.
+        """
+        raise NotImplementedError()
+
+    def in_transaction(self):
+        """
+        Returns whether a transaction is in progress.
+        """
+        raise NotImplementedError()
+
+    def _dump(self, entity):
+        """
+        Returns |entity| serialized to a string, for engines that
+        store entities as strings. The key is not included.
+        """
+        return pickle.dumps((entity.__class__, entity.to_dict()), 2)
+
+    def _load(self, key, data):
+        """
+        Returns the entity with the given |key| from the string |data|
+        returned by _dump(), or None if data is None.
+        """
+        if data is None:
+            return None
+        model_class, values = pickle.loads(data)
+        return model_class(key=key, **values)
+
+
+class NdbStorage(Storage):
+    """
+    Stores the entities in the App Engine datastore, through ndb.
+    """
+    def get(self, key):
+        return key.get()
+
+    def get_multi(self, keys):
+        return ndb.get_multi(keys)
+
+    def put_multi(self, entities):
+        ndb.put_multi(entities)
+
+    def write_multi(self, entities, keys_to_delete):
+        # The deletes and puts run concurrently.
+        futures = ndb.delete_multi_async(keys_to_delete)
+        ndb.put_multi(entities)
+        [future.get_result() for future in futures]
+
+    def delete_multi(self, keys):
+        # Large deletes are split into chunks that run concurrently.
+        futures = []
+        for i in xrange(0, len(keys), _MAX_DELETE_KEYS):
+            chunk = keys[i:i + _MAX_DELETE_KEYS]
+            futures.extend(ndb.delete_multi_async(chunk))
+        [future.get_result() for future in futures]
+
+    def query_keys(self, model_class, parent):
+        # An ancestor query also returns the entities of trees that
+        # have |parent| as ancestor.
+        return [key for key
+                in model_class.query(ancestor=parent).fetch(keys_only=True)
+                if key.parent() == parent]
+
+    @ndb.non_transactional
+    def allocate_id(self, model_class, parent):
+        # Allocate ids is not possible within a transaction for some
+        # reason, so the non_transactional decorator is used to step
+        # outside the current transaction.
+        return model_class.allocate_ids(1, parent=parent)[0]
+
+    def transaction(self, func, xg=False):
+        if ndb.in_transaction():
+            return func()
+        return ndb.transaction(func, xg=xg)
+
+    def in_transaction(self):
+        return ndb.in_transaction()
+
+
+class MemoryStorage(Storage):
+    """
+    Stores the entities in process memory. Each entity is stored as a
+    pickled copy, so entities that are changed but not put do not
+    affect the stored ones.
+
+    Transactions are serialized with a lock. The writes of a
+    transaction are applied when it completes, and are discarded if
+    it raises an exception. A single instance can be shared by many
+    trees, and by the threads of a process.
+    """
+    def __init__(self):
+        self._entities = {}
+        # The writes of the current transaction, None if no
+        # transaction is in progress. Deleted keys map to None.
+        self._pending = None
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+
+    def get_multi(self, keys):
+        with self._lock:
+            results = []
+            for key in keys:
+                if self._pending is not None and key in self._pending:
+                    data = self._pending[key]
+                else:
+                    data = self._entities.get(key)
+                results.append(self._load(key, data))
+            return results
+
+    def put_multi(self, entities):
+        with self._lock:
+            self._write(dict((entity.key, self._dump(entity))
+                             for entity in entities))
+
+    def delete_multi(self, keys):
+        with self._lock:
+            self._write(dict.fromkeys(keys))
+
+    def query_keys(self, model_class, parent):
+        with self._lock:
+            keys = set(self._entities)
+            for key, data in (self._pending or {}).iteritems():
+                if data is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+            kind = model_class._get_kind()
+            return [key for key in keys
+                    if key.kind() == kind and key.parent() == parent]
+
+    def allocate_id(self, model_class, parent):
+        with self._lock:
+            return self._ids.next()
+
+    def transaction(self, func, xg=False):
+        with self._lock:
+            if self._pending is not None:
+                return func()
+            self._pending = {}
+            try:
+                result = func()
+                self._pending, writes = None, self._pending
+                self._write(writes)
+                return result
+            finally:
+                self._pending = None
+
+    def in_transaction(self):
+        with self._lock:
+            return self._pending is not None
+
+    def __len__(self):
+        """
+        Returns the number of stored entities.
+        """
+        return len(self._entities)
+
+    def _write(self, writes):
+        """
+        Applies the dict |writes|, which maps keys to pickled entities
+        or to None for deleted entities.
+        """
+        if self._pending is not None:
+            self._pending.update(writes)
+            return
+        for key, data in writes.iteritems():
+            if data is None:
+                self._entities.pop(key, None)
+            else:
+                self._entities[key] = data